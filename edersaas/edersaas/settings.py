@@ -50,15 +50,37 @@ ROBOTSTXT_OBEY = True
 
 # Enable or disable downloader middlewares
 # See https://docs.scrapy.org/en/latest/topics/downloader-middleware.html
+DOWNLOADER_MIDDLEWARES = {
+    "scrapy.downloadermiddlewares.retry.RetryMiddleware": None,
+    "webtexts.retry.BackoffRetryMiddleware": 550,
+}
 #DOWNLOADER_MIDDLEWARES = {
 #    "edersaas.middlewares.EdersaasDownloaderMiddleware": 543,
 #}
 
 # Enable or disable extensions
 # See https://docs.scrapy.org/en/latest/topics/extensions.html
-#EXTENSIONS = {
-#    "scrapy.extensions.telnet.TelnetConsole": None,
-#}
+EXTENSIONS = {
+    "webtexts.throttle.AdaptiveThrottle": 500,
+}
+
+# Feeds are encoded with orjson when it is installed, indented by 2 then
+FEED_EXPORTERS = {
+    "json": "webtexts.exporters.FastJsonItemExporter",
+    "jsonlines": "webtexts.exporters.FastJsonLinesItemExporter",
+}
+
+# `json` writes each spider's feed as a single JSON array, `shards` as
+# compressed JSON Lines shards (see webtexts.feeds.ShardedJsonLinesPipeline),
+# `none` writes no feed
+FEED_MODE = "json"
+FEED_SHARD_COMPRESSION = "gzip"
+FEED_SHARD_MAX_ITEMS = 100_000
+FEED_SHARD_MAX_BYTES = 256 * 2 ** 20
+
+# Part of the spider's input this process crawls, set by run_shards.py
+SHARD_COUNT = 1
+SHARD_INDEX = 0
 
 # Configure item pipelines
 # See https://docs.scrapy.org/en/latest/topics/item-pipeline.html
@@ -66,6 +88,15 @@ ROBOTSTXT_OBEY = True
 #    "edersaas.pipelines.EdersaasPipeline": 300,
 #}
 
+# Tune delay and concurrency per host from latency and errors, spiders'
+# DOWNLOAD_DELAY is only the starting delay then. Slots start at the
+# concurrency ceiling of their host
+ADAPTIVE_THROTTLE_ENABLED = True
+ADAPTIVE_HOST_LIMITS = {
+    "edersaas.ru": {"min_delay": 1.0, "max_concurrency": 2},
+    "sakha.ysia.ru": {"min_delay": 1.0, "max_concurrency": 2},
+}
+
 # Enable and configure the AutoThrottle extension (disabled by default)
 # See https://docs.scrapy.org/en/latest/topics/autothrottle.html
 #AUTOTHROTTLE_ENABLED = True
@@ -84,7 +115,8 @@ ROBOTSTXT_OBEY = True
 #HTTPCACHE_ENABLED = True
 #HTTPCACHE_EXPIRATION_SECS = 0
 #HTTPCACHE_DIR = "httpcache"
-#HTTPCACHE_IGNORE_HTTP_CODES = []
+# throttling and server errors are retried, not cached
+HTTPCACHE_IGNORE_HTTP_CODES = [429, 500, 502, 503, 504]
 #HTTPCACHE_STORAGE = "scrapy.extensions.httpcache.FilesystemCacheStorage"
 
 # Set settings whose default value is deprecated to a future-proof value
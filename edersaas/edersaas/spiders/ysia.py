@@ -5,6 +5,8 @@ from urllib.parse import urlencode, parse_qs
 import scrapy
 from scrapy import Request, FormRequest
 
+from webtexts.feeds import update_feed_settings
+
 NAME = "ysia"
 PHP_ENDPOINT = "https://sakha.ysia.ru/wp-admin/admin-ajax.php"
 
@@ -87,17 +89,21 @@ class YsiaSpider(scrapy.Spider):
     def update_settings(cls, settings):
         
         super().update_settings(settings)
-        settings.setdefault("FEEDS", {}).update(cls.custom_feed)
+        update_feed_settings(settings, cls.custom_feed)
 
     @staticmethod
-    def inc_page(page: str) -> int:
-        return int(page) + 1
+    def inc_page(page: str, step: int = 1) -> int:
+        return int(page) + step
 
     def start_requests(self):
         data = BASE_DATA
         if hasattr(self, "from_page"):
             page = self.from_page
             data["page"] = page
+        # with `SHARD_COUNT` processes, each one takes every `SHARD_COUNT`-th page
+        shard_index = self.settings.getint("SHARD_INDEX", 0)
+        if shard_index:
+            data["page"] = str(self.inc_page(data["page"], shard_index))
 
         req = FormRequest(
             PHP_ENDPOINT, formdata=data, #method="POST", #headers=HEADERS_2,
@@ -188,7 +194,7 @@ class YsiaSpider(scrapy.Spider):
             self.log(article_data)
             yield Request(url, callback=self.parse_page, cb_kwargs=article_data)
 
-        meta["page"] = str(self.inc_page(meta['page']))
+        meta["page"] = str(self.inc_page(meta['page'], self.settings.getint("SHARD_COUNT", 1)))
         yield FormRequest(
             PHP_ENDPOINT, formdata=meta,
             callback=self.parse,
@@ -0,0 +1,207 @@
+"""Throughput of converting forum dates with `forum_ykt.utils`, against the split-and-branch parser used before.
+
+    python benchmarks/bench_dates.py [--synthetic N] [--days N] [--snapshots N] [--repeat N]
+
+Dates are generated as listings of `--days` capture days show the last
+updates of topics: times of that day, "вчера, 12:30", "5 мая 12:30" for
+the same year and "5 мая 2015" before it, the same older topics seen on
+many days. The web archive often has a few captures of a page a day, so
+every listing is seen `--snapshots` times. Both parsers are checked to
+agree on them. The engine is timed
+without its caches, with them (cleared first) and a capture day at a time
+through the batch API.
+
+The engine is slower than the old parser without its caches (about x0.6),
+and is faster only as far as dates repeat: about x1.3 with 2 captures a day,
+x2 with 4, and below the old parser again with 1.
+"""
+import argparse
+from datetime import datetime, timedelta
+from pathlib import Path
+import random
+import sys
+import time
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from forum_ykt.utils import (
+    months,
+    parse_customary_date,
+    convert_customary_date,
+    convert_customary_to_datetime,
+    convert_customary_dates,
+)
+
+
+MONTH_NAMES = ["января", "февраля", "марта", "апреля", "мая", "июня",
+               "июля", "августа", "сентября", "октября", "ноября", "декабря"]
+
+
+def ru_month_to_int(ru_month: str) -> int:
+    return months[ru_month[:3]]
+
+
+def convert_time_str(time_str: str):
+    time_sep = ":"
+    if time_sep in time_str:
+        parts = time_str.split(time_sep)
+        if len(parts) == 2:
+            hour, minute = map(int, parts)
+            return hour, minute, 0
+
+    raise ValueError(f"unknown pattern for time with time_sep=`{time_sep}`: {time_str}")
+
+
+def convert_reference(time: str, today: datetime):
+    """`convert_customary_to_datetime` as it was"""
+    close_day_sep = ", "
+    if close_day_sep in time:
+        close_day, time_str = time.split(close_day_sep)
+
+        if close_day.lower() == "вчера":
+            day = today.day - 1
+            hour, minute, second = convert_time_str(time_str)
+            return datetime(today.year, today.month, day, hour, minute, second)
+
+    date_sep = " "
+    time_sep = ":"
+    if date_sep in time:
+        parts = time.split(date_sep)
+        if len(parts) == 4:
+            day, month, year, time_str = parts
+
+            day = int(day)
+            month = ru_month_to_int(month)
+            year = int(year)
+            hour, minute, second = convert_time_str(time_str)
+            return datetime(today.year, today.month, today.day, hour, minute, second)
+        elif len(parts) == 3:
+            day, month, year_or_time = parts
+
+            day = int(day)
+            month = ru_month_to_int(month)
+            if time_sep in year_or_time:
+                hour, minute, second = convert_time_str(year_or_time)
+                return datetime(today.year, month, day, hour, minute, second)
+            else:
+                year = int(year_or_time)
+                return datetime(year, month, day)
+        elif len(parts) == 2:
+            day, month = parts
+
+            day = int(day)
+            month = ru_month_to_int(month)
+            year = today.year
+        else:
+            raise ValueError(f"unknown pattern with date_sep=`{date_sep}`: {time}")
+
+        return datetime(year, month, day)
+
+    if time_sep in time:
+        hour, minute, second = convert_time_str(time)
+        return datetime(today.year, today.month, today.day, hour, minute, second)
+
+    return f"<{time}>"
+
+
+def show_date(update: datetime, today: datetime) -> str:
+    """`update` as a listing captured `today` shows it"""
+    hour_minute = f"{update.hour}:{update.minute:02d}"
+    if update.date() == today.date():
+        return hour_minute
+    if update.date() == today.date() - timedelta(days=1):
+        return f"вчера, {hour_minute}"
+    if update.year == today.year:
+        return f"{update.day} {MONTH_NAMES[update.month - 1]} {hour_minute}"
+    return f"{update.day} {MONTH_NAMES[update.month - 1]} {update.year}"
+
+
+def make_dates(n: int, days: int, topics: int, snapshots: int, seed: int = 0):
+    """(date, capture time) pairs of topics seen on listings of `days` capture days,
+    each captured `snapshots` times that day"""
+    rng = random.Random(seed)
+    latest = datetime(2021, 10, 28, 2, 46)
+    # the old parser gets "вчера" wrong on the first of a month
+    days = sorted(
+        day for day in (latest - timedelta(days=rng.randrange(3000)) for _ in range(days))
+        if day.day > 1
+    )
+    updates = sorted(latest - timedelta(minutes=rng.randrange(3000 * 24 * 60)) for _ in range(topics))
+
+    rows = n // (len(days) * snapshots) or 1
+    pairs = []
+    for day in days:
+        listing = []
+        for _ in range(rows):
+            # listings show recent topics more often
+            update = day - timedelta(minutes=int(rng.expovariate(1 / (60 * 24 * 60))))
+            if rng.random() < 0.5:
+                earlier = [update for update in updates[:len(updates) // 2] if update < day]
+                update = rng.choice(earlier) if earlier else update
+            listing.append(show_date(update, day))
+        for i in range(snapshots):
+            today = day + timedelta(minutes=i)
+            pairs.extend((date, today) for date in listing)
+    return pairs
+
+
+def best_of(func, repeat: int) -> float:
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--synthetic", type=int, default=100_000, help="dates to convert")
+    parser.add_argument("--days", type=int, default=500, help="distinct capture days")
+    parser.add_argument("--topics", type=int, default=5000, help="older topics seen again and again")
+    parser.add_argument("--snapshots", type=int, default=2, help="captures of every listing a day")
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    pairs = make_dates(args.synthetic, args.days, args.topics, args.snapshots)
+    for date, today in pairs:
+        assert convert_reference(date, today) == convert_customary_to_datetime(date, today), (date, today)
+
+    captures = {}
+    for date, today in pairs:
+        captures.setdefault(today, []).append(date)
+
+    def clear_caches():
+        convert_customary_date.cache_clear()
+        parse_customary_date.cache_clear()
+
+    def run_uncached():
+        # the resolve step calls the parse one through its cache, emptied every time
+        for date, today in pairs:
+            parse_customary_date.cache_clear()
+            convert_uncached(date, today.date())
+
+    def run_cached():
+        clear_caches()
+        for date, today in pairs:
+            convert_customary_to_datetime(date, today)
+
+    def run_batch():
+        clear_caches()
+        for today, dates in captures.items():
+            convert_customary_dates(dates, today)
+
+    convert_uncached = convert_customary_date.__wrapped__
+    timings = {
+        "reference": best_of(lambda: [convert_reference(date, today) for date, today in pairs], args.repeat),
+        "engine, no cache": best_of(run_uncached, args.repeat),
+        "engine": best_of(run_cached, args.repeat),
+        "engine, batch": best_of(run_batch, args.repeat),
+    }
+    print(f"{len(pairs)} dates of {len(captures)} captures, {len({date for date, _ in pairs})} distinct")
+    for name, timing in timings.items():
+        print(f"{name:<20} {len(pairs) / timing / 1000:8.0f}k dates/s  x{timings['reference'] / timing:.1f}")
+
+
+if __name__ == "__main__":
+    main()
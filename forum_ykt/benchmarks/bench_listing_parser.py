@@ -0,0 +1,161 @@
+"""Per-row cost of `TopicsSpider.parse` on listing pages, against building every row from scratch.
+
+    python benchmarks/bench_listing_parser.py [saved listing pages...] [--url SNAPSHOT_URL] [--repeat N]
+
+The reference is `parse` as it was before listing layouts: the selectors
+of all layouts are tried on every row, and the capture time and the
+`forum_*` keys of the record are got anew for every row. Items of both are
+checked to be equal. Without saved pages, `--synthetic N` makes listings
+of N topics in both layouts, 2021 ones with some author names in
+`.f-topic_author_name` as well.
+"""
+import argparse
+from pathlib import Path
+import sys
+import time
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from scrapy.http import HtmlResponse
+
+from forum_ykt.layouts import LayoutRegistry
+from forum_ykt.spiders.topics import TopicsSpider
+from forum_ykt.utils import convert_customary_to_datetime, safe_strip
+from forum_ykt.wayback import resolve_snapshot_link
+
+
+SNAPSHOT_URL = "https://web.archive.org/web/{timestamp}/https://forum.ykt.ru/viewforum.jsp?id=149&page=2"
+
+
+def make_author_2021(i: int) -> str:
+    # some rows have the name in an element of its own, as 2014 listings do
+    if i % 7 == 3:
+        return f'<div class="f-topic_author"> <span class="f-topic_author_name">user{i % 50}</span></div>'
+    return f'<div class="f-topic_author"> user{i % 50} </div>'
+
+
+def make_listing_2021(n: int) -> bytes:
+    rows = "".join(
+        f'<div class="f-topic"><div class="f-topic_title">'
+        f'<a href="/web/20211028024613/https://forum.ykt.ru/viewtopic.jsp?id={i}"> Тема {i} </a></div>'
+        f'{make_author_2021(i)}<div class="f-topic_replies"> {i % 40} </div>'
+        f'<div class="f-topic_update"><span>{i % 28 + 1} мая 2021</span></div></div>'
+        for i in range(n)
+    )
+    return f'<html><body><div class="f-topics">{rows}</div></body></html>'.encode("utf-8")
+
+
+def make_listing_2014(n: int) -> bytes:
+    rows = "".join(
+        f'<div class="f-topic"><a class="f-topic_title" href="/web/20140501000000/http://forum.ykt.ru/viewtopic.jsp?id={i}">'
+        f' Тема {i} </a><div class="f-topic_author"><span class="f-topic_author_name"> user{i % 50} </span></div>'
+        f'<div class="f-topic_footer"><span class="f-topic_footer_comments">{i % 40}</span>'
+        f'<span class="f-topic_footer_update">{i % 28 + 1}.04.2014</span></div></div>'
+        for i in range(n)
+    )
+    return f'<html><body><div class="f-topics">{rows}</div></body></html>'.encode("utf-8")
+
+
+def make_records(n: int) -> list:
+    """Forums feed records of the same capture, before `parse` adds the capture info to them"""
+    return [
+        {
+            "forum_name": "Сахалыы", "forum_style": "default", "forum_id": 149, "page": 2,
+            "query_date": f"2021-0{i + 1}-01", "orig_url": "https://forum.ykt.ru/viewforum.jsp?id=149&page=2",
+            "status": "200", "available": True, "orig_timestamp": "20211031",
+        }
+        for i in range(n)
+    ]
+
+
+def parse_reference(spider: TopicsSpider, response: HtmlResponse, metas: list) -> list:
+    topics = []
+    for topic in response.css("div.f-topics div.f-topic"):
+        real_meta = spider.get_real_info(response)
+        title, href = spider.get_title(topic)
+        topic_url, orig_url = resolve_snapshot_link(response.url, href)
+        num_messages, last_update_timestamp = spider.get_num_messages_last_update(topic)
+        last_update = (
+            convert_customary_to_datetime(last_update_timestamp, real_meta["real_timestamp"])
+            if last_update_timestamp else None
+        )
+        topics.append({
+            "topic_title": title,
+            "topic_url": topic_url,
+            "topic_orig_url": orig_url,
+            "topic_author": safe_strip(spider.get_author(topic)) or None,
+            "topic_num_messages": num_messages,
+            "topic_last_update": last_update,
+        })
+
+    items = []
+    for meta in metas:
+        meta.update(spider.get_real_info(response))
+        forum_meta = {(f"forum_{key}" if not key.startswith("forum") else key): val
+                      for key, val in meta.items()}
+        items.extend({**topic, **forum_meta} for topic in topics)
+    return items
+
+
+class NoIndex:
+    def record(self, item) -> None:
+        pass
+
+
+def best_of(func, repeat: int) -> float:
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("pages", nargs="*", type=Path)
+    parser.add_argument("--url", default=SNAPSHOT_URL.format(timestamp="20211028024613"),
+                        help="snapshot url of the saved pages")
+    parser.add_argument("--synthetic", type=int, default=50, help="topics of a generated listing")
+    parser.add_argument("--records", type=int, default=2, help="forums records sharing the capture")
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    if args.pages:
+        pages = {page.name: (args.url, page.read_bytes()) for page in args.pages}
+    else:
+        pages = {
+            f"2021, {args.synthetic} topics": (
+                SNAPSHOT_URL.format(timestamp="20211028024613"), make_listing_2021(args.synthetic)
+            ),
+            f"2014, {args.synthetic} topics": (
+                SNAPSHOT_URL.format(timestamp="20140501000000"), make_listing_2014(args.synthetic)
+            ),
+        }
+
+    spider = TopicsSpider()
+    spider.log = lambda *args, **kwargs: None
+    spider.layouts = LayoutRegistry()
+    spider.topic_index = NoIndex()
+    spider.cover = None
+
+    for name, (url, body) in pages.items():
+        response = HtmlResponse(url=url, body=body, encoding="utf-8")
+        # the selector tree is built once and shared, as in the spider
+        response.selector
+        items = list(spider.parse(response, make_records(args.records)))
+        assert parse_reference(spider, response, make_records(args.records)) == items, name
+        if not args.pages:
+            assert all(item["topic_author"] for item in items), f"{name}: rows without an author"
+        if not items:
+            print(f"{name:<30} no topics")
+            continue
+
+        reference = best_of(lambda: parse_reference(spider, response, make_records(args.records)), args.repeat)
+        engine = best_of(lambda: list(spider.parse(response, make_records(args.records))), args.repeat)
+        print(f"{name:<30} reference {reference / len(items) * 1e6:7.1f} us/item  "
+              f"parse {engine / len(items) * 1e6:7.1f} us/item  x{reference / engine:.1f}")
+
+
+if __name__ == "__main__":
+    main()
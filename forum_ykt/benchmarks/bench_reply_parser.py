@@ -0,0 +1,167 @@
+"""Compare the recursive `parse_reply` the spider had with the iterative `iter_reply_tree`.
+
+    python benchmarks/bench_reply_parser.py [saved topic pages...] [--repeat N]
+
+Every page is parsed with both, and their replies are checked to be equal.
+Without saved pages, `--synthetic N` makes a thread of N replies, both
+flat and as a single chain (the deepest tree there can be).
+"""
+import typing as T
+import argparse
+from pathlib import Path
+import sys
+import time
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+import scrapy
+from scrapy.http import HtmlResponse
+
+from forum_ykt.items import Reply
+from forum_ykt.spiders.replies import RepliesSpider
+from forum_ykt.utils import safe_int, safe_strip
+
+
+HEAD_HTML = (
+    '<div class="f-view"><div class="f-view_like" data-id="1">'
+    '<span class="f-comment_like_count">5</span></div>'
+    '<span class="topic-view__author">owner</span><span class="f-user_ip" data-title="10.0.0.1"></span>'
+    '<time datetime="2020-01-01 10:00:00.000"></time><div class="f-view_topic-text">head</div></div>'
+)
+
+
+def make_reply_html(i: int, children: str = "") -> str:
+    further_replies = f'<ul class="f-comments_list">{children}</ul>' if children else ""
+    return (
+        f'<li id="comment-{i}"><div class="f-comment" data-date="{1600000000000 + i * 60000}">'
+        f'<div class="f-comment_content"><div class="f-comment_topic"><b>re: {i}</b></div>'
+        f'<span class="f-user_name"> user{i % 50} </span>'
+        f'<span class="f-comment_ip" data-title="10.0.0.{i % 7}"></span>'
+        f'<p>reply {i}<br>second line</p><p>paragraph</p>'
+        f'<span class="f-comment_like_count">{i % 4}</span></div></div>{further_replies}</li>'
+    )
+
+
+def make_thread_html(n: int, chain: bool) -> bytes:
+    if chain:
+        items = ""
+        for i in range(n, 0, -1):
+            items = make_reply_html(i, items)
+    else:
+        items = "".join(make_reply_html(i) for i in range(1, n + 1))
+    return (
+        f'<html><body>{HEAD_HTML}<div class="f-comments_content">'
+        f'<ul class="topic-comments__items">{items}</ul></div></body></html>'
+    ).encode("utf-8")
+
+
+def parse_reply(
+    spider: RepliesSpider, reply_li: scrapy.Selector, head_id: int, parent_id: T.Optional[int]=None,
+    is_by_owner_checker: T.Optional[T.Callable[[str], bool]]=None
+) -> T.List[Reply]:
+    """`RepliesSpider.parse_reply` as it was, recursing into replies to replies"""
+    results: T.List[Reply] = []
+
+    reply_id = safe_int(reply_li.attrib["id"].strip("comment-")) or spider.default_id
+
+    reply_div = reply_li.css(".f-comment")
+
+    content = reply_li.css(".f-comment_content")[0]
+    title = content.css(".f-comment_topic > *::text").getall()
+    if len(title) > 1:
+        spider.logger.info(f"more than 1 string in title for reply: {reply_id}")
+
+    text = content.css("p::text").getall()
+    rating = safe_int(safe_strip(content.css(".f-comment_like_count::text").get())) or spider.default_rating
+
+    date = spider.parse_reply_date(reply_div)
+    author_name = safe_strip(content.css(".f-user_name::text").get())
+
+    author_ip = spider.parse_ip(content)
+    by_owner = is_by_owner_checker(author_ip) if is_by_owner_checker else None
+
+    reply: Reply = {
+        "id": reply_id,
+        "head_id": head_id,
+        "parent_id": parent_id,
+
+        "is_head": False,
+        "by_owner": by_owner,
+
+        "date": date,
+        "rating": rating,
+        "author_name": author_name,
+        "title": title,
+        "text": text,
+    }
+
+    results.append(reply)
+
+    further_replies_list = reply_li.xpath("./ul/li")
+    if further_replies_list:
+        for further_reply in further_replies_list:
+            res = parse_reply(
+                spider, further_reply, head_id, parent_id=reply_id,
+                is_by_owner_checker=is_by_owner_checker
+            )
+            results.extend(res)
+
+    return results
+
+
+def parse_recursive(spider: RepliesSpider, response: HtmlResponse) -> list:
+    topic_head = spider.parse_head(response)
+    is_by_owner_checker = spider.make_by_owner_checker(topic_head.pop("author_ip"))
+    top_level_replies_list = response.css("div.f-comments_content").css(
+        "ul.topic-comments__items:first-child > li"
+    )
+    all_replies = [topic_head]
+    for top_level_reply in top_level_replies_list:
+        all_replies.extend(parse_reply(
+            spider, top_level_reply, topic_head["id"], is_by_owner_checker=is_by_owner_checker
+        ))
+    return all_replies
+
+
+def best_of(func, repeat: int) -> float:
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("pages", nargs="*", type=Path)
+    parser.add_argument("--synthetic", type=int, default=1000, help="replies in a generated thread")
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    if args.pages:
+        pages = {page.name: page.read_bytes() for page in args.pages}
+    else:
+        pages = {
+            f"flat, {args.synthetic} replies": make_thread_html(args.synthetic, chain=False),
+            f"chain, {args.synthetic} replies": make_thread_html(args.synthetic, chain=True),
+        }
+
+    spider = RepliesSpider()
+    spider.log = lambda *args, **kwargs: None
+    sys.setrecursionlimit(max(sys.getrecursionlimit(), 10 * args.synthetic))
+
+    for name, body in pages.items():
+        response = HtmlResponse(url="https://forum.ykt.ru/viewtopic.jsp?id=1", body=body, encoding="utf-8")
+        # the selector tree is built once and shared, as in the spider
+        response.selector
+        assert parse_recursive(spider, response) == spider.parse_replies(response), name
+
+        recursive = best_of(lambda: parse_recursive(spider, response), args.repeat)
+        iterative = best_of(lambda: spider.parse_replies(response), args.repeat)
+        print(f"{name:<30} recursive {recursive * 1000:9.1f} ms  iterative {iterative * 1000:9.1f} ms"
+              f"  x{recursive / iterative:.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,123 @@
+"""Compare the stdlib/scrapy encoders used so far with `webtexts.serialization`.
+
+    python benchmarks/bench_serialization.py [replies feed] [--repeat N]
+
+The feed is read with `iter_json_records`, its dates are turned back into
+datetimes and every item is then encoded and decoded one by one, as in feed
+export and `iter_json_lines`, both compact and indented as in the spiders'
+feeds. Without a feed at hand, `--synthetic N` makes
+N topics shaped like the replies spider items.
+"""
+import argparse
+from datetime import datetime, timedelta
+import json
+from pathlib import Path
+import random
+import sys
+import time
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+sys.path.insert(0, str(Path(__file__).resolve().parents[2]))
+
+from scrapy.utils.serialize import ScrapyJSONEncoder
+
+from forum_ykt.utils import iter_json_records
+from webtexts import serialization
+
+
+REPLIES_FEED_FILENAME = "./res/pages/webarchive-replies-content-5.json"
+DATE_KEYS = {"date", "topic_last_update", "snapshot_time", "real_timestamp", "forum_query_date", "forum_real_date"}
+
+
+def make_synthetic_topics(n: int, seed: int = 0) -> list:
+    random.seed(seed)
+    words = ["сахалыы", "тыл", "кэпсээн", "форум", "ыйытык", "хоруй", "дьон", "олох"]
+    start = datetime(2012, 1, 1)
+
+    def text() -> list:
+        return [" ".join(random.choices(words, k=random.randint(5, 40))) for _ in range(random.randint(1, 4))]
+
+    topics = []
+    for topic_i in range(n):
+        head_date = start + timedelta(minutes=random.randint(0, 5_000_000))
+        replies = [{
+            "id": topic_i * 1000, "head_id": topic_i * 1000, "parent_id": None,
+            "is_head": True, "by_owner": True, "date": head_date, "rating": random.randint(0, 20),
+            "author_name": random.choice(words), "text": text(),
+        }]
+        for reply_i in range(random.randint(0, 120)):
+            replies.append({
+                "id": topic_i * 1000 + reply_i + 1, "head_id": topic_i * 1000,
+                "parent_id": random.choice([None, topic_i * 1000 + reply_i]),
+                "is_head": False, "by_owner": random.choice([None, False, True]),
+                "date": head_date + timedelta(minutes=reply_i * 7), "rating": random.randint(0, 20),
+                "author_name": random.choice(words), "title": [], "text": text(),
+            })
+        topics.append({
+            "topic_title": " ".join(random.choices(words, k=5)),
+            "topic_url": f"http://web.archive.org/web/20211028024613/https://forum.ykt.ru/viewtopic.jsp?id={topic_i}",
+            "topic_num_messages": len(replies) - 1,
+            "topic_last_update": replies[-1]["date"],
+            "forum_name": "Сахалыы",
+            "forum_id": 149,
+            "replies": replies,
+        })
+    return topics
+
+
+def best_of(func, repeat: int) -> float:
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("feed", nargs="?", default=REPLIES_FEED_FILENAME)
+    parser.add_argument("--synthetic", type=int, default=0, help="topics to generate instead of reading a feed")
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    if args.synthetic or not Path(args.feed).exists():
+        n = args.synthetic or 2000
+        print(f"no feed at {args.feed}, using {n} synthetic topics")
+        items = make_synthetic_topics(n)
+    else:
+        items = [serialization.decode_dates(item, DATE_KEYS) for item in iter_json_records(args.feed)]
+    print(f"{len(items)} items, orjson available: {serialization.ORJSON_AVAILABLE}")
+
+    scrapy_encoder = ScrapyJSONEncoder(ensure_ascii=False)
+    # feeds of the spiders are indented by 4
+    scrapy_indent_encoder = ScrapyJSONEncoder(ensure_ascii=False, indent=4)
+    encoders = {
+        "scrapy feed (ScrapyJSONEncoder)": lambda item: scrapy_encoder.encode(item).encode("utf-8"),
+        "json.dumps(default=str)": lambda item: json.dumps(item, ensure_ascii=False, default=str).encode("utf-8"),
+        "serialization.dumps_bytes": serialization.dumps_bytes,
+        "scrapy feed, indent=4": lambda item: scrapy_indent_encoder.encode(item).encode("utf-8"),
+        "serialization.dumps_bytes(indent=4)": lambda item: serialization.dumps_bytes(item, indent=4),
+    }
+    for name, encode in encoders.items():
+        seconds = best_of(lambda: [encode(item) for item in items], args.repeat)
+        print(f"encode  {name:<35} {seconds * 1000:9.1f} ms")
+
+    lines = [serialization.dumps_bytes(item) for item in items]
+    print(f"{sum(map(len, lines)) / 2 ** 20:.1f} MiB of JSON Lines")
+    decoders = {
+        "json.loads": json.loads,
+        "serialization.loads": serialization.loads,
+        "serialization.loads(date_keys=...)": lambda line: serialization.loads(line, date_keys=DATE_KEYS),
+        "serialization.loads(dates=True)": lambda line: serialization.loads(line, dates=True),
+    }
+    for name, decode in decoders.items():
+        seconds = best_of(lambda: [decode(line) for line in lines], args.repeat)
+        print(f"decode  {name:<35} {seconds * 1000:9.1f} ms")
+
+    assert serialization.loads(lines[0], date_keys=DATE_KEYS) == items[0]
+    assert serialization.loads(serialization.dumps_bytes(items[0], indent=4), date_keys=DATE_KEYS) == items[0]
+
+
+if __name__ == "__main__":
+    main()
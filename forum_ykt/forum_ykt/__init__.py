@@ -0,0 +1,7 @@
+import sys
+from pathlib import Path
+
+# modules shared by the scrapers (`webtexts`) are in the repository root
+REPO_ROOT = str(Path(__file__).resolve().parents[2])
+if REPO_ROOT not in sys.path:
+    sys.path.append(REPO_ROOT)
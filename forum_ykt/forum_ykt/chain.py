@@ -0,0 +1,168 @@
+"""Forums, topics and replies crawled together, each stage fed by the items of the previous one.
+
+    python -m forum_ykt.chain [-a replies.items=replies] [--audit]
+
+Items go through bounded in-process queues instead of the feed files the
+spiders read otherwise. A full queue pauses the crawl that fills it, and a
+downstream spider stays open until its queue is closed and drained.
+"""
+import argparse
+from collections import deque
+import logging
+import typing as T
+
+from scrapy import signals, Request, Spider
+from scrapy.crawler import Crawler, CrawlerProcess
+from scrapy.exceptions import DontCloseSpider
+from scrapy.utils.project import get_project_settings
+
+
+logger = logging.getLogger(__name__)
+
+STAGES = ("forums", "topics", "replies")
+
+
+class StageQueue:
+    """Items scraped by one crawl, waiting to become requests of the next one.
+
+    The upstream engine is paused once `maxsize` items wait and unpaused
+    when half of them are taken. Items of responses already downloading
+    still arrive while paused, so the bound is a soft one.
+    """
+
+    def __init__(self, maxsize: int = 1000) -> None:
+        self.items: T.Deque[T.Dict[str, T.Any]] = deque()
+        self.maxsize = maxsize
+        self.resume_size = maxsize // 2
+
+        self.upstream: T.Optional[Crawler] = None
+        self.downstream: T.Optional[Crawler] = None
+        self.paused = False
+        self.closed = False
+        self.consumer_closed = False
+
+    def connect(self, upstream: Crawler, downstream: Crawler) -> None:
+        self.upstream = upstream
+        self.downstream = downstream
+        upstream.signals.connect(self.item_scraped, signal=signals.item_scraped)
+        upstream.signals.connect(self.upstream_closed, signal=signals.spider_closed)
+        downstream.signals.connect(self.downstream_closed, signal=signals.spider_closed)
+
+    def item_scraped(self, item: T.Dict[str, T.Any]) -> None:
+        if self.consumer_closed:
+            return
+        # downstream spiders add their own fields to what they get
+        self.items.append(dict(item))
+        if not self.paused and len(self.items) >= self.maxsize:
+            logger.info(f"{len(self.items)} items wait, pausing {self.upstream.spider.name}")
+            self.upstream.engine.pause()
+            self.paused = True
+        self.wake_downstream()
+
+    def wake_downstream(self) -> None:
+        # an idle downstream engine would only look at the queue on its next heartbeat
+        slot = getattr(self.downstream.engine, "slot", None)
+        if slot is not None:
+            slot.nextcall.schedule()
+
+    def upstream_closed(self) -> None:
+        self.closed = True
+        self.wake_downstream()
+
+    def downstream_closed(self) -> None:
+        self.consumer_closed = True
+        self.items.clear()
+        self.resume()
+
+    def resume(self) -> None:
+        if self.paused:
+            logger.info(f"{len(self.items)} items wait, unpausing {self.upstream.spider.name}")
+            self.upstream.engine.unpause()
+            self.paused = False
+
+    def get_batch(self, size: int) -> T.List[T.Dict[str, T.Any]]:
+        batch = [self.items.popleft() for _ in range(min(size, len(self.items)))]
+        if len(self.items) <= self.resume_size:
+            self.resume()
+        return batch
+
+    @property
+    def exhausted(self) -> bool:
+        return self.closed and not self.items
+
+
+def fill_scheduler(
+    spider: Spider, queue: StageQueue,
+    make_requests: T.Callable[[T.List[T.Dict[str, T.Any]]], T.Iterable[Request]],
+) -> int:
+    """Crawl requests for the queued items while fewer than a batch of requests wait in the scheduler.
+
+    Called on `request_left_downloader` too, so that downloads go on while
+    the spider is busy, instead of the scheduler draining until it is idle.
+    """
+    engine = spider.crawler.engine
+    batch_size = spider.settings.getint("CHAIN_BATCH_SIZE", 100)
+    scheduled = 0
+    while queue.items and len(engine.slot.scheduler) < batch_size:
+        for request in make_requests(queue.get_batch(batch_size)):
+            engine.crawl(request)
+            scheduled += 1
+    return scheduled
+
+
+def schedule_queued(
+    spider: Spider, queue: StageQueue,
+    make_requests: T.Callable[[T.List[T.Dict[str, T.Any]]], T.Iterable[Request]],
+) -> None:
+    """On `spider_idle`, crawl requests for the queued items, keep the spider open while more can come"""
+    scheduled = fill_scheduler(spider, queue, make_requests)
+    if scheduled or not queue.exhausted:
+        raise DontCloseSpider
+
+
+def parse_stage_args(args: T.Iterable[str]) -> T.Dict[str, T.Dict[str, str]]:
+    """`stage.name=value` arguments by stage"""
+    stage2args: T.Dict[str, T.Dict[str, str]] = {stage: {} for stage in STAGES}
+    for arg in args:
+        name, value = arg.split("=", 1)
+        stage, name = name.split(".", 1)
+        if stage not in stage2args:
+            raise ValueError(f"unknown stage: {stage}")
+        stage2args[stage][name] = value
+    return stage2args
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-a", dest="arg", action="append", default=[], help="spider argument, STAGE.NAME=VALUE")
+    parser.add_argument("-s", dest="set", action="append", default=[], help="setting, NAME=VALUE")
+    parser.add_argument("--audit", action="store_true", help="write feeds of the forums and topics stages too")
+    args = parser.parse_args()
+
+    settings = get_project_settings()
+    for setting in args.set:
+        name, value = setting.split("=", 1)
+        settings.set(name, value, priority="cmdline")
+    stage2args = parse_stage_args(args.arg)
+
+    process = CrawlerProcess(settings)
+    crawlers: T.List[Crawler] = []
+    for i, stage in enumerate(STAGES):
+        stage_settings = settings.copy()
+        if stage != STAGES[-1] and not args.audit:
+            stage_settings.set("FEED_MODE", "none", priority="cmdline")
+        spidercls = process.spider_loader.load(stage)
+        crawlers.append(Crawler(spidercls, stage_settings, init_reactor=(i == 0)))
+
+    for upstream, downstream, stage in zip([None] + crawlers, crawlers, STAGES):
+        kwargs: T.Dict[str, T.Any] = dict(stage2args[stage])
+        if upstream is not None:
+            queue = StageQueue(settings.getint("CHAIN_QUEUE_SIZE", 1000))
+            queue.connect(upstream, downstream)
+            kwargs["input_queue"] = queue
+        process.crawl(downstream, **kwargs)
+    process.start()
+
+
+if __name__ == "__main__":
+    main()
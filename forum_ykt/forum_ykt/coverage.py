@@ -0,0 +1,160 @@
+import typing as T
+from datetime import datetime
+
+
+CaptureGroup = T.Tuple[int, str, int]  # forum_id, forum_style, page
+
+
+class Capture:
+    def __init__(self, url: str, group: CaptureGroup, time: datetime) -> None:
+        self.url = url
+        self.group = group
+        self.time = time
+
+        self.topics: T.Optional[T.Set[str]] = None
+        self.pending = False
+        self.failed = False
+
+    @property
+    def fetched(self) -> bool:
+        return self.topics is not None
+
+
+class CoveragePlanner:
+    """Greedy choice of listing captures that still cover the topic population.
+
+    Captures of the same forum page are ordered by time. The newest and the
+    oldest are fetched first, then every capture lying between two fetched
+    ones is estimated to show `novelty * size * position` unseen topics:
+    `novelty` is 1 minus the Jaccard similarity of the fetched neighbours'
+    topics, `size` their mean topic count and `position` is 1 in the middle
+    of the interval and 0 at its ends. The capture with the largest estimate
+    of every interval is fetched next, and estimates are refined as topics
+    arrive. Captures estimated below `min_gain` are skipped. A group with no
+    fetched capture has no estimate (None), and its captures are fetched first.
+
+    `seen_topics` are topics of earlier crawls: the estimate is scaled down
+    by their share among the topics that differ between the neighbours.
+    """
+
+    def __init__(self, min_gain: float = 1.0, seen_topics: T.Iterable[str] = ()) -> None:
+        self.min_gain = min_gain
+        self.known_topics: T.FrozenSet[str] = frozenset(seen_topics)
+        self.seen_topics: T.Set[str] = set(self.known_topics)
+
+        self.url2capture: T.Dict[str, Capture] = {}
+        self.group2captures: T.Dict[CaptureGroup, T.List[Capture]] = {}
+
+    def add(self, url: str, group: CaptureGroup, time: datetime) -> None:
+        if url in self.url2capture:
+            return
+        capture = self.url2capture[url] = Capture(url, group, time)
+        self.group2captures.setdefault(group, []).append(capture)
+
+    def seeds(self) -> T.List[str]:
+        """Newest and oldest capture of every group"""
+        urls = []
+        for captures in self.group2captures.values():
+            captures.sort(key=lambda capture: capture.time)
+            for capture in {id(c): c for c in (captures[-1], captures[0])}.values():
+                capture.pending = True
+                urls.append(capture.url)
+        return urls
+
+    def observe(self, url: str, topics: T.Iterable[str]) -> int:
+        """Record topics of a fetched capture, return how many were new"""
+        capture = self.url2capture[url]
+        capture.pending = False
+        capture.topics = set(topics)
+
+        new_topics = capture.topics - self.seen_topics
+        self.seen_topics |= new_topics
+        return len(new_topics)
+
+    def observe_failure(self, url: str) -> None:
+        capture = self.url2capture[url]
+        capture.pending = False
+        capture.failed = True
+
+    def estimate(
+        self, capture: Capture, before: T.Optional[Capture], after: T.Optional[Capture]
+    ) -> T.Optional[float]:
+        if before is None or after is None:
+            # nothing is known on one side yet
+            known = before or after
+            return float(len(known.topics - self.known_topics)) if known else None
+
+        union = before.topics | after.topics
+        if not union:
+            return 0.0
+
+        novelty = 1 - len(before.topics & after.topics) / len(union)
+        size = (len(before.topics) + len(after.topics)) / 2
+        changed = before.topics ^ after.topics
+        if changed and self.known_topics:
+            # topics coming and going around the capture were often seen by earlier crawls already
+            novelty *= 1 - len(changed & self.known_topics) / len(changed)
+
+        span = (after.time - before.time).total_seconds()
+        position = (
+            2 * min((capture.time - before.time).total_seconds(),
+                    (after.time - capture.time).total_seconds()) / span
+            if span else 0.0
+        )
+        return novelty * size * position
+
+    def iter_estimates(
+        self
+    ) -> T.Generator[T.Tuple[T.Optional[float], Capture, T.Optional[Capture], T.Optional[Capture]], None, None]:
+        """Estimates of captures not fetched yet, with their fetched neighbours.
+
+        Intervals that already have a pending capture are left out.
+        """
+        for captures in self.group2captures.values():
+            before: T.Optional[Capture] = None
+            interval: T.List[Capture] = []
+            for capture in captures + [None]:
+                if capture is not None and not capture.fetched:
+                    interval.append(capture)
+                    continue
+
+                if not any(c.pending for c in interval):
+                    for candidate in interval:
+                        if not candidate.failed:
+                            yield self.estimate(candidate, before, capture), candidate, before, capture
+
+                before, interval = capture, []
+
+    def next_batch(self, size: int) -> T.List[str]:
+        """Best capture of the intervals with the largest estimated gain"""
+        best_in_interval: T.Dict[T.Tuple[int, int], T.Tuple[float, Capture]] = {}
+        for gain, capture, before, after in self.iter_estimates():
+            if gain is None:
+                # nothing of the group is known, so it goes first
+                gain = float("inf")
+            elif gain < self.min_gain:
+                continue
+            interval = (id(before), id(after)) if before or after else (id(capture), 0)
+            if interval not in best_in_interval or best_in_interval[interval][0] < gain:
+                best_in_interval[interval] = (gain, capture)
+
+        best = sorted(best_in_interval.values(), key=lambda gain_capture: -gain_capture[0])
+        urls = []
+        for _, capture in best[:size]:
+            capture.pending = True
+            urls.append(capture.url)
+        return urls
+
+    def skipped(self) -> T.List[T.Dict[str, T.Any]]:
+        """Captures left out, with the topics estimated to be lost by skipping each (None if unknown)"""
+        return [
+            {
+                "url": capture.url,
+                "forum_id": capture.group[0],
+                "forum_style": capture.group[1],
+                "page": capture.group[2],
+                "snapshot_time": capture.time,
+                "estimated_lost_topics": gain,
+            }
+            for gain, capture, _, _ in self.iter_estimates()
+        ]
@@ -21,6 +21,12 @@ class Snapshot(T.TypedDict):
     timestamp: str
 
 
+class CdxCapture(T.TypedDict):
+    original: str
+    timestamp: str
+    statuscode: str
+
+
 class AuthorMeta(T.TypedDict):
     name: str
 
@@ -70,6 +76,15 @@ class Reply(T.TypedDict):
 TopicItem = T.Union[TopicHead, Reply]
 
 
+class TopicSighting(T.TypedDict):
+    topic_key: str
+    listing_url: str
+    snapshot_time: datetime
+    topic_url: str
+    num_messages: int
+    last_update: T.Optional[datetime]
+
+
 class TopicMetaFull(T.TypedDict):
     title: str
     url: str
@@ -95,6 +110,19 @@ class TopicMetaFull(T.TypedDict):
     replies: T.Optional[T.List[TopicItem]]
 
 
+# items of `-a items=replies`: a header per topic, then every reply on its own
+
+class TopicHeaderItem(TopicMetaFull):
+    item_type: str  # "topic"
+    topic_key: str
+    replies_captures: T.List[str]
+
+
+class ReplyItem(Reply):
+    item_type: str  # "reply"
+    topic_key: str
+
+
 # {
 #     "url": "https://forum.ykt.ru/viewforum.jsp?id=149",
 #     "archived_snapshots": {
@@ -0,0 +1,230 @@
+"""Layouts of forum.ykt.ru listing pages, and where the fields of topic rows are in each.
+
+The layout of a page depends on when it was captured, so the layout found
+on two captures is taken for the captures between them, and only pages
+outside such ranges are probed with every layout.
+"""
+import typing as T
+from bisect import bisect_left, insort
+from collections import Counter
+
+from lxml import etree
+from parsel.csstranslator import HTMLTranslator
+
+from forum_ykt.utils import safe_strip, safe_int
+from forum_ykt.wayback import split_snapshot_url
+
+
+translator = HTMLTranslator()
+
+
+def compile_css(css: str) -> etree.XPath:
+    """XPath of `css` (with parsel's `::text` and `::attr()`) to run on lxml elements"""
+    return etree.XPath(translator.css_to_xpath(css), smart_strings=False)
+
+
+def first(xpath: etree.XPath, el: etree.ElementBase) -> T.Optional[str]:
+    result = xpath(el)
+    return result[0] if result else None
+
+
+# class of the element of a field, and the tag of its descendant holding the value (if not the element itself)
+FieldSpec = T.Tuple[str, T.Optional[str]]
+# title, link, author, number of messages and last update of a topic
+RowFields = T.Tuple[T.Optional[str], T.Optional[str], T.Optional[str], int, T.Optional[str]]
+
+TOPIC_ROWS = compile_css("div.f-topics div.f-topic")
+
+
+def get_text(el: T.Optional[etree.ElementBase]) -> T.Optional[str]:
+    """First text node of `el` itself, as `::text` gets it"""
+    if el is None:
+        return None
+    if el.text is not None:
+        return el.text
+    for child in el:
+        if child.tail is not None:
+            return child.tail
+    return None
+
+
+class ListingLayout:
+    """Where the fields of topic rows and the pagination are in one layout of forum listings
+
+    Fields of a row are found by the classes of their elements in a single
+    pass over the row, the next page link by a compiled selector. A field
+    with a `fallbacks` spec is taken from it when its own element has no text.
+    """
+
+    fields = ("title", "author", "num_messages", "last_update")
+
+    def __init__(
+        self, name: str, marker: T.Tuple[str, str], title: FieldSpec, author: FieldSpec,
+        num_messages: FieldSpec, last_update: FieldSpec, next_page: str,
+        fallbacks: T.Optional[T.Dict[str, FieldSpec]] = None,
+    ) -> None:
+        self.name = name
+        # tag and class of an element that only rows of this layout have
+        self.marker = marker
+        self.field2spec = dict(zip(self.fields, (title, author, num_messages, last_update)))
+        self.field2fallback = {f"{field}_fallback": spec for field, spec in (fallbacks or {}).items()}
+        self.class2field = {
+            class_name: field for field, (class_name, _) in {**self.field2spec, **self.field2fallback}.items()
+        }
+        self.next_page = compile_css(f"{next_page}::attr(href)")
+
+    def matches(self, rows: T.List[etree.ElementBase]) -> bool:
+        if not rows:
+            return False
+        tag, class_name = self.marker
+        return any(class_name in (el.get("class") or "").split() for el in rows[0].iter(tag))
+
+    def find_value(self, field2el: T.Dict[str, etree.ElementBase], field: str) -> T.Optional[etree.ElementBase]:
+        el = field2el.get(field)
+        tag = (self.field2spec.get(field) or self.field2fallback[field])[1]
+        if el is None or tag is None:
+            return el
+        return next(el.iter(tag), None)
+
+    def find_text(self, field2el: T.Dict[str, etree.ElementBase], field: str) -> str:
+        text = safe_strip(get_text(self.find_value(field2el, field)))
+        if not text and f"{field}_fallback" in self.field2fallback:
+            text = safe_strip(get_text(self.find_value(field2el, f"{field}_fallback")))
+        return text
+
+    def parse_row(self, topic: etree.ElementBase) -> RowFields:
+        field2el: T.Dict[str, etree.ElementBase] = {}
+        for el in topic.iter(etree.Element):
+            class_attr = el.get("class")
+            if not class_attr:
+                continue
+            for class_name in class_attr.split():
+                field = self.class2field.get(class_name)
+                if field is not None and field not in field2el:
+                    field2el[field] = el
+
+        title_el = self.find_value(field2el, "title")
+        return (
+            safe_strip(get_text(title_el)),
+            title_el.get("href") if title_el is not None else None,
+            self.find_text(field2el, "author"),
+            safe_int(self.find_text(field2el, "num_messages")) or 0,
+            self.find_text(field2el, "last_update"),
+        )
+
+    def get_next_page(self, root: etree.ElementBase) -> T.Optional[str]:
+        return first(self.next_page, root)
+
+
+# newest first, as most captures are recent
+LISTING_LAYOUTS = (
+    ListingLayout(
+        "2021",
+        marker=("div", "f-topic_title"),
+        title=("f-topic_title", "a"),
+        author=("f-topic_author", None),
+        num_messages=("f-topic_replies", None),
+        last_update=("f-topic_update", "span"),
+        next_page="div#paging ul li.yui-pagination_page--active + li a",
+        # some captures have the name in an element of its own, as in 2014
+        fallbacks={"author": ("f-topic_author_name", None)},
+    ),
+    ListingLayout(
+        "2014",
+        marker=("a", "f-topic_title"),
+        title=("f-topic_title", None),
+        author=("f-topic_author_name", None),
+        num_messages=("f-topic_footer_comments", None),
+        last_update=("f-topic_footer_update", None),
+        next_page="div#paging b + a",
+    ),
+)
+UNKNOWN_LAYOUT = "unknown"
+
+
+class LayoutRegistry:
+    """Layout of every listing capture, probed for only outside the time ranges known so far
+
+    Rows of a known layout are still checked for its marker, and are
+    probed with every layout if it is missing.
+    """
+
+    def __init__(self, layouts: T.Sequence[ListingLayout] = LISTING_LAYOUTS) -> None:
+        self.layouts = layouts
+        self.name2layout = {layout.name: layout for layout in layouts}
+        # (14-digit capture timestamp, layout name) of the probed captures
+        self.observed: T.List[T.Tuple[str, str]] = []
+
+        self.probed = 0
+        self.cached = 0
+        self.name2pages: T.Counter[str] = Counter()
+        self.name2seconds: T.Dict[str, float] = {}
+
+    @staticmethod
+    def get_timestamp(url: str) -> T.Optional[str]:
+        split = split_snapshot_url(url)
+        return split[0].ljust(14, "0") if split else None
+
+    def cached_layout(self, timestamp: str) -> T.Optional[ListingLayout]:
+        """Layout of the probed captures on both sides of `timestamp`, if it is the same"""
+        i = bisect_left(self.observed, (timestamp,))
+        if i < len(self.observed) and self.observed[i][0] == timestamp:
+            return self.name2layout[self.observed[i][1]]
+        if 0 < i < len(self.observed) and self.observed[i - 1][1] == self.observed[i][1]:
+            return self.name2layout[self.observed[i][1]]
+        return None
+
+    @staticmethod
+    def find_rows(root: etree.ElementBase) -> T.List[etree.ElementBase]:
+        return TOPIC_ROWS(root)
+
+    def detect(self, rows: T.List[etree.ElementBase]) -> T.Optional[ListingLayout]:
+        self.probed += 1
+        for layout in self.layouts:
+            if layout.matches(rows):
+                return layout
+        return None
+
+    def get(self, rows: T.List[etree.ElementBase], url: str) -> T.Optional[ListingLayout]:
+        """Layout of the topic `rows` of the page at snapshot `url`, None if no layout matches"""
+        timestamp = self.get_timestamp(url)
+        layout = self.cached_layout(timestamp) if timestamp else None
+        if layout is not None and layout.matches(rows):
+            self.cached += 1
+            return layout
+
+        layout = self.detect(rows)
+        if layout is not None and timestamp:
+            insort(self.observed, (timestamp, layout.name))
+        return layout
+
+    def record(self, layout: T.Optional[ListingLayout], seconds: float) -> None:
+        """A page of `layout` was parsed in `seconds`"""
+        name = layout.name if layout is not None else UNKNOWN_LAYOUT
+        self.name2pages[name] += 1
+        self.name2seconds[name] = self.name2seconds.get(name, 0.0) + seconds
+
+    def get_ranges(self) -> T.Dict[str, T.List[T.Tuple[str, str]]]:
+        """First and last probed capture of every run of captures of the same layout"""
+        name2ranges: T.Dict[str, T.List[T.Tuple[str, str]]] = {}
+        for i, (timestamp, name) in enumerate(self.observed):
+            if i and self.observed[i - 1][1] == name:
+                ranges = name2ranges[name]
+                ranges[-1] = (ranges[-1][0], timestamp)
+            else:
+                name2ranges.setdefault(name, []).append((timestamp, timestamp))
+        return name2ranges
+
+    def report(self) -> T.List[T.Dict[str, T.Any]]:
+        """Pages, parse time and capture ranges of every layout seen, most pages first"""
+        name2ranges = self.get_ranges()
+        return [
+            {
+                "layout": name,
+                "pages": pages,
+                "seconds": round(self.name2seconds[name], 3),
+                "ms_per_page": round(1000 * self.name2seconds[name] / pages, 3),
+                "ranges": name2ranges.get(name, []),
+            }
+            for name, pages in self.name2pages.most_common()
+        ]
@@ -8,6 +8,8 @@ from datetime import datetime
 # useful for handling different item types with a single interface
 from itemadapter import ItemAdapter
 
+from forum_ykt.utils import months, ru_month_to_int
+
 
 class ForumYktPipeline:
     def process_item(self, item, spider):
@@ -15,24 +17,11 @@ class ForumYktPipeline:
 
 
 class RuDatePipeline:
-    months = {
-        "янв": 1,
-        "фев": 2,
-        "мар": 3,
-        "апр": 4,
-        "мая": 5,
-        "июн": 6,
-        "июл": 7,
-        "авг": 8,
-        "сен": 9,
-        "окт": 10,
-        "ноя": 11,
-        "дек": 12,
-    }
+    months = months
 
     @classmethod
     def convert_month(cls, month: str) -> int:
-        return cls.months[month[:3].lower()]
+        return ru_month_to_int(month)
     
     @classmethod
     def parse_date(cls, timestamp: str, sep=" ") -> datetime:
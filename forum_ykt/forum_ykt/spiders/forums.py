@@ -9,11 +9,23 @@ import scrapy.crawler
 from scrapy.spiders import CrawlSpider
 from scrapy import signals
 
-from forum_ykt.items import WebArchiveMetaItem
+from forum_ykt.items import WebArchiveMetaItem, Snapshot, CdxCapture
 from forum_ykt.utils import (
     to_webarchive_date,
     convert_snapshot_timestamp,
     encode_url,
+    in_shard,
+)
+from webtexts.retry import DeferredRetry
+from webtexts.feeds import update_feed_settings
+from webtexts import serialization
+from forum_ykt.storage import SnapshotIndex, ForumStylePage
+from forum_ykt.wayback import (
+    CaptureTimeline,
+    make_cdx_url,
+    make_snapshot_url,
+    iter_cdx_lines,
+    get_query_int,
 )
 
 LATEST_DATE = datetime(2021, 10, 31)
@@ -22,6 +34,8 @@ MIN_DATE = datetime(2010, 1, 1)
 YEAR_DAYS = 365
 SNAPSHOTS_PER_YEAR = 12
 DATE_DELTA = timedelta(days=YEAR_DAYS // SNAPSHOTS_PER_YEAR)
+# every n-th date is sampled first by `dates=bisect`
+COARSE_DATES_STEP = SNAPSHOTS_PER_YEAR
 
 latest_date_str = LATEST_DATE.strftime("%Y%m%d")
 
@@ -61,6 +75,13 @@ PAGE_FROM = 1
 PAGE_TO = 500
 PAGES_RANGE = range(PAGE_FROM, PAGE_TO)
 
+# a probed page exists at a date if its closest snapshot is that near it
+PROBE_TOLERANCE = DATE_DELTA
+# archives have gaps, so a page is missing only if as many pages from it are
+PROBE_MISSES = 3
+# failed probes are asked again that many times, and taken as missing then
+PROBE_RETRIES = 2
+
 
 
 class ForumMeta(T.TypedDict):
@@ -82,13 +103,62 @@ ForumStylePageAtTime = T.Tuple[int, str, int, datetime]
 
 def json_dumps_tuple_keys(mapping: T.Dict[DictKeysWithTuple, T.Any]):
     # https://stackoverflow.com/a/69550057
-    string_keys = {json.dumps(k): v for k, v in mapping.items()}
-    return json.dumps(string_keys, default=str)
+    string_keys = {serialization.dumps(k): v for k, v in mapping.items()}
+    return serialization.dumps(string_keys)
 
 def json_loads_tuple_keys(string: str) -> T.Dict[DictKeysWithTuple, T.Any]:
     # https://stackoverflow.com/a/69550057
-    mapping = json.loads(string)
-    return {tuple(json.loads(k)): v for k, v in mapping.items()}
+    mapping = serialization.loads(string)
+    return {tuple(serialization.loads(k)): v for k, v in mapping.items()}
+
+
+class PageProbe:
+    """Finds the last existing page by galloping up from `start_page` and then bisecting
+
+    A missing page counts as such only when the `misses - 1` pages after it
+    are missing too, so that gaps in the archive don't end the search.
+    """
+
+    def __init__(
+        self, start_page: int = PAGE_FROM, max_page: int = PAGE_TO - 1, misses: int = PROBE_MISSES
+    ) -> None:
+        self.max_page = max_page
+        self.misses = misses
+        self.last_found = PAGE_FROM - 1
+        self.first_missing: T.Optional[int] = None
+        # first page of the run of missing pages being checked
+        self.run_start: T.Optional[int] = None
+        self.step = 1
+        self.page: T.Optional[int] = min(max(start_page, PAGE_FROM), max_page)
+
+    @property
+    def done(self) -> bool:
+        return self.page is None
+
+    def update(self, exists: bool) -> None:
+        if exists:
+            self.last_found = self.page
+            self.run_start = None
+        else:
+            if self.run_start is None:
+                self.run_start = self.page
+            next_page = self.page + 1
+            if (
+                next_page - self.run_start < self.misses and next_page <= self.max_page
+                and (self.first_missing is None or next_page < self.first_missing)
+            ):
+                self.page = next_page
+                return
+            self.first_missing = self.run_start
+            self.run_start = None
+
+        if self.first_missing is None:
+            next_page = min(self.last_found + self.step, self.max_page)
+            self.step *= 2
+        else:
+            next_page = (self.last_found + self.first_missing) // 2
+
+        self.page = next_page if next_page > self.last_found else None
 
 
 class ForumsSpider(scrapy.Spider):
@@ -100,9 +170,11 @@ class ForumsSpider(scrapy.Spider):
         f"./res/webarchive-forums-meta-by_forum_style_date-4.json": {
             "format": "json",
             "indent": 4,
+            # a resumed crawl yields the answers of earlier ones again
+            "overwrite": True,
         }
     }
-    out_forum_page_time2snapshot_times = "./res/_forum_page_time2snapshots.json"
+    snapshot_index_path = "./res/forums-snapshot-index.sqlite"
 
     # handle_http_status_list = [404]
 
@@ -112,19 +184,14 @@ class ForumsSpider(scrapy.Spider):
         crawler.signals.connect(spider.engine_stopped, signal=signals.engine_stopped)
         return spider
 
-    @staticmethod
-    def sort_dict(d: T.Dict):
-        return {key: val for key, val in sorted(d.items(), key=lambda k_v: (k_v[0][1], k_v[0][2]))}
-
     def engine_stopped(self):
-        json_s = json_dumps_tuple_keys(self.sort_dict(self.forum_page_time2snapshot_times))
-        with open(self.out_forum_page_time2snapshot_times, "w", encoding="utf-8") as f:
-            f.write(json_s)
+        if hasattr(self, "snapshot_index"):
+            self.snapshot_index.close()
 
     @classmethod
     def update_settings(cls, settings):
         super().update_settings(settings)
-        settings.setdefault("FEEDS", {}).update(cls.custom_feed)
+        update_feed_settings(settings, cls.custom_feed)
 
     def generate_dates(self) -> T.Generator[datetime, None, None]:
         date = LATEST_DATE
@@ -133,73 +200,459 @@ class ForumsSpider(scrapy.Spider):
             
             date -= DATE_DELTA
 
+    @staticmethod
+    def make_source(
+        date: datetime, forum_name: str, forum_id: int,
+        forum_link_pattern_name: str, forum_link_pattern: str, page: int
+    ) -> Source:
+        timestamp = to_webarchive_date(date)
+        forum_link = forum_link_pattern.format(forum_id)
+
+        forum_page_url = f"{forum_link}&page={page}"
+        encoded_url = encode_url(forum_page_url)
+
+        url = f"{ARCHIVE_LINK}url={encoded_url}&timestamp={timestamp}"
+        return {
+            "orig_url": url,
+            "meta": {
+                "forum_name": forum_name,
+                "forum_style": forum_link_pattern_name,
+                "forum_id": forum_id,
+                "page": page,
+                "query_date": date,
+                "orig_url": forum_page_url,
+            }
+        }
+
+    def iter_forum_styles(self) -> T.Generator[T.Tuple[str, int, str, str], None, None]:
+        """Forums and url styles of this process, by `SHARD_INDEX` of `SHARD_COUNT` (see run_shards.py)"""
+        shard_index = self.settings.getint("SHARD_INDEX", 0)
+        shard_count = self.settings.getint("SHARD_COUNT", 1)
+        for forum_name, forum_id in FORUM2ID.items():
+            for forum_link_pattern_name, forum_link_pattern in FORUM_LINK_PATTERNS.items():
+                # all pages and dates of a forum and style go to the same shard, as probes and chains follow them
+                if in_shard(f"{forum_id}/{forum_link_pattern_name}", shard_index, shard_count):
+                    yield forum_name, forum_id, forum_link_pattern_name, forum_link_pattern
+
     def make_links(self) -> T.Generator[Source, None, None]:
+        forum_styles = list(self.iter_forum_styles())
         for date in self.generate_dates():
-            for forum_name, forum_id in FORUM2ID.items():
-                for forum_link_pattern_name, forum_link_pattern in FORUM_LINK_PATTERNS.items():
-                    for page in PAGES_RANGE:                
-                        timestamp = to_webarchive_date(date)
-                        forum_link = forum_link_pattern.format(forum_id)
-
-                        forum_page_url = f"{forum_link}&page={page}"
-                        encoded_url = encode_url(forum_page_url)
-
-                        url = f"{ARCHIVE_LINK}url={encoded_url}&timestamp={timestamp}"
-                        data = {
-                            "orig_url": url,
-                            "meta": {
-                                "forum_name": forum_name,
-                                "forum_style": forum_link_pattern_name,
-                                "forum_id": forum_id,
-                                "page": page,
-                                "query_date": date,
-                                "orig_url": forum_page_url,
-                            }
-                        }
-
-                        yield data
+            for forum_name, forum_id, forum_link_pattern_name, forum_link_pattern in forum_styles:
+                for page in PAGES_RANGE:
+                    yield self.make_source(
+                        date, forum_name, forum_id,
+                        forum_link_pattern_name, forum_link_pattern, page
+                    )
 
     @staticmethod
-    def make_key_from_meta(meta: ForumMeta):
+    def make_key_from_meta(meta: ForumMeta) -> ForumStylePage:
         return (meta["forum_id"], meta["forum_style"], meta["page"])
 
 
+    def should_skip(self, meta: ForumMeta) -> bool:
+        key = self.make_key_from_meta(meta)
+        times = self.forum_page_time2snapshot_times.get(key)
+
+        self.log(f"key: {key}, snapshots: {times}")
+
+        if times and times[-1] is None:
+            # previous queried date returned nothing
+            #   webarchive will give nothing too
+            self.log(f"skipping url with timestamp {meta['query_date']} "
+                     f"(previous query of same link returned nothing) "
+                     f"(url <{meta['orig_url']}>)")
+            return True
+        if times and times[-1] <= meta["query_date"]:
+            # queried date is newer than last closest snapshot,
+            #   webarchive will give the same one.
+            #   this optimizes both dates and forum_styles 
+            self.log(f"skipping url with timestamp {meta['query_date']} "
+                     f"(it is >= last closest snapshot {times[-1]}) "
+                     f"(url <{meta['orig_url']}>)")
+            return True
+
+        return False
+
     def start_requests(self) -> T.Iterable[scrapy.Request]:
+        # answers are written to the index as they arrive, and the index is read
+        #  back on a restart, so that known queries are answered without requests
+        self.snapshot_index = SnapshotIndex(getattr(self, "index", self.snapshot_index_path))
+
         # we go from newest to oldest, thus times are naturally sorted from newest to oldest too
+        #  (chained keys are dropped once their dates are done)
         self.forum_page_time2snapshot_times: T.Dict[
-            ForumStylePageAtTime, T.List[T.Optional[datetime]]
+            ForumStylePage, T.List[T.Optional[datetime]]
+        ] = {}
+        self.key2sources: T.Dict[ForumStylePage, T.Iterator[Source]] = {}
+        self.key2known_answers: T.Dict[
+            ForumStylePage, T.Dict[datetime, T.Optional[Snapshot]]
+        ] = {}
+        self.key2probe_answers: T.Dict[
+            ForumStylePage, T.Dict[datetime, T.Optional[Snapshot]]
         ] = {}
 
+        discovery = getattr(self, "discovery", "available")
+        if discovery == "cdx":
+            yield from self.start_cdx_requests()
+        elif discovery == "available":
+            yield from self.start_available_requests()
+        else:
+            raise ValueError(f"unknown discovery mode: {discovery}")
+
+    def start_available_requests(self) -> T.Iterable[scrapy.Request]:
+        schedule = getattr(self, "schedule", "chained")
+        pages = getattr(self, "pages", "range")
+        self.dates_sampling = getattr(self, "dates", "grid")
+        if self.dates_sampling not in ("grid", "bisect"):
+            raise ValueError(f"unknown dates sampling: {self.dates_sampling}")
+        if self.dates_sampling == "bisect" and (schedule != "chained" and pages != "probe"):
+            raise ValueError("bisect dates sampling needs the chained schedule")
+        if pages == "probe":
+            yield from self.start_probe_requests()
+        elif pages != "range":
+            raise ValueError(f"unknown pages mode: {pages}")
+        elif schedule == "chained":
+            yield from self.start_chained_requests()
+        elif schedule == "batch":
+            yield from self.start_batch_requests()
+        else:
+            raise ValueError(f"unknown schedule: {schedule}")
+
+    def start_batch_requests(self) -> T.Iterable[scrapy.Request]:
         for source in self.make_links():
             meta = source["meta"]
             # self.checked.add()
 
-            key = self.make_key_from_meta(meta)
-            times = self.forum_page_time2snapshot_times.get(key)
-
-            self.log(f"key: {key}, snapshots: {times}")
-
             # setup requires that queries for date be emitted with great interval
             #  (> CONCURRENT_REQUESTS), because links are consumed in batches
+            if self.should_skip(meta):
+                continue
+
+            yield scrapy.Request(url=source["orig_url"], callback=self.parse, cb_kwargs=meta)
 
-            if times and times[-1] is None:
-                # previous queried date returned nothing
-                #   webarchive will give nothing too
-                self.log(f"skipping url with timestamp {meta['query_date']} "
-                         f"(previous query of same link returned nothing) "
-                         f"(url <{meta['orig_url']}>)")
+    def make_key_sources(
+        self
+    ) -> T.Generator[T.Tuple[ForumStylePage, T.Iterator[Source]], None, None]:
+        for forum_name, forum_id, forum_link_pattern_name, forum_link_pattern in self.iter_forum_styles():
+            for page in PAGES_RANGE:
+                key = (forum_id, forum_link_pattern_name, page)
+                sources = self.make_chain_sources(
+                    forum_name, forum_id, forum_link_pattern_name, forum_link_pattern, page
+                )
+                yield key, sources
+
+    def make_dates_sources(
+        self, forum_name: str, forum_id: int,
+        forum_link_pattern_name: str, forum_link_pattern: str, page: int,
+        dates: T.Optional[T.Iterable[datetime]] = None,
+    ) -> T.Generator[Source, None, None]:
+        for date in dates if dates is not None else self.generate_dates():
+            yield self.make_source(
+                date, forum_name, forum_id, forum_link_pattern_name, forum_link_pattern, page
+            )
+
+    def make_chain_sources(
+        self, forum_name: str, forum_id: int,
+        forum_link_pattern_name: str, forum_link_pattern: str, page: int,
+        dates: T.Optional[T.Iterable[datetime]] = None,
+    ) -> T.Iterator[Source]:
+        sources = self.make_dates_sources(
+            forum_name, forum_id, forum_link_pattern_name, forum_link_pattern, page, dates=dates
+        )
+        if self.dates_sampling == "bisect":
+            return self.bisect_sources((forum_id, forum_link_pattern_name, page), list(sources))
+
+        # lazy, so that every source is checked against the answers known by then
+        return (source for source in sources if not self.should_skip(source["meta"]))
+
+    def bisect_sources(
+        self, key: ForumStylePage, sources: T.List[Source]
+    ) -> T.Generator[Source, None, None]:
+        """Sample dates coarsely, then bisect only where the closest snapshot changes.
+
+        The closest snapshot is monotone in the query date, so equal answers at
+        both ends of an interval hold for every date inside it, and the distinct
+        snapshots are the same as querying every date of `sources`.
+        Each source is yielded only after the answer to the previous one arrived.
+        """
+        if not sources:
+            return
+
+        index2answer: T.Dict[int, T.Optional[datetime]] = {}
+        failed: T.Set[int] = set()
+
+        def sample(i: int) -> T.Generator[Source, None, None]:
+            # the chain appends the answer of the yielded source, errors append nothing
+            times = self.forum_page_time2snapshot_times.setdefault(key, [])
+            num_answers = len(times)
+            yield sources[i]
+            if len(times) > num_answers:
+                index2answer[i] = times[-1]
+            else:
+                failed.add(i)
+
+        last = len(sources) - 1
+        coarse = sorted({*range(0, last, COARSE_DATES_STEP), last})
+        newest_known = None
+        for i in coarse:
+            date = sources[i]["meta"]["query_date"]
+            if newest_known is not None and (
+                index2answer[newest_known] is None or index2answer[newest_known] <= date
+            ):
+                # same rule as `should_skip`
+                index2answer[i] = index2answer[newest_known]
                 continue
-            if times and times[-1] <= meta["query_date"]:
-                # queried date is newer than last closest snapshot,
-                #   webarchive will give the same one.
-                #   this optimizes both dates and forum_styles 
-                self.log(f"skipping url with timestamp {meta['query_date']} "
-                         f"(it is >= last closest snapshot {times[-1]}) "
-                         f"(url <{meta['orig_url']}>)")
+
+            yield from sample(i)
+            if i in index2answer:
+                newest_known = i
+
+        known = [i for i in coarse if i in index2answer]
+        intervals = list(zip(known, known[1:]))
+        while intervals:
+            newer, older = intervals.pop()
+            newer_answer, older_answer = index2answer[newer], index2answer[older]
+            if newer_answer == older_answer:
                 continue
 
-            yield scrapy.Request(url=source["orig_url"], callback=self.parse, cb_kwargs=meta)
+            candidates = [i for i in range(newer + 1, older) if i not in failed]
+            if not candidates:
+                continue
+            middle = min(candidates, key=lambda i: abs(i - (newer + older) // 2))
+            middle_date = sources[middle]["meta"]["query_date"]
+
+            # dates between a query date and its closest snapshot share that snapshot
+            if newer_answer is not None and newer_answer <= middle_date:
+                index2answer[middle] = newer_answer
+            elif older_answer is not None and older_answer >= middle_date:
+                index2answer[middle] = older_answer
+            else:
+                yield from sample(middle)
+
+            if middle in index2answer:
+                intervals.extend([(middle, older), (newer, middle)])
+            else:
+                intervals.append((newer, older))
+
+    def start_chained_requests(self) -> T.Iterable[scrapy.Request]:
+        """Query dates of a key one at a time, each after the previous answer arrived.
+
+        Different keys are still queried concurrently, but skipping no longer
+        depends on how far apart same-key requests are emitted.
+        """
+        for key, sources in self.make_key_sources():
+            self.key2sources[key] = sources
+            yield from self.continue_chain(key)
+
+    def continue_chain(
+        self, key: ForumStylePage
+    ) -> T.Generator[T.Union[WebArchiveMetaItem, scrapy.Request], None, None]:
+        """Yield the next request of the key, answering known dates locally"""
+        sources = self.key2sources.get(key)
+        if sources is None:
+            return
+
+        probe_answers = self.key2probe_answers.get(key, {})
+        known_answers = self.get_known_answers(key)
+        for source in sources:
+            meta = source["meta"]
+            date = meta["query_date"]
+            if date in probe_answers:
+                yield self.add_snapshot(meta, probe_answers.pop(date))
+                continue
+            if date in known_answers:
+                # answered by an earlier crawl, its record is in the index already,
+                #  but the feed of this crawl must have it too
+                yield self.add_snapshot(meta, known_answers.pop(date), record=False)
+                continue
 
+            yield scrapy.Request(
+                url=source["orig_url"], callback=self.parse,
+                errback=self.on_chained_error, cb_kwargs=meta
+            )
+            return
+
+        del self.key2sources[key]
+        self.key2probe_answers.pop(key, None)
+        self.key2known_answers.pop(key, None)
+        self.forum_page_time2snapshot_times.pop(key, None)
+
+    def get_known_answers(self, key: ForumStylePage) -> T.Dict[datetime, T.Optional[Snapshot]]:
+        if key not in self.key2known_answers:
+            self.key2known_answers[key] = self.snapshot_index.answers(key)
+        return self.key2known_answers[key]
+
+    def on_chained_error(self, failure) -> T.Generator[WebArchiveMetaItem, None, None]:
+        meta: ForumMeta = failure.request.cb_kwargs
+        if failure.check(DeferredRetry):
+            # the chain goes on once the deferred request is answered
+            return
+        self.logger.warning(f"query of {meta['orig_url']} at {meta['query_date']} "
+                            f"failed: {failure.value!r}")
+
+        yield from self.continue_chain(self.make_key_from_meta(meta))
+
+    def start_probe_requests(self) -> T.Iterable[scrapy.Request]:
+        """Find the last archived page of every forum, style and date first.
+
+        Pages are probed by galloping and then bisecting, and the chains of
+        `start_chained_requests` are planned only up to the found page.
+        A page exists at a date if its closest snapshot is within
+        `PROBE_TOLERANCE` of it, and failed probes are asked again.
+        Dates of a forum and style are probed newest to oldest, each starting
+        from the last page of the previous date, which usually costs 2 queries.
+        Probe answers are kept and reused by the chains.
+        """
+        self.probes: T.Dict[T.Tuple[int, str], PageProbe] = {}
+        self.forum_style2dates: T.Dict[T.Tuple[int, str], T.Iterator[datetime]] = {}
+        self.forum_style2date_last_page: T.Dict[T.Tuple[int, str], T.Dict[datetime, int]] = {}
+
+        for forum_name, forum_id, forum_link_pattern_name, _ in self.iter_forum_styles():
+            forum_style = (forum_id, forum_link_pattern_name)
+            self.forum_style2dates[forum_style] = self.generate_dates()
+            self.forum_style2date_last_page[forum_style] = {}
+
+            yield from self.start_next_probe(forum_name, forum_id, forum_link_pattern_name)
+
+    def start_next_probe(
+        self, forum_name: str, forum_id: int, forum_style: str, start_page: int = PAGE_FROM
+    ) -> T.Generator[T.Union[WebArchiveMetaItem, scrapy.Request], None, None]:
+        date = next(self.forum_style2dates[(forum_id, forum_style)], None)
+        if date is None:
+            del self.forum_style2dates[(forum_id, forum_style)]
+            yield from self.start_probed_chains(forum_name, forum_id, forum_style)
+            return
+
+        probe = PageProbe(start_page)
+        self.probes[(forum_id, forum_style)] = probe
+        yield from self.continue_probe(date, forum_name, forum_id, forum_style)
+
+    def continue_probe(
+        self, date: datetime, forum_name: str, forum_id: int, forum_style: str
+    ) -> T.Generator[T.Union[WebArchiveMetaItem, scrapy.Request], None, None]:
+        """Request the next probed page, advancing through already known answers"""
+        probe = self.probes[(forum_id, forum_style)]
+        while not probe.done:
+            key = (forum_id, forum_style, probe.page)
+            known_answers = {**self.get_known_answers(key), **self.key2probe_answers.get(key, {})}
+            if date not in known_answers:
+                yield self.make_probe_request(date, forum_name, forum_id, forum_style, probe.page)
+                return
+            probe.update(exists=self.exists_at(known_answers[date], date))
+
+        del self.probes[(forum_id, forum_style)]
+        self.forum_style2date_last_page[(forum_id, forum_style)][date] = probe.last_found
+
+        yield from self.start_next_probe(
+            forum_name, forum_id, forum_style, start_page=probe.last_found
+        )
+
+    def make_probe_request(
+        self, date: datetime, forum_name: str, forum_id: int, forum_style: str, page: int,
+        errors: int = 0,
+    ) -> scrapy.Request:
+        source = self.make_source(
+            date, forum_name, forum_id, forum_style, FORUM_LINK_PATTERNS[forum_style], page
+        )
+        return scrapy.Request(
+            url=source["orig_url"], callback=self.parse_probe,
+            errback=self.on_probe_error, cb_kwargs=source["meta"],
+            meta={"probe_errors": errors}, dont_filter=errors > 0,
+        )
+
+    @staticmethod
+    def exists_at(snapshot: T.Optional[Snapshot], date: datetime) -> bool:
+        """Whether the page was archived near `date`, not just at some time"""
+        if not snapshot:
+            return False
+        return abs(convert_snapshot_timestamp(snapshot["timestamp"]) - date) <= PROBE_TOLERANCE
+
+    def parse_probe(
+        self, response: scrapy.http.Response, **meta
+    ) -> T.Generator[T.Union[WebArchiveMetaItem, scrapy.Request], None, None]:
+        web_archive_res = json.loads(response.body)
+        snapshot = (web_archive_res["archived_snapshots"] or {}).get("closest")
+
+        key = self.make_key_from_meta(meta)
+        # load answers of earlier crawls before this one is written to the index
+        self.get_known_answers(key)
+        self.key2probe_answers.setdefault(key, {})[meta["query_date"]] = snapshot
+        self.snapshot_index.record(self.update_meta(dict(meta), snapshot and dict(snapshot)))
+
+        yield from self.advance_probe(meta, exists=self.exists_at(snapshot, meta["query_date"]))
+
+    def on_probe_error(
+        self, failure
+    ) -> T.Generator[T.Union[WebArchiveMetaItem, scrapy.Request], None, None]:
+        meta: ForumMeta = failure.request.cb_kwargs
+        if failure.check(DeferredRetry):
+            return
+
+        # nothing is known of the page, so it is asked again
+        errors = failure.request.meta.get("probe_errors", 0) + 1
+        if errors <= PROBE_RETRIES:
+            self.logger.warning(f"probe of {meta['orig_url']} at {meta['query_date']} "
+                                f"failed, probing again: {failure.value!r}")
+            yield self.make_probe_request(
+                meta["query_date"], meta["forum_name"], meta["forum_id"], meta["forum_style"],
+                meta["page"], errors=errors,
+            )
+            return
+
+        self.logger.warning(f"probe of {meta['orig_url']} at {meta['query_date']} "
+                            f"failed {errors} times, taking the page as missing: {failure.value!r}")
+        yield from self.advance_probe(meta, exists=False)
+
+    def advance_probe(
+        self, meta: ForumMeta, exists: bool
+    ) -> T.Generator[T.Union[WebArchiveMetaItem, scrapy.Request], None, None]:
+        forum_id, forum_style = meta["forum_id"], meta["forum_style"]
+        self.probes[(forum_id, forum_style)].update(exists)
+
+        yield from self.continue_probe(
+            meta["query_date"], meta["forum_name"], forum_id, forum_style
+        )
+
+    def start_probed_chains(
+        self, forum_name: str, forum_id: int, forum_style: str
+    ) -> T.Generator[T.Union[WebArchiveMetaItem, scrapy.Request], None, None]:
+        date2last_page = self.forum_style2date_last_page.pop((forum_id, forum_style))
+        max_page = max(date2last_page.values(), default=0)
+        self.log(f"{forum_name} ({forum_style}): last page is {max_page} at most, "
+                 f"planning {sum(date2last_page.values())} page queries")
+
+        for page in range(PAGE_FROM, max_page + 1):
+            key = (forum_id, forum_style, page)
+            dates = [date for date in self.generate_dates() if date2last_page[date] >= page]
+            self.key2sources[key] = self.make_chain_sources(
+                forum_name, forum_id, forum_style, FORUM_LINK_PATTERNS[forum_style], page,
+                dates=dates,
+            )
+            yield from self.continue_chain(key)
+
+        # answers of probes past the last page are not needed by any chain
+        for key in [key for key in self.key2known_answers
+                    if key[:2] == (forum_id, forum_style) and key[2] > max_page]:
+            self.key2probe_answers.pop(key, None)
+            del self.key2known_answers[key]
+
+    def start_cdx_requests(self) -> T.Iterable[scrapy.Request]:
+        """One CDX query per forum and url style, covering all its pages"""
+        self.forum_style2captures: T.Dict[T.Tuple[int, str], T.List[CdxCapture]] = {}
+
+        for forum_name, forum_id, forum_link_pattern_name, forum_link_pattern in self.iter_forum_styles():
+            url_prefix = f"{forum_link_pattern.format(forum_id)}&page="
+            self.forum_style2captures[(forum_id, forum_link_pattern_name)] = []
+
+            yield scrapy.Request(
+                url=make_cdx_url(url_prefix), callback=self.parse_cdx,
+                cb_kwargs={
+                    "forum_name": forum_name,
+                    "forum_style": forum_link_pattern_name,
+                    "forum_id": forum_id,
+                    "url_prefix": url_prefix,
+                }
+            )
 
     # def start_requests(self):
     #     sources: T.List[Source] = []
@@ -218,6 +671,29 @@ class ForumsSpider(scrapy.Spider):
     #     for source in sources:
     #         yield scrapy.Request(url=source["url"], callback=self.parse, cb_kwargs=source["meta"])
 
+    @staticmethod
+    def update_meta(meta: ForumMeta, snapshot: T.Optional[Snapshot]) -> WebArchiveMetaItem:
+        if snapshot:
+            snapshot["real_date"] = convert_snapshot_timestamp(snapshot["timestamp"])
+            meta.update(snapshot)
+        else:
+            meta["available"] = False
+
+        return meta
+
+    def add_snapshot(
+        self, meta: ForumMeta, snapshot: T.Optional[Snapshot], record: bool = True
+    ) -> WebArchiveMetaItem:
+        meta = self.update_meta(meta, snapshot)
+        if record:
+            self.snapshot_index.record(meta)
+
+        key = self.make_key_from_meta(meta)
+        real_date = meta["real_date"] if snapshot else None
+        self.forum_page_time2snapshot_times.setdefault(key, []).append(real_date)
+
+        return meta
+
     def parse(
         self, response: scrapy.http.Response, **meta
     )-> T.Generator[WebArchiveMetaItem, None, None]:
@@ -226,17 +702,73 @@ class ForumsSpider(scrapy.Spider):
         # web_archive_res: WebArchiveMetaItem = json.loads(response.body)
         # web_archive_res.update(meta)
         web_archive_res = json.loads(response.body)
-        if web_archive_res["archived_snapshots"]:
-            snapshot = web_archive_res["archived_snapshots"]["closest"]
-            real_date = snapshot["real_date"] = convert_snapshot_timestamp(snapshot["timestamp"])
-            meta.update(snapshot)
-            
-            key = self.make_key_from_meta(meta)
-            self.forum_page_time2snapshot_times.setdefault(key, []).append(real_date)
-            yield meta
-        else:
-            key = self.make_key_from_meta(meta)
-            self.forum_page_time2snapshot_times.setdefault(key, []).append(None)
-
-            meta["available"] = False
-            yield meta
+        snapshot = (web_archive_res["archived_snapshots"] or {}).get("closest")
+        yield self.add_snapshot(meta, snapshot)
+
+        yield from self.continue_chain(self.make_key_from_meta(meta))
+
+    def parse_cdx(
+        self, response: scrapy.http.Response, forum_name: str, forum_style: str,
+        forum_id: int, url_prefix: str,
+    ) -> T.Generator[T.Union[WebArchiveMetaItem, scrapy.Request], None, None]:
+        captures = self.forum_style2captures[(forum_id, forum_style)]
+        resume_key = None
+        for capture in iter_cdx_lines(response.text):
+            if isinstance(capture, str):
+                resume_key = capture
+            else:
+                captures.append(capture)
+
+        if resume_key:
+            self.log(f"{forum_name} ({forum_style}): {len(captures)} captures so far, resuming")
+            yield scrapy.Request(
+                url=make_cdx_url(url_prefix, resume_key=resume_key), callback=self.parse_cdx,
+                cb_kwargs={
+                    "forum_name": forum_name,
+                    "forum_style": forum_style,
+                    "forum_id": forum_id,
+                    "url_prefix": url_prefix,
+                }
+            )
+            return
+
+        captures = self.forum_style2captures.pop((forum_id, forum_style))
+        self.log(f"{forum_name} ({forum_style}): {len(captures)} captures")
+        yield from self.make_cdx_records(forum_name, forum_style, forum_id, captures)
+
+    def make_cdx_records(
+        self, forum_name: str, forum_style: str, forum_id: int,
+        captures: T.Iterable[CdxCapture],
+    ) -> T.Generator[WebArchiveMetaItem, None, None]:
+        """Answer the availability queries of `make_links` from CDX captures.
+
+        Dates are walked newest to oldest and skipped exactly like
+        `start_available_requests` does, so the records are the same.
+        """
+        page2captures: T.Dict[int, T.List[CdxCapture]] = {}
+        for capture in captures:
+            page = get_query_int(capture["original"], "page")
+            if page in PAGES_RANGE:
+                page2captures.setdefault(page, []).append(capture)
+
+        forum_link_pattern = FORUM_LINK_PATTERNS[forum_style]
+        for page in PAGES_RANGE:
+            timeline = CaptureTimeline(page2captures.pop(page, []))
+
+            for source in self.make_dates_sources(
+                forum_name, forum_id, forum_style, forum_link_pattern, page
+            ):
+                meta = source["meta"]
+                if self.should_skip(meta):
+                    continue
+
+                capture = timeline.closest(meta["query_date"])
+                snapshot = capture and {
+                    "status": capture["statuscode"],
+                    "available": True,
+                    "url": make_snapshot_url(capture["timestamp"], capture["original"]),
+                    "timestamp": capture["timestamp"],
+                }
+                yield self.add_snapshot(meta, snapshot)
+
+            self.forum_page_time2snapshot_times.pop((forum_id, forum_style, page), None)
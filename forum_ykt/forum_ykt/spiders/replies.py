@@ -1,13 +1,16 @@
 import typing as T
 from datetime import datetime
-from itertools import islice
+from itertools import chain, islice
 import json
+import math
 from pathlib import Path
 import re
 
+from lxml import etree, html
 import scrapy
-from scrapy import Request
+from scrapy import Request, signals
 from scrapy.http import Response
+import scrapy.crawler
 import scrapy.http
 import scrapy.logformatter
 
@@ -17,9 +20,12 @@ from forum_ykt.items import (
     Snapshot,
     TopicHead,
     Reply,
-    TopicItem
+    TopicItem,
+    TopicHeaderItem,
+    ReplyItem,
 )
 from forum_ykt.pipelines import RuDatePipeline
+from webtexts.feeds import update_feed_settings, shard_finished
 from forum_ykt.utils import (
     safe_strip,
     safe_int,
@@ -29,8 +35,24 @@ from forum_ykt.utils import (
     convert_head_timestamp,
     convert_customary_to_datetime,
     extract_webarchive_date,
+    iter_json_records,
+    normalize_topic_url,
+    in_shard,
+    iter_by_priority,
     tqdm
 )
+from webtexts.retry import DeferredRetry
+from forum_ykt.chain import StageQueue, fill_scheduler, schedule_queued
+from forum_ykt.storage import TopicIndex, ProgressStore, RepliesStore
+from webtexts.serialization import dumps, parse_iso_date
+from forum_ykt.wayback import (
+    CaptureTimeline,
+    make_cdx_url,
+    make_raw_snapshot_url,
+    make_snapshot_url,
+    iter_cdx_lines,
+    order_captures,
+)
 from forum_ykt.spiders.topics import (
     AuthorMeta,
     TopicMetaFull,
@@ -76,6 +98,17 @@ from forum_ykt.spiders.topics import (
 TOPICS_META_FILENAME = "./res/pages/webarchive-forums-content-13.json"
 
 
+def get_classes(el: html.HtmlElement) -> T.List[str]:
+    return (el.get("class") or "").split()
+
+
+def get_own_text(el: html.HtmlElement) -> T.List[str]:
+    """Text nodes of `el` itself, as `::text` does"""
+    texts = [el.text] if el.text is not None else []
+    texts.extend(child.tail for child in el if child.tail is not None)
+    return texts
+
+
 class QuietLogFormatter(scrapy.logformatter.LogFormatter):
     def scraped(self, item: scrapy.Item, response: scrapy.http.Response, spider: scrapy.Spider):
         return (
@@ -103,32 +136,198 @@ class RepliesSpider(scrapy.Spider):
     default_id = DEFAULT_ID
     default_rating = 0
 
+    # topics with all items written to finished shards, skipped when the spider is run again
+    progress_path = "./res/pages/replies-progress.sqlite"
+    # replies of the topics crawled with `-a refresh=1`, unless `-a store=` gives another path
+    replies_store_path = "./res/pages/replies-store.sqlite"
+    # topics items of `python -m forum_ykt.chain`, instead of the topics feed
+    input_queue: T.Optional[StageQueue] = None
+
+    @classmethod
+    def from_crawler(cls, crawler: scrapy.crawler.Crawler, *args, **kwargs):
+        spider = super(RepliesSpider, cls).from_crawler(crawler, *args, **kwargs)
+        crawler.signals.connect(spider.item_scraped, signal=signals.item_scraped)
+        crawler.signals.connect(spider.shard_finished, signal=shard_finished)
+        crawler.signals.connect(spider.spider_closed, signal=signals.spider_closed)
+        crawler.signals.connect(spider.spider_idle, signal=signals.spider_idle)
+        if spider.input_queue is not None:
+            crawler.signals.connect(spider.request_left_downloader, signal=signals.request_left_downloader)
+        return spider
+
     @classmethod
     def update_settings(cls, settings):
         super().update_settings(settings)
-        settings.setdefault("FEEDS", {}).update(cls.custom_feed)
+        update_feed_settings(settings, cls.custom_feed)
+
+    def open_progress(self) -> T.Set[str]:
+        """Open the progress store, return keys of the topics to skip.
+
+        `-a progress=` sets its path (empty disables it), `-a resume=0`
+        crawls finished topics again. Topics count as written once their
+        shard is finished, so progress is only kept with `FEED_MODE=shards`:
+        a JSON array feed is left unterminated by a crash, and a resumed
+        crawl would append a second array to it.
+        """
+        self.topic2scraped: T.Dict[str, int] = {}
+        self.topic2expected: T.Dict[str, T.Tuple[str, int]] = {}
+        self.unwritten_topics: T.List[T.Tuple[str, str, int]] = []
+
+        progress_path = getattr(self, "progress", None)
+        if self.settings.get("FEED_MODE", "json") != "shards":
+            if progress_path:
+                raise ValueError("progress needs FEED_MODE=shards")
+            self.progress_store = None
+            return set()
+        if progress_path is None:
+            progress_path = self.progress_path
+        if not progress_path:
+            self.progress_store = None
+            return set()
+        self.progress_store = ProgressStore(progress_path)
+        if not int(getattr(self, "resume", 1)):
+            return set()
+        return self.progress_store.finished_keys()
+
+    def open_replies_store(self) -> None:
+        """Open the replies store if asked for, with `-a store=` (its path) or `-a refresh=1`.
+
+        `-a refresh=1` crawls only the topics that are new or grew on the
+        listings since they were stored (all of them the first time), and
+        yields them with all their stored replies. Without either, replies
+        are not stored at all.
+        """
+        self.refresh = bool(int(getattr(self, "refresh", 0)))
+        store_path = getattr(self, "store", self.replies_store_path if self.refresh else "")
+        if self.refresh and not store_path:
+            raise ValueError("refresh needs the replies store")
+        self.replies_store = RepliesStore(store_path) if store_path else None
+        self.topic_states = self.replies_store.topic_states() if self.refresh else {}
 
-    # @classmethod
-    # def from_state(cls, state):
-    #     TODO
-    
     @staticmethod
-    def get_topics_data() -> T.List[TopicMetaFull]:
-        with open(TOPICS_META_FILENAME, "r", encoding="utf-8") as f:
-            topics_meta: T.List[TopicMetaFull] = json.load(f)
-        
-        return topics_meta[1:]
+    def get_topic_key(item: T.Dict[str, T.Any]) -> str:
+        return item.get("topic_key") or normalize_topic_url(item["topic_orig_url"])
+
+    def expect_items(self, meta: TopicMetaFull, num_items: int) -> None:
+        """The topic has `num_items` items, finished once they are all scraped"""
+        topic_key = self.get_topic_key(meta)
+        self.topic2expected[topic_key] = (meta["topic_url"], num_items)
+        self.check_finished(topic_key)
+
+    def item_scraped(self, item: T.Dict[str, T.Any]) -> None:
+        topic_key = self.get_topic_key(item)
+        self.topic2scraped[topic_key] = self.topic2scraped.get(topic_key, 0) + 1
+        self.check_finished(topic_key)
+
+    def check_finished(self, topic_key: str) -> None:
+        topic_url, num_items = self.topic2expected.get(topic_key, (None, None))
+        if num_items is None or self.topic2scraped.get(topic_key, 0) < num_items:
+            return
+        del self.topic2expected[topic_key]
+        del self.topic2scraped[topic_key]
+
+        if self.progress_store is None:
+            return
+        # written once the shard it is in is finished
+        self.unwritten_topics.append((topic_key, topic_url, num_items))
+
+    def shard_finished(self, path: Path, items: int) -> None:
+        if self.progress_store is None:
+            return
+        for topic in self.unwritten_topics:
+            self.progress_store.mark_finished(*topic)
+        self.progress_store.commit()
+        self.unwritten_topics = []
+
+    def spider_closed(self):
+        if getattr(self, "replies_store", None) is not None:
+            self.log(f"{len(self.replies_store)} topics in {self.replies_store.path}")
+            self.replies_store.close()
+        if getattr(self, "progress_store", None) is None:
+            return
+        if self.topic2expected or self.unwritten_topics:
+            self.logger.warning(
+                f"{len(self.topic2expected) + len(self.unwritten_topics)} topics are not marked as finished"
+            )
+        self.log(f"{len(self.progress_store)} finished topics in {self.progress_store.path}")
+        self.progress_store.close()
+
+    def skip_finished(
+        self, topics: T.Iterable[TopicMetaFull], finished_keys: T.Set[str]
+    ) -> T.Generator[TopicMetaFull, None, None]:
+        skipped = 0
+        for topic_meta in topics:
+            if self.get_topic_key(topic_meta) in finished_keys:
+                skipped += 1
+                continue
+            yield topic_meta
+        if skipped:
+            self.log(f"skipped {skipped} topics finished by earlier crawls")
+
+    def is_changed(self, meta: TopicMetaFull) -> bool:
+        """The topic has more messages or a later update on the listing than when it was stored"""
+        num_messages, last_update = self.topic_states[self.get_topic_key(meta)]
+        listed_update = self.get_last_update(meta)
+        return (
+            (meta.get("topic_num_messages") or 0) > num_messages
+            or (listed_update is not None and listed_update.isoformat() > last_update)
+        )
+
+    def skip_unchanged(self, topics: T.Iterable[TopicMetaFull]) -> T.Generator[TopicMetaFull, None, None]:
+        stats = self.crawler.stats
+        for topic_meta in topics:
+            if self.get_topic_key(topic_meta) not in self.topic_states:
+                stats.inc_value("refresh/new")
+            elif self.is_changed(topic_meta):
+                stats.inc_value("refresh/changed")
+            else:
+                stats.inc_value("refresh/unchanged")
+                continue
+            yield topic_meta
+        self.log(f"refresh: {stats.get_value('refresh/new', 0)} new, {stats.get_value('refresh/changed', 0)} changed, "
+                 f"{stats.get_value('refresh/unchanged', 0)} unchanged topics")
+
+    def skip_crawled(self, topics: T.Iterable[TopicMetaFull]) -> T.Iterable[TopicMetaFull]:
+        """Topics that are unchanged when refreshing, otherwise finished by earlier crawls, are skipped"""
+        if self.refresh:
+            return self.skip_unchanged(topics)
+        if self.finished_keys:
+            return self.skip_finished(topics, self.finished_keys)
+        return topics
     
+    def get_topics_data(self) -> T.Iterator[TopicMetaFull]:
+        topics_index = getattr(self, "topics_index", None)
+        if topics_index:
+            # one canonical capture per topic instead of every sighting of it
+            return TopicIndex(topics_index).iter_canonical()
+
+        topics_meta = iter_json_records(getattr(self, "topics_meta", TOPICS_META_FILENAME))
+        return islice(topics_meta, 1, None)
+
     def filter_topics(self, topics: T.Iterable[TopicMetaFull]) -> T.Generator[TopicMetaFull, None, None]:
         topics_i_from = getattr(self, "topics_i_from", None)
         topics_i_to = getattr(self, "topics_i_to", None)
-        topics_iter = islice(topics, topics_i_from, topics_i_to)
+        topics_iter = islice(
+            topics,
+            int(topics_i_from) if topics_i_from is not None else None,
+            int(topics_i_to) if topics_i_to is not None else None,
+        )
+        return self.select_topics(topics_iter)
+
+    def select_topics(self, topics_iter: T.Iterable[TopicMetaFull]) -> T.Generator[TopicMetaFull, None, None]:
+        """Topics of this shard matching `-a topics_url_pattern`"""
+        shard_index = self.settings.getint("SHARD_INDEX", 0)
+        shard_count = self.settings.getint("SHARD_COUNT", 1)
+        if shard_count > 1:
+            topics_iter = (
+                topic_meta for topic_meta in topics_iter
+                if in_shard(self.get_topic_key(topic_meta), shard_index, shard_count)
+            )
 
         topics_url_pattern = getattr(self, "topics_url_pattern", None)
         if topics_url_pattern:
             pattern = re.compile(topics_url_pattern)
             for topic_meta in topics_iter:
-                if pattern.match(topic_meta["url"]):
+                if pattern.match(topic_meta["topic_url"]):
                     yield topic_meta
         else:
             yield from topics_iter
@@ -136,15 +335,222 @@ class RepliesSpider(scrapy.Spider):
     def start_requests(self):
         base_topics_meta = self.get_topics_data()
 
-        topics_meta = list(self.filter_topics(base_topics_meta))
+        topics_meta = self.filter_topics(base_topics_meta)
+        self.finished_keys = self.open_progress()
+        self.open_replies_store()
+        topics_meta = self.skip_crawled(topics_meta)
+
+        # `-a fetch=raw` downloads the original pages, without webarchive toolbar and links
+        self.fetch = getattr(self, "fetch", "rewritten")
+        if self.fetch not in ("rewritten", "raw"):
+            raise ValueError(f"unknown fetch mode: {self.fetch}")
+
+        # `-a captures=cdx` chooses among all captures of a topic instead of the linked one
+        self.captures = getattr(self, "captures", "linked")
+        if self.captures not in ("linked", "cdx"):
+            raise ValueError(f"unknown captures mode: {self.captures}")
+        self.max_captures = int(getattr(self, "max_captures", 3))
+        # `-a merge=1` fetches up to `max_captures` captures and merges their replies
+        self.merge = bool(int(getattr(self, "merge", 0)))
+        # `-a items=replies` yields a small header item per topic and then every reply as an item
+        self.items = getattr(self, "items", "topics")
+        if self.items not in ("topics", "replies"):
+            raise ValueError(f"unknown items mode: {self.items}")
+        # `-a priority=yield` crawls topics expected to have more text first
+        self.priority = getattr(self, "priority", "none")
+        if self.priority not in ("none", "yield"):
+            raise ValueError(f"unknown priority mode: {self.priority}")
+        if self.priority == "yield":
+            topics_meta = iter_by_priority(
+                topics_meta, self.get_priority, window=self.settings.getint("TOPIC_PRIORITY_WINDOW", 10_000)
+            )
+
+        if self.input_queue is not None:
+            # topics come from the topics stage, see `iter_chained_requests`
+            self.requested_keys: T.Set[str] = set()
+            return
 
         # print(topics_meta)
 
         for meta in tqdm(topics_meta):
-            topic_url = meta["topic_url"]
-            self.log((meta["topic_title"], topic_url))
+            yield self.make_topic_request(meta)
+
+    def make_topic_request(self, meta: TopicMetaFull) -> Request:
+        topic_url = meta["topic_url"]
+        self.log((meta["topic_title"], topic_url))
+
+        if self.captures == "cdx":
+            return Request(
+                make_cdx_url(meta["topic_orig_url"], match_type="exact"),
+                callback=self.parse_topic_captures, errback=self.on_topic_captures_error,
+                cb_kwargs=meta, priority=self.get_priority(meta),
+            )
+        return Request(
+            self.make_fetch_url(topic_url), callback=self.parse, cb_kwargs=meta,
+            priority=self.get_priority(meta),
+        )
+
+    def iter_chained_requests(self, topics_meta: T.Iterable[TopicMetaFull]) -> T.Generator[Request, None, None]:
+        topics_meta = self.skip_crawled(self.select_topics(topics_meta))
+        for meta in topics_meta:
+            # a topic is seen on many listing captures, the first sighting is crawled
+            topic_key = self.get_topic_key(meta)
+            if topic_key in self.requested_keys:
+                continue
+            self.requested_keys.add(topic_key)
+            yield self.make_topic_request(meta)
+
+    def request_left_downloader(self):
+        fill_scheduler(self, self.input_queue, self.iter_chained_requests)
+
+    def spider_idle(self):
+        if self.input_queue is not None:
+            schedule_queued(self, self.input_queue, self.iter_chained_requests)
+
+    def get_priority(self, meta: TopicMetaFull) -> int:
+        """Request priority of the topic, by `TOPIC_PRIORITY_WEIGHTS` and `TOPIC_PRIORITY_FORUMS`"""
+        if self.priority != "yield":
+            return 0
+        weights = self.settings.getdict("TOPIC_PRIORITY_WEIGHTS")
+        priority = weights.get("messages", 0) * math.log2(1 + (meta.get("topic_num_messages") or 0))
+
+        last_update = self.get_last_update(meta)
+        if last_update is not None:
+            years = max(0.0, (datetime.now() - last_update).days / 365.25)
+            priority += weights.get("recency", 0) / (1 + years)
+
+        # ids are strings when the setting is given as JSON on the command line
+        forum2priority = self.settings.getdict("TOPIC_PRIORITY_FORUMS")
+        forum_id = meta.get("forum_id")
+        priority += forum2priority.get(forum_id, forum2priority.get(str(forum_id), 0))
+        return round(priority)
+
+    @staticmethod
+    def count_chars(reply: TopicItem) -> int:
+        return sum(map(len, reply.get("title") or [])) + sum(map(len, reply.get("text") or []))
+
+    def record_yield(self, num_replies: int, num_chars: int) -> None:
+        """Replies (with heads) and characters of their text in the `yield/...` stats"""
+        stats = self.crawler.stats
+        stats.inc_value("yield/replies", num_replies)
+        stats.inc_value("yield/chars", num_chars)
 
-            yield Request(topic_url, callback=self.parse, cb_kwargs=meta)
+        requests = stats.get_value("yield/requests", 0)
+        if requests:
+            stats.set_value("yield/replies_per_request", round(stats.get_value("yield/replies") / requests, 2))
+            stats.set_value("yield/chars_per_request", round(stats.get_value("yield/chars") / requests, 1))
+
+    def record_request(self) -> None:
+        self.crawler.stats.inc_value("yield/requests")
+
+    def make_fetch_url(self, snapshot_url: str) -> str:
+        return make_raw_snapshot_url(snapshot_url) if self.fetch == "raw" else snapshot_url
+
+    @staticmethod
+    def get_last_update(meta: TopicMetaFull) -> T.Optional[datetime]:
+        last_update = meta.get("topic_last_update")
+        if isinstance(last_update, str):
+            last_update = parse_iso_date(last_update)
+        return last_update if isinstance(last_update, datetime) else None
+
+    def parse_topic_captures(self, response: Response, **meta: T.Any) -> T.Any:
+        self.record_request()
+        timeline = CaptureTimeline(
+            capture for capture in iter_cdx_lines(response.text) if not isinstance(capture, str)
+        )
+        captures = order_captures(timeline, hint=self.get_last_update(meta))[:self.max_captures]
+        capture_urls = [make_snapshot_url(capture["timestamp"], capture["original"]) for capture in captures]
+        self.log(f"{meta['topic_orig_url']}: {len(timeline)} captures")
+
+        yield self.make_capture_request(capture_urls or [meta["topic_url"]], meta, replies=[], fetched=[])
+
+    def on_topic_captures_error(self, failure) -> T.Any:
+        meta = failure.request.cb_kwargs
+        if failure.check(DeferredRetry):
+            return
+        self.record_request()
+        self.logger.warning(f"captures of {meta['topic_orig_url']} failed, "
+                            f"using the linked one: {failure.value!r}")
+        yield self.make_capture_request([meta["topic_url"]], meta, replies=[], fetched=[])
+
+    def make_capture_request(
+        self, capture_urls: T.List[str], meta: TopicMetaFull,
+        replies: T.List[TopicItem], fetched: T.List[str],
+    ) -> Request:
+        capture_url, *rest = capture_urls
+        return Request(
+            self.make_fetch_url(capture_url), callback=self.parse_capture,
+            errback=self.on_capture_error, cb_kwargs=meta, priority=self.get_priority(meta),
+            meta={"capture_url": capture_url, "capture_urls": rest, "replies": replies, "fetched": fetched},
+        )
+
+    @staticmethod
+    def get_reply_key(reply: TopicItem) -> T.Tuple[T.Any, ...]:
+        if reply["id"] != DEFAULT_ID:
+            return (reply["id"],)
+        return (reply["id"], str(reply["date"]), reply["author_name"])
+
+    def merge_replies(self, replies: T.List[TopicItem], more_replies: T.List[TopicItem]) -> T.List[TopicItem]:
+        """Replies of both captures by id, the ones of the first capture kept for the shared ones"""
+        key2reply = {self.get_reply_key(reply): reply for reply in replies}
+        for reply in more_replies:
+            key2reply.setdefault(self.get_reply_key(reply), reply)
+        return list(key2reply.values())
+
+    def continue_captures(
+        self, meta: TopicMetaFull, capture_urls: T.List[str],
+        replies: T.List[TopicItem], fetched: T.List[str],
+    ) -> T.Any:
+        """Fetch the next capture, unless the replies are (believed to be) complete already"""
+        enough = (
+            not self.merge
+            and replies
+            and len(replies) - 1 >= (meta.get("topic_num_messages") or 0)
+        )
+        if capture_urls and not enough:
+            yield self.make_capture_request(capture_urls, meta, replies, fetched)
+            return
+
+        if not replies:
+            self.logger.warning(f"no replies parsed from captures of {meta['topic_orig_url']}")
+            return
+        meta["replies_captures"] = fetched
+        self.log(f"total replies (1 + len(replies)): {len(replies)} from {len(fetched)} captures")
+        replies = list(self.store_replies(meta, replies))
+        if self.items == "replies":
+            yield from self.iter_topic_items(meta, replies)
+            return
+        meta["replies"] = replies
+        self.record_yield(len(replies), sum(map(self.count_chars, replies)))
+        self.expect_items(meta, 1)
+        yield meta
+
+    def parse_capture(self, response: Response, **meta: T.Any) -> T.Any:
+        self.record_request()
+        replies, fetched = response.meta["replies"], response.meta["fetched"] + [response.meta["capture_url"]]
+        try:
+            capture_replies = self.parse_replies(response)
+        except (KeyError, IndexError, AttributeError) as e:
+            # deleted topics and error pages are archived with 200 too
+            self.logger.warning(f"no topic on {response.url}: {e!r}")
+            capture_replies = []
+
+        if self.merge:
+            replies = self.merge_replies(replies, capture_replies)
+        elif len(capture_replies) > len(replies):
+            replies = capture_replies
+
+        yield from self.continue_captures(meta, response.meta["capture_urls"], replies, fetched)
+
+    def on_capture_error(self, failure) -> T.Any:
+        if failure.check(DeferredRetry):
+            return
+        self.record_request()
+        request = failure.request
+        self.logger.warning(f"capture {request.url} failed: {failure.value!r}")
+        yield from self.continue_captures(
+            request.cb_kwargs, request.meta["capture_urls"], request.meta["replies"], request.meta["fetched"]
+        )
 
     # def compute_date(self, date_str):
     #     if 
@@ -180,7 +586,11 @@ class RepliesSpider(scrapy.Spider):
     def parse_reply_date(
         self,  reply_div: scrapy.Selector
     ) -> T.Optional[T.Union[datetime, str]]:
-        return datetime.fromtimestamp(safe_int(reply_div.attrib["data-date"]) / 1000)
+        return self.convert_reply_date(reply_div.attrib["data-date"])
+
+    @staticmethod
+    def convert_reply_date(data_date: str) -> datetime:
+        return datetime.fromtimestamp(safe_int(data_date) / 1000)
 
     @staticmethod
     def parse_ip(content: scrapy.Selector):
@@ -231,31 +641,61 @@ class RepliesSpider(scrapy.Spider):
 
         return is_by_owner
     
-    def parse_reply(
-        self, reply_li: scrapy.Selector, head_id: int, parent_id: T.Optional[int]=None,
+    def parse_reply_element(
+        self, reply_li: html.HtmlElement, head_id: int, parent_id: T.Optional[int]=None,
         is_by_owner_checker: T.Optional[T.Callable[[str], bool]]=None
-    ) -> T.List[Reply]:
-        results: T.List[Reply] = []
-
+    ) -> T.Tuple[Reply, T.List[html.HtmlElement]]:
+        """Fields of the reply of a single `li`, and the `li`s of its own replies"""
         reply_id = safe_int(reply_li.attrib["id"].strip("comment-")) or self.default_id
 
-        reply_div = reply_li.css(".f-comment")
-
-        content = reply_li.css(".f-comment_content")[0]
-        title = content.css(".f-comment_topic > *::text").getall()
+        reply_div = content = None
+        further_replies_list: T.List[html.HtmlElement] = []
+        for child in reply_li:
+            if child.tag == "ul":
+                further_replies_list.extend(li for li in child if li.tag == "li")
+                continue
+            if content is not None:
+                continue
+            for el in child.iter(tag=etree.Element):
+                classes = get_classes(el)
+                if reply_div is None and "f-comment" in classes:
+                    reply_div = el
+                if "f-comment_content" in classes:
+                    content = el
+                    break
+        if content is None:
+            raise IndexError(f"no .f-comment_content in reply: {reply_id}")
+
+        title: T.List[str] = []
+        text: T.List[str] = []
+        rating_text = author_name = None
+        ip_els: T.Dict[str, T.Optional[html.HtmlElement]] = {"f-comment_ip": None, "f-user_ip": None}
+        for el in content.iter(tag=etree.Element):
+            if el.tag == "p":
+                text.extend(get_own_text(el))
+            classes = get_classes(el)
+            if not classes:
+                continue
+            if "f-comment_topic" in classes:
+                for title_el in el.iterchildren(tag=etree.Element):
+                    title.extend(get_own_text(title_el))
+            if rating_text is None and "f-comment_like_count" in classes:
+                rating_text = next(iter(get_own_text(el)), None)
+            if author_name is None and "f-user_name" in classes:
+                author_name = next(iter(get_own_text(el)), None)
+            for ip_class, ip_el in ip_els.items():
+                if ip_el is None and ip_class in classes:
+                    ip_els[ip_class] = el
         if len(title) > 1:
             self.logger.info(f"more than 1 string in title for reply: {reply_id}")
 
-        text = content.css("p::text").getall()
-        rating = safe_int(safe_strip(content.css(".f-comment_like_count::text").get())) or self.default_rating
-
-        # self.log(text)
-        # date = content.css(".f-comment_header_createdate::text")
-        date = self.parse_reply_date(reply_div)
-        author_name = safe_strip(content.css(".f-user_name::text").get())
-
-        author_ip = self.parse_ip(content)
-        # self.log(f"author ip: {author_ip}")
+        rating = safe_int(safe_strip(rating_text)) or self.default_rating
+        date = self.convert_reply_date(reply_div.attrib["data-date"])
+        author_ip = next(
+            (ip_el.attrib["data-title"] for ip_el in ip_els.values()
+             if ip_el is not None and "data-title" in ip_el.attrib),
+            None
+        )
         by_owner = is_by_owner_checker(author_ip) if is_by_owner_checker else None
 
         reply: Reply = {
@@ -268,33 +708,99 @@ class RepliesSpider(scrapy.Spider):
 
             "date": date,
             "rating": rating,
-            "author_name": author_name,
+            "author_name": safe_strip(author_name),
             "title": title,
             "text": text,
         }
+        return reply, further_replies_list
 
-        # self.log(f"parent: `{parent_id}`, current: `{reply_id}`")
-        # self.log(reply)
-
-        results.append(reply)
+    def iter_reply_tree(
+        self, top_level_replies_list: T.Iterable[html.HtmlElement], head_id: int,
+        is_by_owner_checker: T.Optional[T.Callable[[str], bool]]=None
+    ) -> T.Generator[Reply, None, None]:
+        """Replies of the tree in depth-first order, without recursion"""
+        stack: T.List[T.Tuple[html.HtmlElement, T.Optional[int]]] = [
+            (reply_li, None) for reply_li in reversed(list(top_level_replies_list))
+        ]
+        while stack:
+            reply_li, parent_id = stack.pop()
+            reply, further_replies_list = self.parse_reply_element(
+                reply_li, head_id, parent_id=parent_id, is_by_owner_checker=is_by_owner_checker
+            )
+            yield reply
+            stack.extend((further_reply, reply["id"]) for further_reply in reversed(further_replies_list))
+
+    def iter_topic_items(
+        self, meta: TopicMetaFull, replies: T.Iterable[TopicItem]
+    ) -> T.Generator[T.Union[TopicHeaderItem, ReplyItem], None, None]:
+        """Header of the topic, then its replies one by one, all with the topic key"""
+        topic_key = meta.get("topic_key") or normalize_topic_url(meta["topic_orig_url"])
+        replies = iter(replies)
+        # the head is parsed before anything is yielded, so broken pages give no header
+        topic_head = next(replies, None)
+        if topic_head is None:
+            return
+
+        topic_header: TopicHeaderItem = {
+            "item_type": "topic",
+            "topic_key": topic_key,
+            **{key: val for key, val in meta.items() if key not in ("replies", "topic_key")},
+        }
+        yield topic_header
+
+        num_replies = num_chars = 0
+        for reply in chain([topic_head], replies):
+            reply_item: ReplyItem = {"item_type": "reply", "topic_key": topic_key, **reply}
+            yield reply_item
+            num_replies += 1
+            num_chars += self.count_chars(reply)
+        self.log(f"total replies (1 + len(replies)): {num_replies}")
+        self.record_yield(num_replies, num_chars)
+        self.expect_items(meta, 1 + num_replies)
 
-        # further_replies_lists_list = reply_li.css(".f-comments_list")
-        further_replies_list = reply_li.xpath("./ul/li")
-        # if further_replies_lists_list:
-        # self.log(f"further_replies: {further_replies_list}")
-        if further_replies_list:
-            # further_replies_list = further_replies_lists_list[0]
-            # for further_reply in further_replies_list.xpath("/li"):
-            for further_reply in further_replies_list:
-                res = self.parse_reply(
-                    further_reply, head_id, parent_id=reply_id,
-                    is_by_owner_checker=is_by_owner_checker
-                )
-                results.extend(res)
+    def parse(self, response: Response, **meta: T.Any) -> T.Any:
+        self.record_request()
+        replies = self.store_replies(meta, self.iter_replies(response))
+        if self.items == "replies":
+            yield from self.iter_topic_items(meta, replies)
+            return
+        meta["replies"] = list(replies)
+        self.log(f"total replies (1 + len(replies)): {len(meta['replies'])}")
+        self.record_yield(len(meta["replies"]), sum(map(self.count_chars, meta["replies"])))
+        self.expect_items(meta, 1)
+        yield meta
+
+    def store_replies(self, meta: TopicMetaFull, replies: T.Iterable[TopicItem]) -> T.Iterable[TopicItem]:
+        """The replies, written to the replies store as they pass, or all stored ones when refreshing"""
+        if self.replies_store is None:
+            return replies
+        stored = self.iter_stored(meta, replies)
+        if not self.refresh:
+            return stored
+        num_parsed = sum(1 for _ in stored)
+        merged = self.replies_store.replies(self.get_topic_key(meta))
+        self.log(f"refreshed {meta['topic_url']}: {num_parsed} replies parsed, {len(merged)} stored")
+        return merged
+
+    def iter_stored(
+        self, meta: TopicMetaFull, replies: T.Iterable[TopicItem]
+    ) -> T.Generator[TopicItem, None, None]:
+        """Yield the replies, then merge them into the store by reply key and record the topic's counts"""
+        keyed_replies = []
+        for reply in replies:
+            keyed_replies.append((dumps(self.get_reply_key(reply)), reply))
+            yield reply
+        topic_key = self.get_topic_key(meta)
+        self.replies_store.add_replies(topic_key, keyed_replies)
+        self.replies_store.record_topic(
+            topic_key, meta["topic_url"], meta.get("topic_num_messages") or 0, self.get_last_update(meta)
+        )
 
-        return results
+    def parse_replies(self, response: Response) -> T.List[TopicItem]:
+        return list(self.iter_replies(response))
 
-    def parse(self, response: Response, **meta: T.Any) -> T.Any:
+    def iter_replies(self, response: Response) -> T.Generator[TopicItem, None, None]:
+        """Head of the topic, then its replies"""
         topic_head = self.parse_head(response)
         head_id = topic_head["id"]
         topic_starter_ip = topic_head.pop("author_ip")
@@ -304,14 +810,8 @@ class RepliesSpider(scrapy.Spider):
         top_level_replies_list = top_container.css("ul.topic-comments__items:first-child > li")
         # self.log(f"top-level replies: {len(top_level_replies_list)}")
 
-        all_replies: T.List[TopicItem] = [topic_head]
-        for top_level_reply in tqdm(top_level_replies_list):
-            branched_replies = self.parse_reply(
-                top_level_reply, head_id, is_by_owner_checker=is_by_owner_checker
-            )
-            # self.log(f"`{len(branched_replies)}` from `{branched_replies[0]}`")
-            all_replies.extend(branched_replies)
-
-        meta["replies"] = all_replies
-        self.log(f"total replies (1 + len(replies)): {len(all_replies)}")
-        yield meta
\ No newline at end of file
+        yield topic_head
+        yield from self.iter_reply_tree(
+            (reply_li.root for reply_li in top_level_replies_list), head_id,
+            is_by_owner_checker=is_by_owner_checker
+        )
\ No newline at end of file
@@ -1,26 +1,51 @@
 import typing as T
 from datetime import datetime
+from itertools import groupby
 import json
 from pathlib import Path
+import time
 
 import scrapy
-from scrapy import Request
+import scrapy.crawler
+from scrapy import Request, signals
+from scrapy.exceptions import DontCloseSpider
 
-from forum_ykt.spiders import WEB_ARCHIVE_DOMAIN
 from forum_ykt.items import WebArchiveMetaItem, Snapshot
 from forum_ykt.pipelines import RuDatePipeline
+from webtexts.feeds import update_feed_settings
+from webtexts.serialization import dumps_bytes
+from forum_ykt.coverage import CoveragePlanner
+from webtexts.retry import DeferredRetry
+from forum_ykt.chain import StageQueue, fill_scheduler, schedule_queued
+from forum_ykt.storage import SnapshotIndex, TopicIndex
+from forum_ykt.layouts import LayoutRegistry, ListingLayout, RowFields
+from forum_ykt.wayback import (
+    make_raw_snapshot_url,
+    strip_snapshot_modifier,
+    resolve_snapshot_link,
+)
 from forum_ykt.utils import (
     safe_strip,
     safe_int,
     extract_query,
     convert_snapshot_timestamp,
-    convert_customary_to_datetime,
+    convert_customary_dates,
     extract_webarchive_date,
+    iter_json_records,
+    in_shard,
 )
 
 
 # FORUMS_META_FILENAME = "./res/webarchive-forums-meta.json"
 FORUMS_META_FILENAME = "./res/webarchive-forums-meta-by_forum_style_date-4.json"
+COVERAGE_REPORT_FILENAME = "./res/pages/topics-coverage-skipped.json"
+LAYOUTS_REPORT_FILENAME = "./res/pages/topics-layouts.json"
+
+# fields of a topic row of a listing, in the order of the items
+TOPIC_FIELDS = (
+    "topic_title", "topic_url", "topic_orig_url", "topic_author", "topic_num_messages", "topic_last_update",
+)
+TopicRow = T.Tuple[str, str, str, T.Optional[str], int, T.Union[datetime, str, None]]
 
 
 class AuthorMeta(T.TypedDict):
@@ -84,8 +109,17 @@ class PaginationParser:
 
         return {"style": "2014", "result": self.escape_result(response, next_page)}
 
-    def parse(self, response: scrapy.http.Response) -> T.Optional[PaginationParseResult]:
-        """Parse with styles from newest to oldest and return on first sucess"""
+    def parse(
+        self, response: scrapy.http.Response, layout: T.Optional[ListingLayout] = None
+    ) -> T.Optional[PaginationParseResult]:
+        """Parse with the layout of the capture if known, else with styles from newest to oldest and return on first sucess
+
+        `layout` is the one `TopicsSpider.get_layout` found for the rows, so that the page is counted once.
+        """
+        if layout:
+            next_page = self.escape_result(response, layout.get_next_page(response.selector.root))
+            return {"style": layout.name, "result": next_page} if next_page else None
+
         for parse_func in (self.parse_2021, self.parse_2014):
             parse_result = parse_func(response)
             if parse_result["result"]:
@@ -111,20 +145,33 @@ class TopicsSpider(scrapy.Spider):
             "indent": 4,
         }
     }
+    topic_index_path = "./res/pages/topics-index.sqlite"
+    # forums items of `python -m forum_ykt.chain`, instead of the forums feed
+    input_queue: T.Optional[StageQueue] = None
     # MAX_PAGES = 23
 
+    @classmethod
+    def from_crawler(cls, crawler: scrapy.crawler.Crawler, *args, **kwargs):
+        spider = super(TopicsSpider, cls).from_crawler(crawler, *args, **kwargs)
+        crawler.signals.connect(spider.spider_idle, signal=signals.spider_idle)
+        crawler.signals.connect(spider.spider_closed, signal=signals.spider_closed)
+        if spider.input_queue is not None:
+            crawler.signals.connect(spider.request_left_downloader, signal=signals.request_left_downloader)
+        return spider
+
     @classmethod
     def update_settings(cls, settings):
         
         super().update_settings(settings)
-        settings.setdefault("FEEDS", {}).update(cls.custom_feed)
+        update_feed_settings(settings, cls.custom_feed)
 
-    @staticmethod
-    def get_forum_data() -> T.List[WebArchiveMetaItem]:
-        with open(FORUMS_META_FILENAME, "r", encoding="utf-8") as f:
-            forums_meta: T.List[WebArchiveMetaItem] = json.load(f)
-        
-        return forums_meta
+    def get_forum_data(self) -> T.Iterable[WebArchiveMetaItem]:
+        forums_index = getattr(self, "forums_index", None)
+        if forums_index:
+            # snapshots found by the forums spider so far, without loading them all
+            return SnapshotIndex(forums_index).iter_metas()
+
+        return iter_json_records(getattr(self, "forums_meta", FORUMS_META_FILENAME))
 
     @staticmethod
     def get_test_forum_data() -> T.List[WebArchiveMetaItem]:
@@ -156,60 +203,252 @@ class TopicsSpider(scrapy.Spider):
 
         return d
 
+    @staticmethod
+    def group_by_snapshot_url(
+        forums_meta: T.Iterable[WebArchiveMetaItem], sorted_by_url: bool = False
+    ) -> T.Generator[T.Tuple[str, T.List[WebArchiveMetaItem]], None, None]:
+        """Collapse records resolving to the same capture, keeping all of them
+
+        Records already sorted by url (as read from the index) are grouped as a stream.
+        """
+        available_metas = (meta for meta in forums_meta if meta["available"])
+        if sorted_by_url:
+            for snapshot_url, metas in groupby(available_metas, key=lambda meta: meta["url"]):
+                yield snapshot_url, list(metas)
+            return
+
+        url2metas: T.Dict[str, T.List[WebArchiveMetaItem]] = {}
+        for meta in available_metas:
+            url2metas.setdefault(meta["url"], []).append(meta)
+
+        yield from url2metas.items()
+
+    def get_seen_topics(self) -> T.Set[str]:
+        """Original urls of topics in an earlier topics feed, passed as `-a seen_topics=`"""
+        seen_topics_path = getattr(self, "seen_topics", None)
+        if not seen_topics_path:
+            return set()
+
+        return {topic["topic_orig_url"] for topic in iter_json_records(seen_topics_path)}
+
+    def make_request(
+        self, snapshot_url: str, metas: T.List[WebArchiveMetaItem], late: bool = False
+    ) -> Request:
+        """Request of a capture, `late` for records that came after it was parsed (from the HTTP cache then)"""
+        return Request(
+            make_raw_snapshot_url(snapshot_url) if self.fetch == "raw" else snapshot_url,
+            callback=self.parse, errback=self.on_error,
+            cb_kwargs={"metas": metas, "late": late}, meta={"snapshot_url": snapshot_url},
+            dont_filter=late,
+        )
+
     def start_requests(self):
         forums_meta = self.get_forum_data()
+        # selectors of the listing layout of every capture
+        self.layouts = LayoutRegistry()
         self.pagination_parser = PaginationParser(logger=self.log)
-        
-        for meta in forums_meta:
-            if not meta["available"]:
-                continue
-
+        # every sighting of a topic, and the capture to fetch its replies from
+        self.topic_index = TopicIndex(getattr(self, "topics_index", self.topic_index_path))
+
+        # `-a fetch=raw` downloads the original pages, without webarchive toolbar and links
+        self.fetch = getattr(self, "fetch", "rewritten")
+        if self.fetch not in ("rewritten", "raw"):
+            raise ValueError(f"unknown fetch mode: {self.fetch}")
+
+        # `-a cover=greedy` fetches only the captures expected to show unseen topics
+        self.cover = getattr(self, "cover", None)
+        if self.cover not in (None, "greedy"):
+            raise ValueError(f"unknown cover mode: {self.cover}")
+        if self.cover:
+            self.planner = CoveragePlanner(
+                min_gain=float(getattr(self, "min_gain", 1.0)),
+                seen_topics=self.get_seen_topics(),
+            )
+            self.url2metas: T.Dict[str, T.List[WebArchiveMetaItem]] = {}
+
+        if self.input_queue is not None:
+            # records come from the forums stage, see `iter_chained_requests`
+            if self.cover:
+                raise ValueError("greedy cover needs all captures before the crawl")
+            # records of captures yet to be parsed, and captures parsed already
+            self.chained_url2metas: T.Dict[str, T.List[WebArchiveMetaItem]] = {}
+            self.chained_parsed: T.Set[str] = set()
+            return
+
+        grouped_metas = self.group_by_snapshot_url(
+            forums_meta, sorted_by_url=bool(getattr(self, "forums_index", None))
+        )
+        for snapshot_url, metas in grouped_metas:
+            request = self.make_group_request(snapshot_url, metas)
+            if request is not None:
+                yield request
+
+        if self.cover:
+            seeds = self.planner.seeds()
+            self.log(f"covering {len(self.url2metas)} captures, starting with {len(seeds)}")
+            for snapshot_url in seeds:
+                yield self.make_request(snapshot_url, self.url2metas[snapshot_url])
+
+    def in_own_shard(self, meta: WebArchiveMetaItem) -> bool:
+        """Whether the record's capture is crawled by this process, see run_shards.py"""
+        # all captures of a forum page go to the same shard, as the coverage planner compares them
+        shard_index = self.settings.getint("SHARD_INDEX", 0)
+        shard_count = self.settings.getint("SHARD_COUNT", 1)
+        return in_shard(f"{meta['forum_id']}/{meta['forum_style']}/{meta['page']}", shard_index, shard_count)
+
+    def make_group_request(self, snapshot_url: str, metas: T.List[WebArchiveMetaItem]) -> T.Optional[Request]:
+        """Request of a capture for all its records, unless it is left to another shard or to the planner"""
+        meta = metas[0]
+        if not self.in_own_shard(meta):
+            return None
+
+        if self.cover:
+            self.planner.add(
+                snapshot_url, (meta["forum_id"], meta["forum_style"], meta["page"]),
+                convert_snapshot_timestamp(meta["timestamp"]),
+            )
+
+        for meta in metas:
             self.add_pref_to_keys(meta, ["url", "timestamp"])
-            self.log(meta)
+        self.log(f"{snapshot_url}: {len(metas)} records")
 
-            # snapshots: T.Dict[str, Snapshot] = meta.pop("archived_snapshots")
-            # if len(snapshots) > 1:
-            #     self.log(f"multiple snapshots for {meta['forum_name'] (meta['orig_url'])}")
+        # snapshots: T.Dict[str, Snapshot] = meta.pop("archived_snapshots")
+        # if len(snapshots) > 1:
+        #     self.log(f"multiple snapshots for {meta['forum_name'] (meta['orig_url'])}")
 
-            # closest_snapshot = snapshots["closest"]
-            # meta.update(closest_snapshot)
+        # closest_snapshot = snapshots["closest"]
+        # meta.update(closest_snapshot)
 
-            # self.log(meta)
-            
-            if not hasattr(self, "forum2pages"):
-                self.forum2pages = {}
+        # self.log(meta)
+        
+        if not hasattr(self, "forum2pages"):
+            self.forum2pages = {}
+        for meta in metas:
             self.forum2pages[meta["forum_name"]] = 0
 
-            yield Request(meta["orig_url"], callback=self.parse, cb_kwargs=meta)
+        if self.cover:
+            self.url2metas[snapshot_url] = metas
+            return None
+        return self.make_request(snapshot_url, metas)
+
+    def iter_chained_requests(self, forums_meta: T.Iterable[WebArchiveMetaItem]) -> T.Generator[Request, None, None]:
+        for meta in forums_meta:
+            # records of other shards are not kept at all
+            if not meta["available"] or not self.in_own_shard(meta):
+                continue
+            snapshot_url = meta["url"]
+            metas = self.chained_url2metas.get(snapshot_url)
+            if metas is not None:
+                # another record of a capture being requested, which `parse` sees with the others
+                metas.append(self.add_pref_to_keys(meta, ["url", "timestamp"]))
+                continue
+
+            if snapshot_url in self.chained_parsed:
+                # the capture is requested again for records that came too late for it
+                metas = self.chained_url2metas[snapshot_url] = [self.add_pref_to_keys(meta, ["url", "timestamp"])]
+                yield self.make_request(snapshot_url, metas, late=True)
+                continue
+
+            metas = self.chained_url2metas[snapshot_url] = [meta]
+            request = self.make_group_request(snapshot_url, metas)
+            if request is None:
+                del self.chained_url2metas[snapshot_url]
+                continue
+            yield request
+
+    def on_error(self, failure):
+        if failure.check(DeferredRetry):
+            return
+        self.log(f"failed {failure.request.url}: {failure.value!r}")
+        if self.input_queue is not None:
+            # later records request the capture again
+            self.chained_url2metas.pop(failure.request.meta["snapshot_url"], None)
+        if self.cover:
+            self.planner.observe_failure(failure.request.meta["snapshot_url"])
+
+    def request_left_downloader(self):
+        fill_scheduler(self, self.input_queue, self.iter_chained_requests)
+
+    def spider_idle(self):
+        if self.input_queue is not None:
+            schedule_queued(self, self.input_queue, self.iter_chained_requests)
+
+        if not getattr(self, "cover", None):
+            return
+
+        batch_size = self.crawler.settings.getint("CONCURRENT_REQUESTS")
+        snapshot_urls = self.planner.next_batch(batch_size)
+        if not snapshot_urls:
+            return
+
+        for snapshot_url in snapshot_urls:
+            self.crawler.engine.crawl(self.make_request(snapshot_url, self.url2metas[snapshot_url]))
+        raise DontCloseSpider
+
+    def spider_closed(self):
+        if hasattr(self, "topic_index"):
+            self.log(f"{len(self.topic_index)} distinct topics in {self.topic_index.path}")
+            self.topic_index.close()
+        if hasattr(self, "layouts"):
+            self.report_layouts()
+
+        if not getattr(self, "cover", None):
+            return
+
+        skipped = self.planner.skipped()
+        estimates = [capture["estimated_lost_topics"] for capture in skipped]
+        unknown = estimates.count(None)
+        lost = sum(estimate for estimate in estimates if estimate is not None)
+        self.log(
+            f"skipped {len(skipped)} of {len(self.url2metas)} captures, "
+            f"estimated {lost:.1f} topics lost ({unknown} captures of pages never fetched not counted)"
+        )
 
+        Path(COVERAGE_REPORT_FILENAME).parent.mkdir(parents=True, exist_ok=True)
+        with open(COVERAGE_REPORT_FILENAME, "wb") as f:
+            f.write(dumps_bytes(skipped, indent=4))
+
+    def report_layouts(self) -> None:
+        """Pages and parse time of every listing layout, in the log, stats and `LAYOUTS_REPORT_FILENAME`"""
+        report = self.layouts.report()
+        stats = self.crawler.stats
+        stats.set_value("layouts/probed", self.layouts.probed)
+        stats.set_value("layouts/cached", self.layouts.cached)
+        for layout in report:
+            stats.set_value(f"layouts/{layout['layout']}/pages", layout["pages"])
+            stats.set_value(f"layouts/{layout['layout']}/ms_per_page", layout["ms_per_page"])
+            self.log(
+                f"layout {layout['layout']}: {layout['pages']} pages, {layout['ms_per_page']} ms per page, "
+                f"{len(layout['ranges'])} capture ranges"
+            )
+        self.log(f"layouts probed on {self.layouts.probed} pages, known for {self.layouts.cached}")
+
+        Path(LAYOUTS_REPORT_FILENAME).parent.mkdir(parents=True, exist_ok=True)
+        with open(LAYOUTS_REPORT_FILENAME, "wb") as f:
+            f.write(dumps_bytes(report, indent=4))
 
     def get_real_info(
         self, response: scrapy.http.Response
     ) -> T.Dict[str, str]:
-        real_url = response.url
+        real_url = strip_snapshot_modifier(response.url)
         return {
             "real_url": real_url,
             "real_timestamp": extract_webarchive_date(real_url),
         }
 
     @staticmethod
-    def get_title(topic: scrapy.Selector):
+    def get_title(topic: scrapy.Selector) -> T.Tuple[str, str]:
         title_div: scrapy.Selector = topic.css("div.f-topic_title")
         if title_div:
             title: str = title_div.css("a::text").get()
-            full_url: str = title_div.css("a").attrib["href"]
+            href: str = title_div.css("a").attrib["href"]
         else:
             title_a: scrapy.Selector = topic.css("a.f-topic_title")
             title: str = title_a.css(":scope::text").get()
-            full_url: str = title_a.attrib["href"]
-        
-        no_prefix = full_url.removeprefix("/web/")
-        snapshot_timestamp, orig_url = no_prefix.split("/", maxsplit=1)
-        # snapshot_time = convert_snapshot_timestamp(snapshot_timestamp)
-        # self.log(f"{no_prefix}, {snapshot_timestamp}, {orig_url}, {snapshot_time}")
+            href: str = title_a.attrib["href"]
 
         title = safe_strip(title)
-        return title, full_url, orig_url
+        return title, href
 
     @staticmethod
     def get_author(topic: scrapy.Selector) -> str:
@@ -222,11 +461,11 @@ class TopicsSpider(scrapy.Spider):
     def get_num_messages_last_update(topic: scrapy.Selector) -> int:
         num_messages = safe_strip(topic.css("div.f-topic_replies::text").get())
         if not num_messages:
-            num_messages = topic.css("f-topic_footer_comments::text").get()
+            num_messages = topic.css(".f-topic_footer_comments::text").get()
         
         last_update_timestamp = safe_strip(topic.css("div.f-topic_update span::text").get())
         if not last_update_timestamp:
-            last_update_timestamp = topic.css("f-topic_footer_update::text").get()
+            last_update_timestamp = topic.css(".f-topic_footer_update::text").get()
 
         return (
             # TODO: do we cover above all the cases where number of replies could occur
@@ -235,47 +474,90 @@ class TopicsSpider(scrapy.Spider):
             safe_strip(last_update_timestamp)
         )
 
+    @classmethod
+    def parse_row(cls, topic: scrapy.Selector) -> RowFields:
+        """Fields of a row of no known layout, with the selectors of all of them"""
+        title, href = cls.get_title(topic)
+        return (title, href, cls.get_author(topic), *cls.get_num_messages_last_update(topic))
+
+    @staticmethod
+    def make_item_template(meta: WebArchiveMetaItem) -> T.Dict[str, T.Any]:
+        """Item of the record with the topic fields yet to be set, copied for every topic"""
+        template = dict.fromkeys(TOPIC_FIELDS)
+        for key, val in meta.items():
+            template[key if key.startswith("forum") else f"forum_{key}"] = val
+        return template
+
     def parse(
-        self, response: scrapy.http.Response, **meta
+        self, response: scrapy.http.Response, metas: T.List[WebArchiveMetaItem], late: bool = False
     ) -> T.Generator[TopicMetaFull, None, None]:
-        for topic in response.css("div.f-topics div.f-topic"):
-            real_meta = self.get_real_info(response)
-            meta.update(real_meta)
-
-            title, full_url, orig_url = self.get_title(topic)
-
-            num_messages, last_update_timestamp = self.get_num_messages_last_update(topic)
-            if last_update_timestamp:
-                # last_update = RuDatePipeline.parse_date(last_update_timestamp)
-                last_update = convert_customary_to_datetime(last_update_timestamp, real_meta["real_timestamp"])
-            else:
-                last_update = None
-
-            # if "page" not in meta:
-            #     meta["page"] = 1
-            #     self.forum2pages[meta["forum_name"]] = 1
-
-            res = {
-                "topic_title": title,
-                "topic_url": f"{WEB_ARCHIVE_DOMAIN}{full_url}",
-                "topic_orig_url": orig_url,
-                "topic_author": safe_strip(self.get_author(topic)) or None,
-                "topic_num_messages": num_messages,
-                "topic_last_update": last_update,
-                # "forum_snapshot_time": snapshot_time,
-                **{(f"forum_{key}" if not key.startswith("forum") else key): val
-                   for key, val in meta.items()},
-                # **real_meta
-            }
+        """Parse the capture once, then fan the topics out to every record of it"""
+        if self.input_queue is not None:
+            # records that come from now on need another request
+            snapshot_url = response.meta["snapshot_url"]
+            self.chained_url2metas.pop(snapshot_url, None)
+            self.chained_parsed.add(snapshot_url)
+
+        rows = list(self.iter_topic_rows(response, *self.get_layout(response)))
+        if self.cover:
+            new_topics = self.planner.observe(
+                response.meta["snapshot_url"], (orig_url for _, _, orig_url, *_ in rows)
+            )
+            self.log(f"{response.meta['snapshot_url']}: {new_topics} new of {len(rows)} topics")
+
+        real_info = self.get_real_info(response)
+        for i, meta in enumerate(metas):
+            meta.update(real_info)
+            template = self.make_item_template(meta)
+
+            for row in rows:
+                item = template.copy()
+                item.update(zip(TOPIC_FIELDS, row))
+                if i == 0 and not late:
+                    # records of the same capture are the same sightings
+                    self.topic_index.record(item)
+                yield item
+
+    def parse_topics(
+        self, response: scrapy.http.Response
+    ) -> T.Generator[T.Dict[str, T.Any], None, None]:
+        for row in self.iter_topic_rows(response, *self.get_layout(response)):
+            yield dict(zip(TOPIC_FIELDS, row))
+
+    def get_layout(self, response: scrapy.http.Response) -> T.Tuple[T.List[T.Any], T.Optional[ListingLayout]]:
+        """Topic rows of the listing and their layout, looked up once per response"""
+        topics = self.layouts.find_rows(response.selector.root)
+        return topics, self.layouts.get(topics, response.url)
+
+    def iter_topic_rows(
+        self, response: scrapy.http.Response, topics: T.List[T.Any], layout: T.Optional[ListingLayout]
+    ) -> T.Generator[TopicRow, None, None]:
+        """Values of `TOPIC_FIELDS` of every topic on the listing, of the rows and layout of `get_layout`"""
+        started = time.perf_counter()
+        if layout is not None:
+            parse_row = layout.parse_row
+        else:
+            topics = response.css("div.f-topics div.f-topic")
+            parse_row = self.parse_row
+
+        rows = [parse_row(topic) for topic in topics]
+        # relative dates of all rows are counted from the capture time
+        last_updates = convert_customary_dates(
+            (last_update_timestamp for *_, last_update_timestamp in rows),
+            self.get_real_info(response)["real_timestamp"],
+        )
+        page_url = response.url
+        for (title, href, author, num_messages, _), last_update in zip(rows, last_updates):
+            topic_url, orig_url = resolve_snapshot_link(page_url, href)
+            yield title, topic_url, orig_url, safe_strip(author) or None, num_messages, last_update
 
-            # self.log(res)
-            yield res
+        self.layouts.record(layout, time.perf_counter() - started)
 
         # pager = response.css("div#paging ul")
         # next_page = pager.css("li.yui-pagination_page--active + li a::attr(href)").get()
         # self.log(f"next page is: ({type(next_page)}) {next_page}")
         # next_page_url = response.urljoin(next_page)
-        # next_page: PaginationParseResult = self.pagination_parser.parse(response)
+        # next_page: PaginationParseResult = self.pagination_parser.parse(response, layout)
         # next_page_url = next_page["result"]
         # self.log(f"next page is: ({type(next_page_url)}) {next_page_url}")
         
@@ -0,0 +1,382 @@
+import typing as T
+from datetime import datetime
+from pathlib import Path
+import sqlite3
+
+from webtexts import serialization
+from forum_ykt.items import Snapshot, WebArchiveMetaItem, TopicSighting, TopicItem
+from forum_ykt.utils import convert_snapshot_timestamp, normalize_topic_url, in_shard
+
+
+ForumStylePage = T.Tuple[int, str, int]
+
+
+class SqliteStore:
+    """Base for the on-disk stores shared between crawls and stages"""
+
+    schema: str = ""
+
+    def __init__(self, path: T.Union[str, Path], commit_every: int = 100) -> None:
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+
+        self.connection = sqlite3.connect(self.path)
+        self.connection.row_factory = sqlite3.Row
+        # readers of other stages can query while a crawl writes
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.executescript(self.schema)
+
+        self.commit_every = commit_every
+        self.uncommitted = 0
+
+    def written(self) -> None:
+        self.uncommitted += 1
+        if self.uncommitted >= self.commit_every:
+            self.commit()
+
+    def commit(self) -> None:
+        self.connection.commit()
+        self.uncommitted = 0
+
+    def close(self) -> None:
+        self.commit()
+        self.connection.close()
+
+
+class SnapshotIndex(SqliteStore):
+    """Closest snapshots found for every (forum_id, style, page, query_date)
+
+    `snapshot_time` is NULL for queries that webarchive had nothing for.
+    """
+
+    schema = """
+        CREATE TABLE IF NOT EXISTS snapshots (
+            forum_id INTEGER NOT NULL,
+            forum_style TEXT NOT NULL,
+            page INTEGER NOT NULL,
+            query_date TEXT NOT NULL,
+            forum_name TEXT NOT NULL,
+            orig_url TEXT NOT NULL,
+            snapshot_time TEXT,
+            status TEXT,
+            url TEXT,
+            timestamp TEXT,
+            PRIMARY KEY (forum_id, forum_style, page, query_date)
+        );
+        CREATE INDEX IF NOT EXISTS snapshots_by_url ON snapshots (url);
+    """
+
+    def record(self, meta: WebArchiveMetaItem) -> None:
+        available = meta.get("available", False)
+        self.connection.execute(
+            "INSERT OR REPLACE INTO snapshots VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (
+                meta["forum_id"], meta["forum_style"], meta["page"],
+                meta["query_date"].isoformat(), meta["forum_name"], meta["orig_url"],
+                meta["real_date"].isoformat() if available else None,
+                meta.get("status"), meta.get("url"), meta.get("timestamp"),
+            )
+        )
+        self.written()
+
+    @staticmethod
+    def row_to_snapshot(row: sqlite3.Row) -> T.Optional[Snapshot]:
+        if row["snapshot_time"] is None:
+            return None
+        return {
+            "status": row["status"],
+            "available": True,
+            "url": row["url"],
+            "timestamp": row["timestamp"],
+        }
+
+    def answers(self, key: ForumStylePage) -> T.Dict[datetime, T.Optional[Snapshot]]:
+        """Known answers for the key by query date"""
+        rows = self.connection.execute(
+            "SELECT * FROM snapshots WHERE forum_id = ? AND forum_style = ? AND page = ?",
+            key,
+        )
+        return {
+            datetime.fromisoformat(row["query_date"]): self.row_to_snapshot(row)
+            for row in rows
+        }
+
+    def row_to_meta(self, row: sqlite3.Row) -> WebArchiveMetaItem:
+        meta = {
+            "forum_name": row["forum_name"],
+            "forum_style": row["forum_style"],
+            "forum_id": row["forum_id"],
+            "page": row["page"],
+            "query_date": datetime.fromisoformat(row["query_date"]),
+            "orig_url": row["orig_url"],
+        }
+        snapshot = self.row_to_snapshot(row)
+        if snapshot:
+            meta.update(snapshot)
+            meta["real_date"] = convert_snapshot_timestamp(snapshot["timestamp"])
+        else:
+            meta["available"] = False
+        return meta
+
+    def iter_metas(
+        self, available_only: bool = True, forum_ids: T.Optional[T.Iterable[int]] = None
+    ) -> T.Generator[WebArchiveMetaItem, None, None]:
+        """Records as in the forums feed, ordered by snapshot url"""
+        query = "SELECT * FROM snapshots"
+        conditions, params = [], []
+        if available_only:
+            conditions.append("snapshot_time IS NOT NULL")
+        if forum_ids is not None:
+            forum_ids = list(forum_ids)
+            conditions.append(f"forum_id IN ({', '.join('?' * len(forum_ids))})")
+            params.extend(forum_ids)
+        if conditions:
+            query += " WHERE " + " AND ".join(conditions)
+        query += " ORDER BY url, forum_id, forum_style, page, query_date DESC"
+
+        # a separate cursor, so that the crawl can keep writing meanwhile
+        for row in self.connection.cursor().execute(query, params):
+            yield self.row_to_meta(row)
+
+    def merge(self, path: T.Union[str, Path]) -> None:
+        """Add the answers of another index (of a crawl shard)"""
+        self.commit()
+        self.connection.execute("ATTACH DATABASE ? AS other", (str(path),))
+        self.connection.execute("INSERT OR REPLACE INTO snapshots SELECT * FROM other.snapshots")
+        self.commit()
+        self.connection.execute("DETACH DATABASE other")
+
+    def __len__(self) -> int:
+        return self.connection.execute("SELECT COUNT(*) FROM snapshots").fetchone()[0]
+
+
+class TopicIndex(SqliteStore):
+    """Topics seen on listing snapshots, keyed by their normalized original url.
+
+    Every sighting is kept, while `topics` holds the item of the canonical
+    one: with the most messages, then the latest update, then the latest
+    listing snapshot, which likely links to the fullest capture of the topic.
+    """
+
+    schema = """
+        CREATE TABLE IF NOT EXISTS topic_sightings (
+            topic_key TEXT NOT NULL,
+            listing_url TEXT NOT NULL,
+            snapshot_time TEXT,
+            topic_url TEXT NOT NULL,
+            num_messages INTEGER NOT NULL,
+            last_update TEXT,
+            PRIMARY KEY (topic_key, listing_url)
+        );
+        CREATE TABLE IF NOT EXISTS topics (
+            topic_key TEXT PRIMARY KEY,
+            topic_url TEXT NOT NULL,
+            num_messages INTEGER NOT NULL,
+            last_update TEXT NOT NULL,
+            snapshot_time TEXT NOT NULL,
+            item TEXT NOT NULL
+        );
+    """
+
+    # ISO strings compare as the dates do, missing ones as ""
+    keep_canonical = """
+        ON CONFLICT (topic_key) DO UPDATE SET
+            topic_url = excluded.topic_url, num_messages = excluded.num_messages,
+            last_update = excluded.last_update, snapshot_time = excluded.snapshot_time,
+            item = excluded.item
+        WHERE (excluded.num_messages, excluded.last_update, excluded.snapshot_time)
+            > (topics.num_messages, topics.last_update, topics.snapshot_time)
+    """
+
+    @staticmethod
+    def to_sighting(item: T.Dict[str, T.Any]) -> TopicSighting:
+        last_update = item.get("topic_last_update")
+        return {
+            "topic_key": normalize_topic_url(item["topic_orig_url"]),
+            "listing_url": item["forum_real_url"],
+            "snapshot_time": item["forum_real_timestamp"],
+            "topic_url": item["topic_url"],
+            "num_messages": item["topic_num_messages"],
+            "last_update": last_update if isinstance(last_update, datetime) else None,
+        }
+
+    def record(self, item: T.Dict[str, T.Any]) -> None:
+        sighting = self.to_sighting(item)
+        snapshot_time = sighting["snapshot_time"].isoformat() if sighting["snapshot_time"] else ""
+        last_update = sighting["last_update"].isoformat() if sighting["last_update"] else ""
+
+        self.connection.execute(
+            "INSERT OR REPLACE INTO topic_sightings VALUES (?, ?, ?, ?, ?, ?)",
+            (
+                sighting["topic_key"], sighting["listing_url"], snapshot_time or None,
+                sighting["topic_url"], sighting["num_messages"], last_update or None,
+            )
+        )
+        self.connection.execute(
+            "INSERT INTO topics VALUES (?, ?, ?, ?, ?, ?)" + self.keep_canonical,
+            (
+                sighting["topic_key"], sighting["topic_url"], sighting["num_messages"],
+                last_update, snapshot_time, serialization.dumps(item),
+            )
+        )
+        self.written()
+
+    def merge(self, path: T.Union[str, Path]) -> None:
+        """Add the sightings of another index (of a crawl shard), keeping the canonical topics"""
+        self.commit()
+        self.connection.execute("ATTACH DATABASE ? AS other", (str(path),))
+        self.connection.execute("INSERT OR REPLACE INTO topic_sightings SELECT * FROM other.topic_sightings")
+        # `WHERE true` tells the upsert clause from a join
+        self.connection.execute("INSERT INTO topics SELECT * FROM other.topics WHERE true" + self.keep_canonical)
+        self.commit()
+        self.connection.execute("DETACH DATABASE other")
+
+    def __len__(self) -> int:
+        return self.connection.execute("SELECT COUNT(*) FROM topics").fetchone()[0]
+
+    def sightings(self, topic_key: str) -> T.List[TopicSighting]:
+        rows = self.connection.execute(
+            "SELECT * FROM topic_sightings WHERE topic_key = ? ORDER BY snapshot_time", (topic_key,)
+        )
+        return [
+            {
+                **dict(row),
+                "snapshot_time": datetime.fromisoformat(row["snapshot_time"]) if row["snapshot_time"] else None,
+                "last_update": datetime.fromisoformat(row["last_update"]) if row["last_update"] else None,
+            }
+            for row in rows
+        ]
+
+    def iter_canonical(self) -> T.Generator[T.Dict[str, T.Any], None, None]:
+        """Item of the canonical sighting of every topic, as in the topics feed"""
+        for row in self.connection.cursor().execute("SELECT topic_key, item FROM topics ORDER BY topic_key"):
+            yield {**serialization.loads(row["item"]), "topic_key": row["topic_key"]}
+
+
+class ProgressStore(SqliteStore):
+    """Topics of the replies spider whose items are all written, with their item counts"""
+
+    schema = """
+        CREATE TABLE IF NOT EXISTS finished_topics (
+            topic_key TEXT PRIMARY KEY,
+            topic_url TEXT NOT NULL,
+            num_items INTEGER NOT NULL,
+            finished_at TEXT NOT NULL
+        );
+    """
+
+    def mark_finished(self, topic_key: str, topic_url: str, num_items: int) -> None:
+        self.connection.execute(
+            "INSERT OR REPLACE INTO finished_topics VALUES (?, ?, ?, ?)",
+            (topic_key, topic_url, num_items, datetime.now().isoformat()),
+        )
+        self.written()
+
+    def finished_keys(self) -> T.Set[str]:
+        return {row["topic_key"] for row in self.connection.execute("SELECT topic_key FROM finished_topics")}
+
+    def __contains__(self, topic_key: str) -> bool:
+        return self.connection.execute(
+            "SELECT 1 FROM finished_topics WHERE topic_key = ?", (topic_key,)
+        ).fetchone() is not None
+
+    def __len__(self) -> int:
+        return self.connection.execute("SELECT COUNT(*) FROM finished_topics").fetchone()[0]
+
+
+
+class RepliesStore(SqliteStore):
+    """Replies of crawled topics by reply key, with the listing counts each topic was last crawled for.
+
+    Refreshes compare the counts of the latest listing crawl with `topics`
+    and merge the replies of the topics that changed into `replies`, where
+    a reply seen again replaces its earlier version.
+    """
+
+    schema = """
+        CREATE TABLE IF NOT EXISTS topics (
+            topic_key TEXT PRIMARY KEY,
+            topic_url TEXT NOT NULL,
+            num_messages INTEGER NOT NULL,
+            last_update TEXT NOT NULL,
+            num_replies INTEGER NOT NULL,
+            crawled_at TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS replies (
+            topic_key TEXT NOT NULL,
+            reply_key TEXT NOT NULL,
+            reply TEXT NOT NULL,
+            PRIMARY KEY (topic_key, reply_key)
+        );
+    """
+
+    def topic_states(self) -> T.Dict[str, T.Tuple[int, str]]:
+        """`num_messages` and `last_update` (ISO, "" if unknown) of every stored topic"""
+        rows = self.connection.execute("SELECT topic_key, num_messages, last_update FROM topics")
+        return {row["topic_key"]: (row["num_messages"], row["last_update"]) for row in rows}
+
+    def add_replies(self, topic_key: str, replies: T.Iterable[T.Tuple[str, TopicItem]]) -> None:
+        """Upsert `(reply_key, reply)` pairs, the stored order of replies seen before is kept"""
+        self.connection.executemany(
+            "INSERT INTO replies VALUES (?, ?, ?)"
+            " ON CONFLICT (topic_key, reply_key) DO UPDATE SET reply = excluded.reply",
+            ((topic_key, reply_key, serialization.dumps(reply)) for reply_key, reply in replies),
+        )
+        self.written()
+
+    def record_topic(
+        self, topic_key: str, topic_url: str, num_messages: int, last_update: T.Optional[datetime]
+    ) -> int:
+        """Listing counts the topic was crawled for, returns the number of its stored replies"""
+        num_replies = self.connection.execute(
+            "SELECT COUNT(*) FROM replies WHERE topic_key = ?", (topic_key,)
+        ).fetchone()[0]
+        self.connection.execute(
+            "INSERT OR REPLACE INTO topics VALUES (?, ?, ?, ?, ?, ?)",
+            (
+                topic_key, topic_url, num_messages, last_update.isoformat() if last_update else "",
+                num_replies, datetime.now().isoformat(),
+            )
+        )
+        self.written()
+        return num_replies
+
+    def merge(self, path: T.Union[str, Path]) -> None:
+        """Add the topics and replies of another store (of a crawl shard), replacing the ones it has too"""
+        self.commit()
+        self.connection.execute("ATTACH DATABASE ? AS other", (str(path),))
+        self.connection.execute("INSERT OR REPLACE INTO topics SELECT * FROM other.topics")
+        # `WHERE true` tells the upsert clause from a join
+        self.connection.execute(
+            "INSERT INTO replies SELECT * FROM other.replies WHERE true ORDER BY rowid"
+            " ON CONFLICT (topic_key, reply_key) DO UPDATE SET reply = excluded.reply"
+        )
+        self.commit()
+        self.connection.execute("DETACH DATABASE other")
+
+    def split(self, path: T.Union[str, Path], shard_index: int, shard_count: int) -> None:
+        """Copy the topics of a crawl shard (by `in_shard` of their key) with their replies to a new store"""
+        RepliesStore(path).close()
+        self.commit()
+        self.connection.create_function("in_shard", 3, in_shard, deterministic=True)
+        self.connection.execute("ATTACH DATABASE ? AS other", (str(path),))
+        self.connection.execute(
+            "INSERT INTO other.topics SELECT * FROM topics WHERE in_shard(topic_key, ?, ?)",
+            (shard_index, shard_count),
+        )
+        self.connection.execute(
+            "INSERT INTO other.replies SELECT * FROM replies WHERE in_shard(topic_key, ?, ?) ORDER BY rowid",
+            (shard_index, shard_count),
+        )
+        self.commit()
+        self.connection.execute("DETACH DATABASE other")
+
+    def replies(self, topic_key: str) -> T.List[TopicItem]:
+        """Stored replies of the topic, in the order they were first seen"""
+        rows = self.connection.execute(
+            "SELECT reply FROM replies WHERE topic_key = ? ORDER BY rowid", (topic_key,)
+        )
+        return [serialization.loads(row["reply"], date_keys=("date",)) for row in rows]
+
+    def __len__(self) -> int:
+        return self.connection.execute("SELECT COUNT(*) FROM topics").fetchone()[0]
@@ -1,7 +1,17 @@
 import typing as T
-from datetime import datetime
+from datetime import date, datetime, timedelta
+from functools import lru_cache
+import gzip
+import heapq
+import io
+from itertools import chain
+import json
+from pathlib import Path
 import re
-from urllib.parse import urlparse, quote as encode_url
+from urllib.parse import urlparse, urlunparse, parse_qsl, urlencode, quote as encode_url
+import zlib
+
+from webtexts import serialization
 
 try:
     from tqdm.auto import tqdm
@@ -9,6 +19,12 @@ try:
 except ImportError:
     def tqdm(iter: T.Iterable[T.Any], *args, **kwargs):
         return iter
+
+try:
+    import zstandard
+    ZSTANDARD_AVAILABLE = True
+except ImportError:
+    ZSTANDARD_AVAILABLE = False
     
 
 
@@ -58,70 +74,96 @@ months = {
 }
 
 
+# "вчера, 12:30", "5 мая 2015 12:30", "5 мая 12:30", "5 мая 2015", "5 мая", "12:30"
+CUSTOMARY_DATE_PATTERN = re.compile(
+    r"""
+    \s*
+    (?:
+        (?P<close_day>[Вв]чера|[Сс]егодня)
+        | (?P<day>\d{1,2})\s+(?P<month>[а-яёА-ЯЁ]+)\.?(?:\s+(?P<year>\d{4}))?
+    )?
+    (?:,?\s*(?:в\s+)?(?P<hour>\d{1,2}):(?P<minute>\d{2}))?
+    \s*
+    """,
+    # case is spelled out, as IGNORECASE makes matching Cyrillic slower
+    re.VERBOSE,
+)
+CLOSE_DAY_OFFSETS = {"вчера": 1, "сегодня": 0}
+
+# days before today (for "вчера", "сегодня" and times only), or year (None for
+# the last 12 months), month and day, then hour and minute
+CustomaryDate = T.Tuple[T.Optional[int], T.Optional[int], T.Optional[int], T.Optional[int], int, int]
+
+
 def ru_month_to_int(ru_month: str) -> int:
-    return months[ru_month[:3]]
+    return months[ru_month[:3].lower()]
 
 
-def convert_time_str(time_str: str) -> T.Tuple[int, int, int]:
-    time_sep = ":"
-    if time_sep in time_str:
-        parts = time_str.split(time_sep)
-        if len(parts) == 2:
-            hour, minute = map(int, parts)
-            return hour, minute, 0
+# The pattern is for correctness ("вчера" on the first of a month, dates of
+# 4 parts, "сегодня"), a match costs more than splitting did: only dates seen
+# again, as on several captures of a listing a day, get cheaper, by the caches
+@lru_cache(maxsize=2 ** 14)
+def parse_customary_date(time: str) -> T.Optional[CustomaryDate]:
+    """Parts of a date as the forum shows it, the same whatever day it is seen on"""
+    match = CUSTOMARY_DATE_PATTERN.fullmatch(time)
+    if match is None:
+        return None
+    close_day, day, month, year, hour, minute = match.groups()
+    hour_minute = (int(hour), int(minute)) if hour else (0, 0)
+
+    if day is not None:
+        month = months.get(month[:3].lower())
+        if month is None:
+            return None
+        return (None, int(year) if year else None, month, int(day), *hour_minute)
+    if close_day is not None:
+        return (CLOSE_DAY_OFFSETS[close_day.lower()], None, None, None, *hour_minute)
+    if hour is not None:
+        return (0, None, None, None, *hour_minute)
+    return None
 
-    raise ValueError(f"unknown pattern for time with time_sep=`{time_sep}`: {time_str}")
 
+@lru_cache(maxsize=2 ** 14)
+def convert_customary_date(time: str, today: T.Optional[date]) -> T.Union[datetime, str]:
+    """`convert_customary_to_datetime` relative to a day, which keeps the cache small"""
+    parts = parse_customary_date(time)
+    if parts is None:
+        return f"<{time}>"
+    days_before, year, month, day, hour, minute = parts
 
-def convert_customary_to_datetime(time: str, today: datetime) -> T.Union[datetime, str]:
-    close_day_sep = ", "
-    if close_day_sep in time:
-        close_day, time_str = time.split(close_day_sep)
+    if days_before is not None:
+        if today is None:
+            return f"<{time}>"
+        if days_before:
+            today = today - timedelta(days=days_before)
+        year, month, day = today.year, today.month, today.day
+    elif year is None:
+        if today is None:
+            return f"<{time}>"
+        # dates without a year are of the last 12 months
+        year = today.year - ((month, day) > (today.month, today.day))
 
-        if close_day.lower() == "вчера":
-            day = today.day - 1
-            hour, minute, second = convert_time_str(time_str)
-            return datetime(today.year, today.month, day, hour, minute, second)
-    
-    date_sep = " "
-    time_sep = ":"
-    if date_sep in time:
-        parts = time.split(date_sep)
-        if len(parts) == 4:
-            day, month, year, time_str = parts
-
-            day = int(day)
-            month = ru_month_to_int(month)
-            year = int(year)
-            hour, minute, second = convert_time_str(time_str)
-            return datetime(today.year, today.month, today.day, hour, minute, second)
-        elif len(parts) == 3:
-            day, month, year_or_time = parts
-
-            day = int(day)
-            month = ru_month_to_int(month)
-            if time_sep in year_or_time:
-                hour, minute, second = convert_time_str(year_or_time)
-                return datetime(today.year, month, day, hour, minute, second)
-            else:
-                year = int(year_or_time)
-                return datetime(year, month, day)
-        elif len(parts) == 2:
-            day, month = parts
-            
-            day = int(day)
-            month = ru_month_to_int(month)
-            year = today.year
-        else:
-            raise ValueError(f"unknown pattern with date_sep=`{date_sep}`: {time}")
+    try:
+        return datetime(year, month, day, hour, minute)
+    except ValueError:
+        # a day or time that doesn't exist
+        return f"<{time}>"
 
-        return datetime(year, month, day)
-    
-    if time_sep in time:
-        hour, minute, second = convert_time_str(time)
-        return datetime(today.year, today.month, today.day, hour, minute, second)
 
-    return f"<{time}>"
+def convert_customary_to_datetime(time: str, today: T.Optional[datetime]) -> T.Union[datetime, str]:
+    """Datetime of a date as the forum shows it, counted from `today` (the capture time) if relative.
+
+    Strings that are not such dates come back in angle brackets.
+    """
+    return convert_customary_date(time, today.date() if today is not None else None)
+
+
+def convert_customary_dates(
+    times: T.Iterable[T.Optional[str]], today: T.Optional[datetime]
+) -> T.List[T.Union[datetime, str, None]]:
+    """`convert_customary_to_datetime` of all `times` of a page, None for the missing ones"""
+    today_date = today.date() if today is not None else None
+    return [convert_customary_date(time, today_date) if time else None for time in times]
 
 
 def extract_webarchive_date(
@@ -143,4 +185,163 @@ def extract_query(url: str) -> T.Dict[str, T.List[str]]:
         key, val = part.split("=")
         query.setdefault(key, []).append(val)
 
-    return query
\ No newline at end of file
+    return query
+
+
+def normalize_topic_url(url: str) -> str:
+    """The same topic regardless of scheme, `www.`, extra query parameters and fragment"""
+    parsed = urlparse(url.strip())
+    host = parsed.netloc.lower().removeprefix("www.")
+    query = urlencode(sorted(
+        (key, val) for key, val in parse_qsl(parsed.query) if key == "id"
+    ))
+    return urlunparse(("https", host, parsed.path.split(";")[0], "", query, ""))
+
+
+def in_shard(key: str, shard_index: int, shard_count: int) -> bool:
+    """Whether `key` belongs to the shard, the same way in every process and run"""
+    return shard_count <= 1 or zlib.crc32(key.encode("utf-8")) % shard_count == shard_index
+
+
+def iter_by_priority(
+    items: T.Iterable[T.Any], key: T.Callable[[T.Any], float], window: int = 0
+) -> T.Generator[T.Any, None, None]:
+    """Items with the highest `key` first, among the next `window` items (all of them if 0).
+
+    Items of equal `key` keep their order.
+    """
+    heap: T.List[T.Tuple[float, int, T.Any]] = []
+    for i, item in enumerate(items):
+        heapq.heappush(heap, (-key(item), i, item))
+        if window and len(heap) >= window:
+            yield heapq.heappop(heap)[2]
+    while heap:
+        yield heapq.heappop(heap)[2]
+
+
+def regroup_topics(items: T.Iterable[T.Dict[str, T.Any]]) -> T.Generator[T.Dict[str, T.Any], None, None]:
+    """Topics with their `replies` list again, from the header and reply items of `-a items=replies`.
+
+    Replies keep their order (`head_id` and `parent_id` still give the tree), other items pass through.
+    A repeated header starts its topic over, dropping what a crashed crawl left of it in finished shards.
+    """
+    key2topic: T.Dict[str, T.Dict[str, T.Any]] = {}
+    for item in items:
+        item_type = item.get("item_type")
+        if item_type == "topic":
+            topic = key2topic[item["topic_key"]] = {"replies": []}
+            topic.update((key, val) for key, val in item.items() if key not in ("item_type", "replies"))
+        elif item_type == "reply":
+            topic = key2topic.setdefault(item["topic_key"], {"replies": []})
+            topic["replies"].append({
+                key: val for key, val in item.items() if key not in ("item_type", "topic_key")
+            })
+        else:
+            yield item
+
+    # replies are moved to the end, as in the items of a whole topic
+    for topic in key2topic.values():
+        topic["replies"] = topic.pop("replies")
+        yield topic
+
+
+def iter_json_array(
+    f: T.TextIO, chunk_size: int = 1 << 16, buffer: str = ""
+) -> T.Generator[T.Any, None, None]:
+    """Yield elements of a JSON array one by one, reading `f` in chunks
+
+    `buffer` is the beginning of the array already read from `f`.
+    """
+    decoder = json.JSONDecoder()
+    pos, eof = 0, False
+
+    def read_more() -> None:
+        nonlocal buffer, pos, eof
+        # at least double the pending part, so that large elements are not re-parsed too often
+        chunk = f.read(max(chunk_size, len(buffer) - pos))
+        eof = not chunk
+        buffer, pos = buffer[pos:] + chunk, 0
+
+    started = False
+    while True:
+        while pos < len(buffer) and buffer[pos] in " \t\r\n,":
+            pos += 1
+        if pos == len(buffer):
+            if eof:
+                raise ValueError("unexpected end of JSON array")
+            read_more()
+            continue
+
+        if not started:
+            if buffer[pos] != "[":
+                raise ValueError(f"expected a JSON array, got {buffer[pos]!r}")
+            started, pos = True, pos + 1
+            continue
+        if buffer[pos] == "]":
+            return
+
+        try:
+            element, end = decoder.raw_decode(buffer, pos)
+        except json.JSONDecodeError:
+            if eof:
+                raise
+            read_more()
+            continue
+        if end == len(buffer) and not eof:
+            # a number could go on in the next chunk
+            read_more()
+            continue
+
+        yield element
+        pos = end
+
+
+def iter_json_lines(lines: T.Iterable[str]) -> T.Generator[T.Any, None, None]:
+    for line in lines:
+        if line.strip():
+            yield serialization.loads(line)
+
+
+def open_text(path: T.Union[str, Path]) -> T.TextIO:
+    path = Path(path)
+    if path.suffix == ".gz":
+        return gzip.open(path, "rt", encoding="utf-8")
+    if path.suffix == ".zst":
+        if not ZSTANDARD_AVAILABLE:
+            raise ImportError(f"reading {path} needs the `zstandard` package")
+        return io.TextIOWrapper(zstandard.ZstdDecompressor().stream_reader(open(path, "rb")), encoding="utf-8")
+    return open(path, "r", encoding="utf-8")
+
+
+def iter_finished_shards(directory: T.Union[str, Path]) -> T.List[Path]:
+    """Shards written by `ShardedJsonLinesPipeline` so far, without the unfinished `.part` one"""
+    return sorted(path for path in Path(directory).glob("part-*") if path.suffix != ".part")
+
+
+# characters read to tell a JSON array from JSON Lines
+PEEK_SIZE = 1024
+
+
+def iter_json_records(path: T.Union[str, Path]) -> T.Generator[T.Any, None, None]:
+    """Records of a feed without loading it whole.
+
+    The feed is either a JSON array, JSON Lines (possibly gzip or zstd
+    compressed) or a directory of such shards, of which the finished ones are read.
+    """
+    if Path(path).is_dir():
+        for shard_path in iter_finished_shards(path):
+            yield from iter_json_records(shard_path)
+        return
+
+    with open_text(path) as f:
+        # not `readline`, as a compact JSON array is a single line
+        head = f.read(PEEK_SIZE)
+        while head and not head.strip():
+            head = f.read(PEEK_SIZE)
+        head = head.lstrip()
+
+        if head.startswith("["):
+            yield from iter_json_array(f, buffer=head)
+        else:
+            # the peeked part can hold several lines, and the last of them only partly
+            yield from iter_json_lines(chain((head + f.readline()).split("\n"), f))
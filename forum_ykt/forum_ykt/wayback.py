@@ -0,0 +1,163 @@
+import typing as T
+from bisect import bisect_left
+from datetime import datetime
+import re
+from urllib.parse import urlencode, urljoin, urlparse, parse_qs
+
+from forum_ykt.spiders import WEB_ARCHIVE_DOMAIN
+from forum_ykt.items import CdxCapture
+from forum_ykt.utils import convert_snapshot_timestamp
+
+
+CDX_LINK = f"{WEB_ARCHIVE_DOMAIN}/cdx/search/cdx?"
+CDX_FIELDS = ("original", "timestamp", "statuscode")
+CDX_PAGE_LIMIT = 50_000
+
+# statuses which the availability API reports as a `closest` snapshot
+AVAILABLE_STATUSES = ("200",)
+
+# `<timestamp>id_` serves the original bytes, without the toolbar and rewritten links
+RAW_MODIFIER = "id_"
+SNAPSHOT_URL_PATTERN = re.compile(
+    r"^(?:(?:https?:)?//web\.archive\.org)?/web/(?P<timestamp>\d{1,14})(?P<modifier>[a-z]{2}_)?/(?P<orig_url>.+)$"
+)
+
+
+def make_snapshot_url(timestamp: str, orig_url: str) -> str:
+    return f"{WEB_ARCHIVE_DOMAIN}/web/{timestamp}/{orig_url}"
+
+
+def split_snapshot_url(url: str) -> T.Optional[T.Tuple[str, str]]:
+    """Timestamp (without modifier) and original url of a snapshot url"""
+    match = SNAPSHOT_URL_PATTERN.match(url)
+    if not match:
+        return None
+    return match["timestamp"], match["orig_url"]
+
+
+def make_raw_snapshot_url(url: str) -> str:
+    split = split_snapshot_url(url)
+    if not split:
+        return url
+    timestamp, orig_url = split
+    return make_snapshot_url(f"{timestamp}{RAW_MODIFIER}", orig_url)
+
+
+def strip_snapshot_modifier(url: str) -> str:
+    split = split_snapshot_url(url)
+    return make_snapshot_url(*split) if split else url
+
+
+def resolve_snapshot_link(page_url: str, href: str) -> T.Tuple[str, str]:
+    """Snapshot url and original url of a link found on the snapshot at `page_url`
+
+    Links are either rewritten by webarchive (`/web/<ts>/<orig_url>`) or, on
+    raw pages, left as on the original site and resolved against its url.
+    """
+    split = split_snapshot_url(href)
+    if split is None:
+        timestamp, page_orig_url = split_snapshot_url(page_url)
+        split = timestamp, urljoin(page_orig_url, href)
+
+    timestamp, orig_url = split
+    return make_snapshot_url(timestamp, orig_url), orig_url
+
+
+def make_cdx_url(
+    url: str, match_type: str = "prefix", resume_key: T.Optional[str] = None,
+    limit: int = CDX_PAGE_LIMIT, fields: T.Sequence[str] = CDX_FIELDS,
+) -> str:
+    params = {
+        "url": url,
+        "matchType": match_type,
+        "fl": ",".join(fields),
+        "limit": limit,
+        "showResumeKey": "true",
+    }
+    if resume_key:
+        params["resumeKey"] = resume_key
+
+    return f"{CDX_LINK}{urlencode(params)}"
+
+
+def iter_cdx_lines(
+    text: str, fields: T.Sequence[str] = CDX_FIELDS
+) -> T.Generator[T.Union[CdxCapture, str], None, None]:
+    """Yield captures from a plain-text CDX response.
+
+    With `showResumeKey=true` the captures are followed by an empty line and
+    the resume key, which is yielded last as a bare string.
+    """
+    lines = iter(text.splitlines())
+    for line in lines:
+        if not line.strip():
+            resume_key = next(lines, "").strip()
+            if resume_key:
+                yield resume_key
+            return
+        yield dict(zip(fields, line.split(" ")))
+
+
+def get_query_int(url: str, key: str) -> T.Optional[int]:
+    values = parse_qs(urlparse(url).query).get(key)
+    if values and values[0].isdigit():
+        return int(values[0])
+    return None
+
+
+def find_closest(
+    times: T.Sequence[datetime], date: datetime
+) -> T.Optional[int]:
+    """Index of the time closest to `date` in ascending `times`"""
+    if not times:
+        return None
+
+    i = bisect_left(times, date)
+    if i == 0:
+        return 0
+    if i == len(times):
+        return i - 1
+
+    before, after = times[i - 1], times[i]
+    return i - 1 if date - before <= after - date else i
+
+
+class CaptureTimeline:
+    """Sorted available captures of a single url, answering `closest` queries locally"""
+
+    def __init__(self, captures: T.Iterable[CdxCapture]) -> None:
+        by_time: T.Dict[datetime, CdxCapture] = {}
+        for capture in captures:
+            if capture["statuscode"] not in AVAILABLE_STATUSES:
+                continue
+            by_time.setdefault(convert_snapshot_timestamp(capture["timestamp"]), capture)
+
+        self.times = sorted(by_time)
+        self.captures = [by_time[time] for time in self.times]
+
+    def __len__(self) -> int:
+        return len(self.times)
+
+    def closest(self, date: datetime) -> T.Optional[CdxCapture]:
+        i = find_closest(self.times, date)
+        return self.captures[i] if i is not None else None
+
+
+def order_captures(
+    timeline: CaptureTimeline, hint: T.Optional[datetime] = None
+) -> T.List[CdxCapture]:
+    """Captures of a page whose content only grows, most promising first.
+
+    The newest capture goes first. If the time of the last known change is
+    given, the earliest capture after it follows, as surely having all of
+    that change. Then the rest, newest to oldest.
+    """
+    ordered = timeline.captures[::-1]
+    if hint is None or len(ordered) < 2:
+        return ordered
+
+    i = bisect_left(timeline.times, hint)
+    if i < len(timeline.times) - 1:
+        earliest_after = ordered.pop(len(ordered) - 1 - i)
+        ordered.insert(1, earliest_after)
+    return ordered
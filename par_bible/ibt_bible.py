@@ -14,7 +14,9 @@ from bs4 import (
 )
 
 from models import TextItem, TextMeta, AuthorMeta
-from utils import random_delay_adder, append_list_part, write_json, HEADERS
+from utils import adaptive_delay_adder, append_list_part, write_json, HEADERS
+# `utils` makes the repository root importable
+from webtexts import serialization
 
 try:
     from tqdm.auto import tqdm
@@ -165,7 +167,7 @@ class BibleText(BaseText):
                 "chapters": {ch.i: ch.to_json() for ch in self.chapters}}
 
 
-@random_delay_adder(0.5, 1.0)
+@adaptive_delay_adder(0.5, 10.0)
 def load_chapter(
     text_title: str, chapter: int=1, text_title_template: str = "{title}.{chapter}",
     return_text_container_only=False
@@ -319,8 +321,8 @@ def main():
         pbar.set_description(f"Книга: {title}")
         texts.append(process_one_text(title))
         
-    with open("bible-sah_ru.json", "w", encoding="utf-8") as f:
-        json.dump(texts, f, ensure_ascii=False, indent=4)
+    with open("bible-sah_ru.json", "wb") as f:
+        f.write(serialization.dumps_bytes(texts, indent=4))
 
 
 if __name__ == "__main__":
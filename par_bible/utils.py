@@ -1,10 +1,16 @@
+from pathlib import Path
 import random
-from time import sleep
+import sys
+from time import sleep, monotonic
 import json
 
 import requests
 from bs4 import BeautifulSoup
 
+# modules shared by the scrapers (`webtexts`) are in the repository root
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+from webtexts import serialization
+
 HEADERS = {
     # 'authority': 'www.kith.com',
     'cache-control': 'max-age=0',
@@ -42,6 +48,27 @@ def random_delay_adder(min, max):
     return add_random_delay
 
 
+def adaptive_delay_adder(min_delay, max_delay, jitter=0.25):
+    """Sleep about as long as the previous call took, doubling after failures"""
+    def add_adaptive_delay(func):
+        state = {"delay": min_delay}
+
+        def delayed_func(*args, **kwargs):
+            sleep(state["delay"] * random.uniform(1 - jitter, 1 + jitter))
+
+            start = monotonic()
+            try:
+                result = func(*args, **kwargs)
+            except Exception:
+                state["delay"] = min(max_delay, state["delay"] * 2)
+                raise
+            state["delay"] = max(min_delay, min(max_delay, monotonic() - start))
+            return result
+
+        return delayed_func
+    return add_adaptive_delay
+
+
 def make_page_loader(PARSER):
     def load_page(page_link):
         response = requests.get(page_link)
@@ -52,5 +79,5 @@ def make_page_loader(PARSER):
 
 
 def write_json(obj, filename):
-    with open(f"{filename}.json", 'w', encoding='utf-8') as f:
-        json.dump(obj, f, ensure_ascii=False, indent=2, default=str)
+    with open(f"{filename}.json", 'wb') as f:
+        f.write(serialization.dumps_bytes(obj, indent=2))
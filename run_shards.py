@@ -0,0 +1,316 @@
+"""Run a spider as several processes, each crawling its own shard of the input.
+
+    python run_shards.py forum_ykt replies -n 4 -a items=replies
+    python run_shards.py edersaas ysia -n 2 --merge json
+
+Every process gets `SHARD_COUNT` and `SHARD_INDEX` settings, by which the
+spider keeps its part of the input (crc32 of the topic key, of the forum
+and url style for forums, of the forum page for topics, every n-th listing
+page for news), so reruns crawl the same shards. Processes write JSON Lines shards (`FEED_MODE=shards`) and a
+log of their own under `--out`, and stores that can't be shared between
+processes get a path per shard too. Once all processes succeed, their
+shards replace the spider's feed (as shards or a JSON array) and the
+per-shard stores are merged where that makes sense.
+
+`replies -a refresh=1` splits the replies store among the shards by topic
+key before the crawl and merges them back into it afterwards, so a later
+refresh, sharded (with any `-n`) or not, starts from all stored topics.
+
+Each process throttles hosts on its own, so the per-host limits of
+`ADAPTIVE_HOST_LIMITS` are shared between them: the concurrency ceiling is
+divided by the number of shards, and where that leaves less than a request
+per process, the minimal delay grows instead. `-s` overrides of these
+settings are passed as they are.
+"""
+import argparse
+import gzip
+import io
+import json
+import os
+from pathlib import Path
+import re
+import shutil
+import subprocess
+import sys
+import time
+import typing as T
+
+from webtexts import feeds
+
+
+ROOT = Path(__file__).resolve().parent
+PROJECTS = ("forum_ykt", "edersaas")
+
+# spider argument -> file name of stores kept per shard
+SPIDER_STORES: T.Dict[str, T.Dict[str, str]] = {
+    "forums": {"index": "forums-snapshot-index.sqlite"},
+    "topics": {"topics_index": "topics-index.sqlite"},
+    "replies": {"progress": "replies-progress.sqlite", "store": "replies-store.sqlite"},
+}
+# stores kept only when one of the spider arguments is given -> those arguments
+OPTIONAL_STORES: T.Dict[str, T.Tuple[str, ...]] = {
+    "store": ("refresh",),
+}
+LOG_STATS_PATTERN = re.compile(r"Crawled (\d+) pages .*scraped (\d+) items")
+
+
+class Shard:
+    def __init__(self, index: int, directory: Path) -> None:
+        self.index = index
+        self.feed_dir = directory / f"shard-{index:02d}"
+        self.log_path = directory / f"shard-{index:02d}.log"
+        self.process: T.Optional[subprocess.Popen] = None
+        self.status = ""
+
+    def store_path(self, filename: str) -> Path:
+        return self.feed_dir.with_name(f"{self.feed_dir.name}-{filename}")
+
+    def read_status(self) -> str:
+        """Pages and items of the last stats line in the log"""
+        if not self.log_path.exists():
+            return "starting"
+        with open(self.log_path, "rb") as f:
+            f.seek(max(0, self.log_path.stat().st_size - 64 * 1024))
+            matches = LOG_STATS_PATTERN.findall(f.read().decode("utf-8", errors="replace"))
+        if not matches:
+            return "running"
+        pages, items = matches[-1]
+        return f"{pages} pages, {items} items"
+
+
+def load_spider(project: str, spider_name: str):
+    os.chdir(ROOT / project)
+    sys.path.insert(0, str(ROOT / project))
+    os.environ.setdefault("SCRAPY_SETTINGS_MODULE", f"{project}.settings")
+
+    from scrapy.spiderloader import SpiderLoader
+    from scrapy.utils.project import get_project_settings
+    return SpiderLoader.from_settings(get_project_settings()).load(spider_name)
+
+
+def share_limits(limits: T.Dict[str, T.Any], shard_count: int) -> T.Dict[str, T.Any]:
+    """Host limits of a single process, so that all of them together keep to `limits`"""
+    max_concurrency = limits["max_concurrency"]
+    concurrency = max(1, max_concurrency // shard_count)
+    # requests per second of all processes are at most those of a single one with `limits`
+    delay_factor = max(1.0, shard_count * concurrency / max_concurrency)
+    shared = {**limits, "min_delay": limits["min_delay"] * delay_factor, "max_concurrency": concurrency}
+    if "max_delay" in shared:
+        shared["max_delay"] = max(shared["max_delay"], shared["min_delay"])
+    return shared
+
+
+def get_shared_throttle_settings(spider, shard_count: int) -> T.Dict[str, T.Any]:
+    """`ADAPTIVE_*` settings of every process for the limits of the project to hold for all of them"""
+    from scrapy.utils.project import get_project_settings
+
+    settings = get_project_settings()
+    spider.update_settings(settings)
+    if not settings.getbool("ADAPTIVE_THROTTLE_ENABLED") or shard_count <= 1:
+        return {}
+
+    defaults = {
+        "min_delay": settings.getfloat("ADAPTIVE_MIN_DELAY", 0.0),
+        "max_concurrency": settings.getint("ADAPTIVE_MAX_CONCURRENCY", 8),
+    }
+    default_limits = share_limits(defaults, shard_count)
+    host2limits = {
+        host: share_limits({**defaults, **limits}, shard_count)
+        for host, limits in settings.getdict("ADAPTIVE_HOST_LIMITS").items()
+    }
+    return {
+        "ADAPTIVE_MIN_DELAY": default_limits["min_delay"],
+        "ADAPTIVE_MAX_CONCURRENCY": default_limits["max_concurrency"],
+        "ADAPTIVE_HOST_LIMITS": json.dumps(host2limits),
+    }
+
+
+def get_spider_args(args: argparse.Namespace) -> T.Dict[str, str]:
+    return dict(arg.split("=", 1) for arg in args.arg)
+
+
+def uses_store(arg: str, spider_args: T.Dict[str, str]) -> bool:
+    if arg not in OPTIONAL_STORES:
+        return True
+    return any(spider_args.get(name, "0") not in ("", "0") for name in OPTIONAL_STORES[arg])
+
+
+def make_command(
+    spider_name: str, shard: Shard, shard_count: int, args: argparse.Namespace,
+    throttle_settings: T.Dict[str, T.Any],
+) -> T.List[str]:
+    command = [sys.executable, "-m", "scrapy", "crawl", spider_name]
+    settings = {
+        "SHARD_COUNT": shard_count,
+        "SHARD_INDEX": shard.index,
+        "FEED_MODE": "shards",
+        "FEED_SHARDS_DIR": shard.feed_dir,
+        "LOG_FILE": shard.log_path,
+        **throttle_settings,
+    }
+    for name, value in settings.items():
+        command += ["-s", f"{name}={value}"]
+    # given after the shared ones, so that they win
+    for setting in args.set:
+        command += ["-s", setting]
+
+    spider_args = get_spider_args(args)
+    for arg, filename in SPIDER_STORES.get(spider_name, {}).items():
+        if arg in spider_args or not uses_store(arg, spider_args):
+            continue
+        command += ["-a", f"{arg}={shard.store_path(filename)}"]
+    for arg in args.arg:
+        command += ["-a", arg]
+    return command
+
+
+def run(shards: T.List[Shard], commands: T.List[T.List[str]], poll: float) -> bool:
+    for shard, command in zip(shards, commands):
+        shard.feed_dir.mkdir(parents=True, exist_ok=True)
+        # tracebacks before logging starts go to the log too
+        with open(shard.log_path, "ab") as log:
+            shard.process = subprocess.Popen(command, stdout=log, stderr=subprocess.STDOUT)
+        print(f"shard {shard.index}: pid {shard.process.pid}, log {shard.log_path}")
+
+    try:
+        while any(shard.process.poll() is None for shard in shards):
+            time.sleep(poll)
+            for shard in shards:
+                returncode = shard.process.poll()
+                status = shard.read_status() if returncode is None else f"exited with {returncode}"
+                if status != shard.status:
+                    shard.status = status
+                    print(f"shard {shard.index}: {status}")
+    except KeyboardInterrupt:
+        # scrapy shuts down gracefully on the first SIGINT, which the children got too
+        for shard in shards:
+            shard.process.wait()
+        raise
+
+    failed = [shard.index for shard in shards if shard.process.returncode != 0]
+    if failed:
+        print(f"shards {failed} failed, rerun to resume them (nothing merged)")
+    return not failed
+
+
+def iter_shard_lines(path: Path) -> T.Iterator[bytes]:
+    if path.suffix == ".gz":
+        f = gzip.open(path, "rb")
+    elif path.suffix == ".zst":
+        import zstandard
+        f = zstandard.ZstdDecompressor().stream_reader(open(path, "rb"))
+        f = io.BufferedReader(f)
+    else:
+        f = open(path, "rb")
+    with f:
+        yield from f
+
+
+def merge_feeds(shards: T.List[Shard], feed_uri: str, merge: str) -> None:
+    shard_paths = sorted(
+        path for shard in shards for path in shard.feed_dir.glob("part-*")
+        if path.suffix != feeds.PART_SUFFIX
+    )
+    if merge == "json":
+        # shard lines are compact JSON already
+        Path(feed_uri).parent.mkdir(parents=True, exist_ok=True)
+        with open(feed_uri, "wb") as f:
+            f.write(b"[")
+            lines = (line.rstrip(b"\n") for path in shard_paths for line in iter_shard_lines(path))
+            for i, line in enumerate(line for line in lines if line):
+                f.write(b"\n" if i == 0 else b",\n")
+                f.write(line)
+            f.write(b"\n]")
+        print(f"merged {len(shard_paths)} shards into {feed_uri}")
+        return
+
+    # shards of the processes are kept for reruns, so the merged ones are replaced
+    merged_dir = feeds.get_shards_dir(feed_uri)
+    merged_dir.mkdir(parents=True, exist_ok=True)
+    for path in merged_dir.glob("part-*"):
+        path.unlink()
+    for shard_i, path in enumerate(shard_paths):
+        suffixes = "".join(path.suffixes)
+        shutil.copyfile(path, merged_dir / f"part-{shard_i:05d}{suffixes}")
+    with open(merged_dir / feeds.DONE_MARKER, "w", encoding="utf-8") as f:
+        json.dump({"shards": sorted(path.name for path in merged_dir.glob("part-*"))}, f, indent=4)
+    print(f"merged {len(shard_paths)} shards into {merged_dir}")
+
+
+def split_stores(spider, shards: T.List[Shard], spider_args: T.Dict[str, str]) -> None:
+    """Give shards of a refresh the stored topics of their part, unless they have them from a failed run"""
+    if spider.name != "replies" or "store" in spider_args or not uses_store("store", spider_args):
+        return
+    from forum_ykt.storage import RepliesStore
+
+    replies_store = RepliesStore(spider.replies_store_path)
+    for shard in shards:
+        path = shard.store_path(SPIDER_STORES["replies"]["store"])
+        if not path.exists():
+            replies_store.split(path, shard.index, len(shards))
+    replies_store.close()
+
+
+def merge_stores(spider, shards: T.List[Shard], spider_args: T.Dict[str, str]) -> None:
+    # progress stays per shard, as the shards are resumed one by one
+    if spider.name == "forums":
+        from forum_ykt.storage import SnapshotIndex
+
+        snapshot_index = SnapshotIndex(spider.snapshot_index_path)
+        for shard in shards:
+            snapshot_index.merge(shard.store_path(SPIDER_STORES["forums"]["index"]))
+        print(f"{len(snapshot_index)} queries in {snapshot_index.path}")
+        snapshot_index.close()
+    elif spider.name == "topics":
+        from forum_ykt.storage import TopicIndex
+
+        topic_index = TopicIndex(spider.topic_index_path)
+        for shard in shards:
+            topic_index.merge(shard.store_path(SPIDER_STORES["topics"]["topics_index"]))
+        print(f"{len(topic_index)} topics in {topic_index.path}")
+        topic_index.close()
+    elif spider.name == "replies" and "store" not in spider_args and uses_store("store", spider_args):
+        from forum_ykt.storage import RepliesStore
+
+        # later refreshes, with any number of shards, start from the merged store
+        replies_store = RepliesStore(spider.replies_store_path)
+        for shard in shards:
+            path = shard.store_path(SPIDER_STORES["replies"]["store"])
+            replies_store.merge(path)
+            for store_file in (path, path.with_name(f"{path.name}-wal"), path.with_name(f"{path.name}-shm")):
+                store_file.unlink(missing_ok=True)
+        print(f"{len(replies_store)} topics in {replies_store.path}")
+        replies_store.close()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("project", choices=PROJECTS)
+    parser.add_argument("spider")
+    parser.add_argument("-n", "--shards", type=int, default=os.cpu_count())
+    parser.add_argument("-a", dest="arg", action="append", default=[], help="spider argument, NAME=VALUE")
+    parser.add_argument("-s", dest="set", action="append", default=[], help="setting, NAME=VALUE")
+    parser.add_argument("--out", type=Path, help="directory of shard feeds, stores and logs")
+    parser.add_argument("--merge", choices=("shards", "json", "none"), default="shards")
+    parser.add_argument("--poll", type=float, default=10.0, help="seconds between status lines")
+    args = parser.parse_args()
+
+    spider = load_spider(args.project, args.spider)
+    out = (args.out or Path("./res/shards") / spider.name).resolve()
+    shards = [Shard(i, out) for i in range(args.shards)]
+    throttle_settings = get_shared_throttle_settings(spider, args.shards)
+    spider_args = get_spider_args(args)
+    split_stores(spider, shards, spider_args)
+    commands = [make_command(spider.name, shard, args.shards, args, throttle_settings) for shard in shards]
+
+    if not run(shards, commands, args.poll):
+        sys.exit(1)
+
+    if args.merge != "none":
+        feed_uri, = spider.custom_feed
+        merge_feeds(shards, feed_uri, args.merge)
+    merge_stores(spider, shards, spider_args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,22 @@
+"""Feed exporters encoding items with `webtexts.serialization`"""
+from scrapy.exporters import JsonItemExporter, JsonLinesItemExporter
+
+from webtexts.serialization import dumps_bytes
+
+
+class FastJsonItemExporter(JsonItemExporter):
+    """JSON array feed, encoded by `serialization.dumps_bytes`"""
+
+    def export_item(self, item):
+        itemdict = dict(self._get_serialized_fields(item))
+        data = dumps_bytes(itemdict, indent=self._kwargs.get("indent"))
+        self._add_comma_after_first()
+        self.file.write(data)
+
+
+class FastJsonLinesItemExporter(JsonLinesItemExporter):
+    """JSON Lines feed, encoded by `serialization.dumps_bytes`"""
+
+    def export_item(self, item):
+        itemdict = dict(self._get_serialized_fields(item))
+        self.file.write(dumps_bytes(itemdict) + b"\n")
@@ -0,0 +1,163 @@
+"""JSON Lines feed shards, written in place of the FEEDS export with `FEED_MODE=shards`"""
+import typing as T
+import gzip
+import json
+import logging
+from pathlib import Path
+
+from scrapy import Spider
+from scrapy.crawler import Crawler
+from scrapy.settings import BaseSettings
+
+from itemadapter import ItemAdapter
+
+from webtexts.serialization import dumps_bytes
+
+try:
+    import zstandard
+    ZSTANDARD_AVAILABLE = True
+except ImportError:
+    ZSTANDARD_AVAILABLE = False
+
+
+logger = logging.getLogger(__name__)
+
+SHARD_SUFFIXES = {"gzip": ".jsonl.gz", "zstd": ".jsonl.zst", "none": ".jsonl"}
+PART_SUFFIX = ".part"
+DONE_MARKER = "_DONE"
+
+# sent with `path` and `items` once a shard is renamed from `.part`
+shard_finished = object()
+
+
+def get_shards_dir(feed_uri: str) -> Path:
+    """Shards of a feed go to a directory named as the feed file without its suffix"""
+    path = Path(feed_uri)
+    return path.with_name(path.stem)
+
+
+def update_feed_settings(settings: BaseSettings, custom_feed: T.Dict[str, T.Dict[str, T.Any]]) -> None:
+    """Set up the spider's feed according to `FEED_MODE`.
+
+    `json` (default) exports a single array through FEEDS, `shards` writes
+    compressed JSON Lines shards with `ShardedJsonLinesPipeline`, `none`
+    (for stages chained in process) writes nothing.
+    """
+    feed_mode = settings.get("FEED_MODE", "json")
+    if feed_mode == "json":
+        settings.setdefault("FEEDS", {}).update(custom_feed)
+    elif feed_mode == "shards":
+        feed_uri, = custom_feed
+        settings.set("FEED_SHARDS_DIR", str(get_shards_dir(feed_uri)), priority="spider")
+        pipelines = settings.getdict("ITEM_PIPELINES")
+        pipelines[ShardedJsonLinesPipeline] = 900
+        settings.set("ITEM_PIPELINES", pipelines, priority="spider")
+    elif feed_mode != "none":
+        raise ValueError(f"unknown feed mode: {feed_mode}")
+
+
+class ShardWriter:
+    """A single shard, written as `<name>.part` and renamed when finished"""
+
+    def __init__(self, path: Path, compression: str) -> None:
+        self.path = path
+        self.part_path = path.with_name(path.name + PART_SUFFIX)
+        self.items = 0
+        self.bytes = 0
+
+        if compression == "gzip":
+            self.file = gzip.open(self.part_path, "wb")
+        elif compression == "zstd":
+            self.file = zstandard.ZstdCompressor().stream_writer(open(self.part_path, "wb"))
+        else:
+            self.file = open(self.part_path, "wb")
+
+    def write(self, line: bytes) -> None:
+        self.file.write(line)
+        self.items += 1
+        self.bytes += len(line)
+
+    def finish(self) -> None:
+        self.file.close()
+        self.part_path.rename(self.path)
+
+
+class ShardedJsonLinesPipeline:
+    """Writes items as compact JSON Lines into compressed, rotated shards.
+
+    A shard is renamed from `.part` once it has `FEED_SHARD_MAX_ITEMS` items
+    or `FEED_SHARD_MAX_BYTES` bytes of uncompressed JSON, so finished shards
+    can be read while the crawl goes on. `_DONE` with the list of shards is
+    written when the spider closes. Shards of earlier crawls are kept and
+    numbering continues after them, while `.part` shards left by a crash
+    are removed: what they had is not counted as written (`shard_finished`).
+    """
+
+    def __init__(
+        self, directory: T.Union[str, Path], compression: str = "gzip",
+        max_items: int = 100_000, max_bytes: int = 256 * 2 ** 20,
+    ) -> None:
+        if compression not in SHARD_SUFFIXES:
+            raise ValueError(f"unknown shard compression: {compression}")
+        if compression == "zstd" and not ZSTANDARD_AVAILABLE:
+            raise ImportError("zstd shards need the `zstandard` package")
+
+        self.directory = Path(directory)
+        self.compression = compression
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+
+        self.writer: T.Optional[ShardWriter] = None
+        self.shard_i = 0
+        self.crawler: T.Optional[Crawler] = None
+
+    @classmethod
+    def from_crawler(cls, crawler: Crawler):
+        settings = crawler.settings
+        pipeline = cls(
+            settings.get("FEED_SHARDS_DIR"),
+            compression=settings.get("FEED_SHARD_COMPRESSION", "gzip"),
+            max_items=settings.getint("FEED_SHARD_MAX_ITEMS", 100_000),
+            max_bytes=settings.getint("FEED_SHARD_MAX_BYTES", 256 * 2 ** 20),
+        )
+        pipeline.crawler = crawler
+        return pipeline
+
+    def open_spider(self, spider: Spider) -> None:
+        self.directory.mkdir(parents=True, exist_ok=True)
+        (self.directory / DONE_MARKER).unlink(missing_ok=True)
+        for stale_part in self.directory.glob(f"*{PART_SUFFIX}"):
+            logger.warning(f"removing unfinished shard of an earlier crawl: {stale_part}")
+            stale_part.unlink()
+
+        self.shard_i = len(list(self.directory.glob("part-*")))
+
+    def open_shard(self) -> ShardWriter:
+        name = f"part-{self.shard_i:05d}{SHARD_SUFFIXES[self.compression]}"
+        self.shard_i += 1
+        return ShardWriter(self.directory / name, self.compression)
+
+    def finish_shard(self) -> None:
+        writer, self.writer = self.writer, None
+        writer.finish()
+        logger.info(f"finished shard {writer.path} of {writer.items} items")
+        if self.crawler is not None:
+            self.crawler.signals.send_catch_log(shard_finished, path=writer.path, items=writer.items)
+
+    def process_item(self, item, spider: Spider):
+        line = dumps_bytes(ItemAdapter(item).asdict()) + b"\n"
+
+        if self.writer is None:
+            self.writer = self.open_shard()
+        self.writer.write(line)
+        if self.writer.items >= self.max_items or self.writer.bytes >= self.max_bytes:
+            self.finish_shard()
+
+        return item
+
+    def close_spider(self, spider: Spider) -> None:
+        if self.writer is not None:
+            self.finish_shard()
+
+        with open(self.directory / DONE_MARKER, "w", encoding="utf-8") as f:
+            json.dump({"shards": sorted(path.name for path in self.directory.glob("part-*"))}, f, indent=4)
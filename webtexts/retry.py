@@ -0,0 +1,237 @@
+"""Retries with backoff per host, shared by the Scrapy projects of the repository"""
+import typing as T
+from collections import deque
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+import logging
+import random
+import time
+
+from scrapy import signals, Request, Spider
+from scrapy.crawler import Crawler
+from scrapy.downloadermiddlewares.retry import RetryMiddleware
+from scrapy.exceptions import DontCloseSpider, IgnoreRequest
+from scrapy.http import Response
+from scrapy.utils.httpobj import urlparse_cached
+from scrapy.utils.python import global_object_name
+from scrapy.utils.response import response_status_message
+
+from webtexts.throttle import AdaptiveThrottle
+
+
+logger = logging.getLogger(__name__)
+
+
+class DeferredRetry(IgnoreRequest):
+    """The request is put aside and will be retried once the crawl is otherwise done"""
+
+
+class HostHealth:
+    """Recent outcomes of requests to a single host"""
+
+    def __init__(self, window: int) -> None:
+        self.outcomes: T.Deque[bool] = deque(maxlen=window)
+        self.consecutive_failures = 0
+        self.open_until = 0.0
+        self.trips = 0
+
+    def record(self, ok: bool) -> None:
+        self.outcomes.append(ok)
+        self.consecutive_failures = 0 if ok else self.consecutive_failures + 1
+
+    @property
+    def error_rate(self) -> float:
+        return self.outcomes.count(False) / len(self.outcomes) if self.outcomes else 0.0
+
+    def is_open(self, now: float) -> bool:
+        return now < self.open_until
+
+
+class BackoffRetryMiddleware(RetryMiddleware):
+    """Retries with per-host backoff, a circuit breaker and a deferred queue.
+
+    Throttling responses (`BACKOFF_HTTP_CODES`, 429 and 503 by default) and
+    download errors raise the download delay of the host's slot
+    exponentially, with jitter and no lower than `Retry-After`; successes
+    bring it back down to `DOWNLOAD_DELAY`. With `AdaptiveThrottle` enabled,
+    the throttle alone sets delays and is only told of the backoff. When more than
+    `BREAKER_ERROR_RATE` of the last `BREAKER_WINDOW` requests to a host
+    failed, the breaker opens for `BREAKER_COOLDOWN` seconds (doubling on
+    every trip) and requests to the host are deferred meanwhile. Deferred
+    requests, and those which ran out of retries, are scheduled again with
+    a lower priority when the spider goes idle, at most
+    `DEFERRED_RETRY_TIMES` times each. Requests failing after that are
+    dropped with `IgnoreRequest`, so that only errbacks see them.
+    """
+
+    def __init__(self, crawler: Crawler) -> None:
+        super().__init__(crawler.settings)
+        settings = crawler.settings
+        self.crawler = crawler
+        self.stats = crawler.stats
+
+        self.backoff_http_codes = set(settings.getlist("BACKOFF_HTTP_CODES", [429, 503]))
+        self.base_delay = settings.getfloat("DOWNLOAD_DELAY")
+        self.backoff_start = settings.getfloat("BACKOFF_START_DELAY", 5.0)
+        self.backoff_max = settings.getfloat("BACKOFF_MAX_DELAY", 300.0)
+        self.backoff_jitter = settings.getfloat("BACKOFF_JITTER", 0.3)
+
+        self.breaker_window = settings.getint("BREAKER_WINDOW", 50)
+        self.breaker_min_requests = settings.getint("BREAKER_MIN_REQUESTS", 10)
+        self.breaker_error_rate = settings.getfloat("BREAKER_ERROR_RATE", 0.5)
+        self.breaker_cooldown = settings.getfloat("BREAKER_COOLDOWN", 60.0)
+
+        self.deferred_retry_times = settings.getint("DEFERRED_RETRY_TIMES", 2)
+        self.deferred_priority_adjust = settings.getint("DEFERRED_PRIORITY_ADJUST", -100)
+
+        self.host2health: T.Dict[str, HostHealth] = {}
+        self.deferred: T.List[Request] = []
+
+        self.throttle: T.Optional[AdaptiveThrottle] = next(
+            (ext for ext in crawler.extensions.middlewares if isinstance(ext, AdaptiveThrottle)), None
+        )
+
+    @classmethod
+    def from_crawler(cls, crawler: Crawler):
+        s = cls(crawler)
+        crawler.signals.connect(s.spider_idle, signal=signals.spider_idle)
+        return s
+
+    @staticmethod
+    def get_slot_key(request: Request) -> str:
+        return request.meta.get("download_slot") or urlparse_cached(request).hostname or ""
+
+    def get_health(self, key: str) -> HostHealth:
+        if key not in self.host2health:
+            self.host2health[key] = HostHealth(self.breaker_window)
+        return self.host2health[key]
+
+    @staticmethod
+    def parse_retry_after(response: Response) -> T.Optional[float]:
+        value = response.headers.get("Retry-After")
+        if not value:
+            return None
+        value = value.decode("latin-1").strip()
+        if value.isdigit():
+            return float(value)
+        try:
+            return max(0.0, (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds())
+        except (TypeError, ValueError):
+            return None
+
+    def set_slot_delay(self, key: str, delay: float) -> None:
+        slot = self.crawler.engine.downloader.slots.get(key)
+        if slot is not None:
+            slot.delay = delay
+            self.stats.set_value(f"backoff/delay/{key}", round(delay, 2))
+
+    def on_success(self, key: str) -> None:
+        health = self.get_health(key)
+        health.record(ok=True)
+        if self.throttle is not None:
+            return
+
+        slot = self.crawler.engine.downloader.slots.get(key)
+        if slot is not None and slot.delay > self.base_delay:
+            self.set_slot_delay(key, max(self.base_delay, slot.delay / 2))
+
+    def on_failure(self, key: str, retry_after: T.Optional[float] = None) -> None:
+        health = self.get_health(key)
+        health.record(ok=False)
+
+        delay = min(self.backoff_max, self.backoff_start * 2 ** (health.consecutive_failures - 1))
+        delay *= random.uniform(1 - self.backoff_jitter, 1 + self.backoff_jitter)
+        if retry_after is not None:
+            delay = max(delay, min(retry_after, self.backoff_max))
+
+        if self.throttle is not None:
+            self.throttle.backoff(key, delay)
+        else:
+            slot = self.crawler.engine.downloader.slots.get(key)
+            if slot is not None and delay > slot.delay:
+                self.set_slot_delay(key, delay)
+        self.stats.inc_value(f"backoff/failures/{key}")
+
+        now = time.monotonic()
+        if (
+            not health.is_open(now)
+            and len(health.outcomes) >= self.breaker_min_requests
+            and health.error_rate > self.breaker_error_rate
+        ):
+            cooldown = min(self.backoff_max * 4, self.breaker_cooldown * 2 ** health.trips)
+            health.open_until = now + cooldown
+            health.trips += 1
+            health.outcomes.clear()
+            self.stats.inc_value(f"backoff/breaker_trips/{key}")
+            logger.warning(f"circuit breaker for {key} is open for {cooldown:.0f}s")
+
+    def defer(self, request: Request, reason: str, spider: Spider) -> None:
+        """Raise `DeferredRetry`, unless the request was deferred enough times already"""
+        deferred_times = request.meta.get("deferred_times", 0)
+        if deferred_times >= self.deferred_retry_times:
+            return
+
+        retry_request = request.replace(
+            priority=request.priority + self.deferred_priority_adjust, dont_filter=True,
+        )
+        retry_request.meta["deferred_times"] = deferred_times + 1
+        retry_request.meta["retry_times"] = 0
+        self.deferred.append(retry_request)
+        self.stats.inc_value("backoff/deferred")
+        self.stats.inc_value(f"backoff/deferred_reason/{reason}")
+        raise DeferredRetry(f"deferred {request} ({reason})")
+
+    def process_request(self, request: Request, spider: Spider):
+        key = self.get_slot_key(request)
+        if self.get_health(key).is_open(time.monotonic()):
+            self.defer(request, "breaker_open", spider)
+        return None
+
+    def process_response(self, request: Request, response: Response, spider: Spider):
+        key = self.get_slot_key(request)
+        if "cached" in response.flags:
+            # served from the http cache, says nothing of the host
+            pass
+        elif response.status in self.backoff_http_codes or response.status >= 500:
+            self.on_failure(key, retry_after=self.parse_retry_after(response))
+        else:
+            self.on_success(key)
+
+        if request.meta.get("dont_retry", False) or response.status not in self.retry_http_codes:
+            return response
+
+        reason = response_status_message(response.status)
+        retry_request = self._retry(request, reason, spider)
+        if retry_request is not None:
+            return retry_request
+        self.defer(request, str(response.status), spider)
+        # callbacks expect an answer, errbacks of chained requests carry the chain on
+        self.stats.inc_value("backoff/gave_up")
+        raise IgnoreRequest(f"gave up on {request} ({reason})")
+
+    def process_exception(self, request: Request, exception: Exception, spider: Spider):
+        if not isinstance(exception, self.exceptions_to_retry) or request.meta.get("dont_retry", False):
+            return None
+
+        self.on_failure(self.get_slot_key(request))
+        retry_request = self._retry(request, exception, spider)
+        if retry_request is not None:
+            return retry_request
+        self.defer(request, global_object_name(exception.__class__), spider)
+        return None
+
+    def spider_idle(self, spider: Spider) -> None:
+        if not self.deferred:
+            return
+
+        now = time.monotonic()
+        ready = [request for request in self.deferred
+                 if not self.get_health(self.get_slot_key(request)).is_open(now)]
+        self.deferred = [request for request in self.deferred
+                         if self.get_health(self.get_slot_key(request)).is_open(now)]
+
+        if ready:
+            logger.info(f"retrying {len(ready)} deferred requests, {len(self.deferred)} still wait")
+        for request in ready:
+            self.crawler.engine.crawl(request)
+        raise DontCloseSpider
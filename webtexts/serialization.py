@@ -0,0 +1,85 @@
+"""JSON encoding and decoding shared by the scrapers of the repository, with orjson when it is installed"""
+import typing as T
+from datetime import date, datetime
+import json
+import re
+
+try:
+    import orjson
+    ORJSON_AVAILABLE = True
+except ImportError:
+    ORJSON_AVAILABLE = False
+
+
+# `YYYY-MM-DD`, optionally followed by time, as written by `dumps` (or with a space, by scrapy feeds)
+ISO_DATE_PATTERN = re.compile(r"^\d{4}-\d{2}-\d{2}(?:[T ]\d{2}:\d{2}:\d{2}(?:\.\d{1,6})?)?$")
+
+
+def default(obj: T.Any) -> T.Any:
+    """Encode what json (or orjson) can't by itself"""
+    if isinstance(obj, (datetime, date)):
+        return obj.isoformat()
+    if isinstance(obj, (set, frozenset)):
+        return list(obj)
+    return str(obj)
+
+
+def dumps_bytes(obj: T.Any, indent: T.Optional[int] = None) -> bytes:
+    """UTF-8 JSON of `obj`, with datetimes and dates in ISO format
+
+    orjson only indents by 2, so any `indent` means 2 with it.
+    """
+    if ORJSON_AVAILABLE:
+        # keys such as chapter numbers become strings, as with json
+        option = orjson.OPT_NON_STR_KEYS
+        if indent:
+            option |= orjson.OPT_INDENT_2
+        return orjson.dumps(obj, default=default, option=option)
+
+    separators = (",", ":") if indent is None else None
+    return json.dumps(
+        obj, default=default, ensure_ascii=False, indent=indent, separators=separators
+    ).encode("utf-8")
+
+
+def dumps(obj: T.Any, indent: T.Optional[int] = None) -> str:
+    return dumps_bytes(obj, indent=indent).decode("utf-8")
+
+
+def parse_iso_date(value: str) -> T.Union[datetime, date, str]:
+    if len(value) < 10 or value[4] != "-" or not ISO_DATE_PATTERN.match(value):
+        return value
+    if len(value) == 10:
+        return date.fromisoformat(value)
+    return datetime.fromisoformat(value)
+
+
+def decode_dates(obj: T.Any, keys: T.Optional[T.Collection[str]] = None) -> T.Any:
+    """Turn ISO strings back into datetimes and dates in place, in values of `keys` only if given"""
+    if isinstance(obj, dict):
+        for key, value in obj.items():
+            if isinstance(value, str):
+                if keys is None or key in keys:
+                    obj[key] = parse_iso_date(value)
+            elif isinstance(value, (dict, list)):
+                decode_dates(value, keys)
+    elif isinstance(obj, list):
+        for i, value in enumerate(obj):
+            if isinstance(value, str):
+                if keys is None:
+                    obj[i] = parse_iso_date(value)
+            elif isinstance(value, (dict, list)):
+                decode_dates(value, keys)
+    elif isinstance(obj, str) and keys is None:
+        return parse_iso_date(obj)
+    return obj
+
+
+def loads(
+    data: T.Union[str, bytes], dates: bool = False, date_keys: T.Optional[T.Collection[str]] = None
+) -> T.Any:
+    """Parse JSON, with `dates` turning ISO strings (of `date_keys`, if given) back to datetimes"""
+    obj = orjson.loads(data) if ORJSON_AVAILABLE else json.loads(data)
+    if dates or date_keys is not None:
+        obj = decode_dates(obj, date_keys)
+    return obj
@@ -0,0 +1,167 @@
+"""Delay and concurrency per host, shared by the Scrapy projects of the repository"""
+import typing as T
+from collections import deque
+import logging
+
+from scrapy import signals, Request, Spider
+from scrapy.core.downloader import Slot
+from scrapy.crawler import Crawler
+from scrapy.exceptions import NotConfigured
+from scrapy.http import Response
+from scrapy.utils.httpobj import urlparse_cached
+
+
+logger = logging.getLogger(__name__)
+
+
+class HostLimits(T.TypedDict, total=False):
+    min_delay: float
+    max_delay: float
+    max_concurrency: int
+
+
+class HostStats:
+    """Smoothed latency and recent errors of a single host"""
+
+    def __init__(self, window: int) -> None:
+        self.latency: T.Optional[float] = None
+        self.outcomes: T.Deque[bool] = deque(maxlen=window)
+        # lowest delay after failures, halved on every success
+        self.backoff_delay = 0.0
+
+    def record(self, latency: float, ok: bool, smoothing: float) -> None:
+        self.latency = latency if self.latency is None else (
+            smoothing * latency + (1 - smoothing) * self.latency
+        )
+        self.outcomes.append(ok)
+
+    @property
+    def error_rate(self) -> float:
+        return self.outcomes.count(False) / len(self.outcomes) if self.outcomes else 0.0
+
+
+class AdaptiveThrottle:
+    """Tunes download delay and concurrency of every host from its latency and errors.
+
+    Like AutoThrottle, the delay follows `latency / ADAPTIVE_TARGET_CONCURRENCY`,
+    and error responses never lower it. Concurrency grows by one while the
+    error rate of the last `ADAPTIVE_WINDOW` responses stays under
+    `ADAPTIVE_ERROR_RATE` and is halved above it. Both are kept within
+    `ADAPTIVE_HOST_LIMITS` of the host (or the `ADAPTIVE_MIN_DELAY`,
+    `ADAPTIVE_MAX_DELAY`, `ADAPTIVE_MAX_CONCURRENCY` defaults), and the
+    current values are kept in the `adaptive/<host>/...` stats. Slots start
+    at the concurrency ceiling of their host.
+
+    The throttle is the only one to set slot delays: the retry middleware
+    reports the backoff delay of failures with `backoff`, and the delay
+    stays at least at it, halved on every success since.
+    """
+
+    def __init__(self, crawler: Crawler) -> None:
+        settings = crawler.settings
+        if not settings.getbool("ADAPTIVE_THROTTLE_ENABLED"):
+            raise NotConfigured
+
+        self.crawler = crawler
+        self.stats = crawler.stats
+
+        self.target_concurrency = settings.getfloat("ADAPTIVE_TARGET_CONCURRENCY", 1.0)
+        self.window = settings.getint("ADAPTIVE_WINDOW", 20)
+        self.error_rate = settings.getfloat("ADAPTIVE_ERROR_RATE", 0.1)
+        self.smoothing = settings.getfloat("ADAPTIVE_LATENCY_SMOOTHING", 0.3)
+        self.default_limits: HostLimits = {
+            "min_delay": settings.getfloat("ADAPTIVE_MIN_DELAY", 0.0),
+            "max_delay": settings.getfloat("ADAPTIVE_MAX_DELAY", 60.0),
+            "max_concurrency": settings.getint("ADAPTIVE_MAX_CONCURRENCY", 8),
+        }
+        self.host2limits: T.Dict[str, HostLimits] = settings.getdict("ADAPTIVE_HOST_LIMITS")
+
+        self.host2stats: T.Dict[str, HostStats] = {}
+
+    @classmethod
+    def from_crawler(cls, crawler: Crawler):
+        ext = cls(crawler)
+        crawler.signals.connect(ext.request_reached_downloader, signal=signals.request_reached_downloader)
+        crawler.signals.connect(ext.response_downloaded, signal=signals.response_downloaded)
+        return ext
+
+    @staticmethod
+    def get_slot_key(request: Request) -> str:
+        return request.meta.get("download_slot") or urlparse_cached(request).hostname or ""
+
+    def get_limits(self, host: str) -> HostLimits:
+        # limits of `archive.org` apply to `web.archive.org` too, unless it has its own
+        parts = host.split(".")
+        for i in range(len(parts)):
+            limits = self.host2limits.get(".".join(parts[i:]))
+            if limits is not None:
+                return {**self.default_limits, **limits}
+        return self.default_limits
+
+    def request_reached_downloader(self, request: Request, spider: Spider) -> None:
+        key = self.get_slot_key(request)
+        if key in self.host2stats:
+            return
+        slot = self.crawler.engine.downloader.slots.get(key)
+        if slot is None:
+            return
+
+        # a new slot, not to go over the host's ceiling until enough responses are in
+        self.host2stats[key] = HostStats(self.window)
+        limits = self.get_limits(key)
+        slot.concurrency = limits["max_concurrency"]
+        slot.delay = min(max(slot.delay, limits["min_delay"]), limits["max_delay"])
+        self.publish(key, slot)
+
+    def backoff(self, key: str, delay: float) -> None:
+        """Keep the delay of the host at least at `delay`, after a failure"""
+        host_stats = self.host2stats.setdefault(key, HostStats(self.window))
+        host_stats.backoff_delay = max(host_stats.backoff_delay, delay)
+
+        slot = self.crawler.engine.downloader.slots.get(key)
+        if slot is not None and delay > slot.delay:
+            slot.delay = delay
+            self.publish(key, slot)
+
+    def response_downloaded(self, response: Response, request: Request, spider: Spider) -> None:
+        key = self.get_slot_key(request)
+        slot = self.crawler.engine.downloader.slots.get(key)
+        latency = request.meta.get("download_latency")
+        if slot is None or latency is None:
+            return
+
+        ok = response.status < 400 or response.status == 404
+        host_stats = self.host2stats.setdefault(key, HostStats(self.window))
+        host_stats.record(latency, ok, self.smoothing)
+        limits = self.get_limits(key)
+
+        delay = (slot.delay + host_stats.latency / self.target_concurrency) / 2
+        delay = min(max(delay, limits["min_delay"]), limits["max_delay"])
+        if ok:
+            host_stats.backoff_delay /= 2
+            slot.delay = max(delay, host_stats.backoff_delay)
+        elif delay > slot.delay:
+            slot.delay = delay
+
+        if len(host_stats.outcomes) >= self.window:
+            if host_stats.error_rate > self.error_rate:
+                concurrency = max(1, slot.concurrency // 2)
+            elif host_stats.error_rate == 0:
+                concurrency = slot.concurrency + 1
+            else:
+                concurrency = slot.concurrency
+            concurrency = min(concurrency, limits["max_concurrency"])
+            if concurrency != slot.concurrency:
+                logger.debug(f"{key}: concurrency {slot.concurrency} -> {concurrency}")
+                slot.concurrency = concurrency
+                host_stats.outcomes.clear()
+
+        self.publish(key, slot)
+
+    def publish(self, key: str, slot: Slot) -> None:
+        host_stats = self.host2stats[key]
+        self.stats.set_value(f"adaptive/{key}/delay", round(slot.delay, 3))
+        self.stats.set_value(f"adaptive/{key}/concurrency", slot.concurrency)
+        if host_stats.latency is not None:
+            self.stats.set_value(f"adaptive/{key}/latency", round(host_stats.latency, 3))
+        self.stats.set_value(f"adaptive/{key}/error_rate", round(host_stats.error_rate, 3))